@@ -1,21 +1,66 @@
 # app.py
 import os
+import sys
 import sqlite3
 import base64
 import io
-from datetime import datetime, date
+import gzip
+import shutil
+import fcntl
+import json
+import socket
+import time
+import hmac
+import hashlib
+import secrets
+import threading
+import queue
+import csv
+import zipfile
+import tempfile
+import itertools
+import re
+import contextvars
+from contextlib import contextmanager
+import unicodedata
+from datetime import datetime, date, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 from calendar import monthcalendar, month_name
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape as xml_escape
 
-from flask import Flask, request, redirect, url_for, session, render_template_string, abort, send_file
+import click
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
+from markupsafe import escape
+from flask import (
+    Flask, request, redirect, url_for, session, render_template_string, abort, send_file,
+    Response, stream_with_context, has_request_context,
+)
 
 
 app = Flask(__name__)
 
 APP_NAME = "Lullyland"
-app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key-change-me")
+DEFAULT_SECRET_KEY = "dev-secret-key-change-me"
+app.secret_key = os.getenv("SECRET_KEY", DEFAULT_SECRET_KEY)
 APP_PIN = os.getenv("APP_PIN", "1234")
 DB_PATH = os.getenv("DB_PATH", "lullyland.db")
+# Più sedi: VENUES="centro=lullyland.db,mare=lullyland-mare.db", un file SQLite per sede (regole
+# slot e listini compresi). Senza VENUES c'è una sola sede, su DB_PATH.
+VENUES = OrderedDict(
+    (k.strip().lower(), v.strip())
+    for k, v in (item.split("=", 1) for item in os.getenv("VENUES", "").split(",") if "=" in item)
+) or OrderedDict([("", DB_PATH)])
+MULTI_VENUE = len(VENUES) > 1 or "" not in VENUES
+# Sede dei comandi CLI e dei processi fuori richiesta: VENUE=mare flask jobs-worker
+DEFAULT_VENUE = os.getenv("VENUE", next(iter(VENUES))).lower()
+if DEFAULT_VENUE not in VENUES:
+    raise RuntimeError(f"VENUE={DEFAULT_VENUE!r} non è tra le sedi configurate ({', '.join(VENUES)})")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
 
 # -------------------------
 # Cataloghi e prezzi
@@ -69,13 +114,329 @@ EXTRA_SERVIZI_ALL_INCLUSIVE = {
     "mascotte_deluxe": ("Servizio mascotte deluxe", Decimal("90.00")),
 }
 
+# Listino di partenza (versione 1 in price_lists). I listini successivi stanno nel database,
+# datati: vale quello con valid_from più recente non successivo alla data evento.
+DEFAULT_PRICE_LIST = {
+    "packages": PACKAGE_PRICES_EUR,
+    "torta_eur_per_kg": TORTA_PRICE_EUR_PER_KG,
+    "torta_esterna_eur_per_person": TORTA_ESTERNASVC_EUR_PER_PERSON,
+    "extras": EXTRA_SERVIZI,
+    "extras_all_inclusive": EXTRA_SERVIZI_ALL_INCLUSIVE,
+}
+
+
+def price_list_to_json(prices: dict) -> str:
+    return json.dumps({
+        "packages": {k: str(v) for k, v in prices["packages"].items()},
+        "torta_eur_per_kg": str(prices["torta_eur_per_kg"]),
+        "torta_esterna_eur_per_person": str(prices["torta_esterna_eur_per_person"]),
+        "extras": {k: [name, str(v)] for k, (name, v) in prices["extras"].items()},
+        "extras_all_inclusive": {k: [name, str(v)] for k, (name, v) in prices["extras_all_inclusive"].items()},
+    })
+
+
+def price_list_from_json(data_json: str) -> dict:
+    data = json.loads(data_json)
+    return {
+        "packages": {k: Decimal(v) for k, v in data["packages"].items()},
+        "torta_eur_per_kg": Decimal(data["torta_eur_per_kg"]),
+        "torta_esterna_eur_per_person": Decimal(data["torta_esterna_eur_per_person"]),
+        "extras": {k: (name, Decimal(v)) for k, (name, v) in data["extras"].items()},
+        "extras_all_inclusive": {k: (name, Decimal(v)) for k, (name, v) in data["extras_all_inclusive"].items()},
+    }
+
+# -------------------------
+# Sedi: instradamento e connessioni
+# -------------------------
+# La sede di una richiesta arriva dal sottodominio (mare.example.it) o dal primo pezzo del
+# percorso (/mare/...); col prefisso, url_for e request.script_root portano la sede in
+# tutti i link. Una richiesta senza sede non viene mai indovinata: le letture si
+# reindirizzano all'ultima sede usata, le scritture si rifiutano (gli id delle prenotazioni
+# si ripetono tra i DB). Fuori richiesta vale use_venue() o VENUE. Le chiavi delle sedi
+# non devono coincidere con un percorso dell'app.
+_VENUE = contextvars.ContextVar("venue", default=None)
+
+
+def current_venue() -> str:
+    venue = _VENUE.get()
+    if venue is not None:
+        return venue
+    if has_request_context():
+        venue = request.environ.get("lullyland.venue")
+        if venue in VENUES:
+            return venue
+    return DEFAULT_VENUE
+
+
+@contextmanager
+def use_venue(venue: str):
+    token = _VENUE.set(venue)
+    try:
+        yield
+    finally:
+        _VENUE.reset(token)
+
+
+def venue_db_path(venue: str = None) -> str:
+    return VENUES[current_venue() if venue is None else venue]
+
+
+class VenueRouter:
+    """Middleware WSGI: riconosce la sede da sottodominio o prefisso del percorso."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        host = (environ.get("HTTP_HOST") or environ.get("SERVER_NAME") or "").split(":")[0]
+        sub = host.split(".", 1)[0].lower() if host.count(".") >= 2 else ""
+        first = (environ.get("PATH_INFO") or "").lstrip("/").split("/", 1)[0].lower()
+        if sub and sub in VENUES:
+            environ["lullyland.venue"] = sub
+        elif first and first in VENUES:
+            environ["lullyland.venue"] = first
+            environ["lullyland.venue_prefix"] = True
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + environ["PATH_INFO"][:len(first) + 1]
+            environ["PATH_INFO"] = environ["PATH_INFO"][len(first) + 1:] or "/"
+        return self.wsgi_app(environ, start_response)
+
+
+if MULTI_VENUE:
+    app.wsgi_app = VenueRouter(app.wsgi_app)
+
+    @app.before_request
+    def require_venue():
+        venue = request.environ.get("lullyland.venue")
+        if venue:
+            if request.environ.get("lullyland.venue_prefix") and session.get("venue") != venue:
+                session["venue"] = venue
+            return None
+        if request.method not in ("GET", "HEAD"):
+            abort(400, "Sede mancante nell'indirizzo: ricarica la pagina dalla sede giusta.")
+        venue = session.get("venue") if session.get("venue") in VENUES else DEFAULT_VENUE
+        return redirect(f"{request.script_root}/{venue}{request.full_path.rstrip('?')}")
+
+
+class PerVenue:
+    """Un'istanza per sede (cache, indici), creata al primo uso; inoltra attributi e metodi
+    a quella della sede corrente, così il codice che la usa non cambia."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def _current(self):
+        venue = current_venue()
+        item = self._items.get(venue)
+        if item is None:
+            with self._lock:
+                item = self._items.get(venue)
+                if item is None:
+                    item = self._items[venue] = self._factory()
+        return item
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+
+class PooledConnection(sqlite3.Connection):
+    """close() rimette la connessione nel pool della sua sede invece di chiuderla."""
+
+    pool = None
+    idle = False
+
+    def close(self):
+        if self.idle:
+            return
+        if self.pool is None or not self.pool.release(self):
+            super().close()
+
+
+class ConnectionPool:
+    """Connessioni già aperte verso il DB di una sede, riusate tra le richieste.
+
+    Ogni sede ha il suo file e quindi il suo lock di scrittura: le sedi non si bloccano
+    a vicenda. Dopo un fork (pool di processi) il figlio riparte con un pool vuoto: le
+    connessioni del padre non vanno né usate né chiuse.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def acquire(self) -> PooledConnection:
+        if os.getpid() != self._pid:
+            self._inherited.append(self._idle)
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.path, factory=PooledConnection, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.pool = self
+        conn.idle = False
+        return conn
+
+    def release(self, conn) -> bool:
+        if os.getpid() != self._pid or self._idle.qsize() >= self.size:
+            return False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            for r in conn.execute("PRAGMA database_list").fetchall():
+                if r["name"] not in ("main", "temp"):
+                    conn.execute(f"DETACH DATABASE {r['name']}")
+        except sqlite3.Error:
+            return False
+        conn.idle = True
+        self._idle.put(conn)
+        return True
+
+
+DB_POOLS = {venue: ConnectionPool(path, DB_POOL_SIZE) for venue, path in VENUES.items()}
+
 # -------------------------
 # DB helpers
 # -------------------------
+def audit_actor() -> str:
+    """Chi sta scrivendo, per lo storico: dispositivo (sessione) e richiesta, oppure il comando."""
+    if has_request_context():
+        return f"{session.get('device', '-')} {request.method} {request.path}"
+    return "sistema " + " ".join(os.path.basename(a) for a in sys.argv[:2])
+
+
+def actor_stamp() -> str:
+    """Valore per bookings.last_actor: chi scrive, più un contatore dopo un TAB.
+
+    I trigger dello storico leggono NEW.last_actor solo se la scrittura l'ha cambiato; il
+    contatore rende diverse anche due modifiche di fila dallo stesso dispositivo.
+    """
+    return f"{audit_actor()}\t{time.time_ns()}"
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Connessione (dal pool) al DB della sede corrente; conn.close() la restituisce."""
+    return DB_POOLS[current_venue()].acquire()
+
+
+# Un solo importo e nient'altro: "50", "50,00", "1.234,50", "EUR 50.5", "50 €". Testo libero
+# ("200 (bonifico 12/03)", "100 + 50") non si indovina: resta da registrare a mano.
+EUR_AMOUNT_RE = re.compile(
+    r"^(?:EUR|€)?\s*(?P<int>\d{1,3}(?:[.\s]\d{3})+|\d+)(?:[.,](?P<dec>\d{1,2}))?\s*(?:EUR|€|euro)?$",
+    re.IGNORECASE,
+)
+
+
+def parse_eur_cents(value):
+    """Importo scritto a mano in centesimi; None se il testo non è solo un importo."""
+    m = EUR_AMOUNT_RE.match(str(value or "").strip())
+    if not m:
+        return None
+    units = int(re.sub(r"[.\s]", "", m.group("int")))
+    return units * 100 + int((m.group("dec") or "0").ljust(2, "0"))
+
+
+def unparsed_deposits(conn) -> list:
+    """Prenotazioni con un acconto scritto che non è un importo e nessun pagamento registrato."""
+    rows = conn.execute(
+        """
+        SELECT id, event_date, nome_festeggiato, acconto_eur FROM bookings
+        WHERE acconto_eur <> '' AND paid_cent = 0 ORDER BY event_date
+        """
+    ).fetchall()
+    return [r for r in rows if parse_eur_cents(r["acconto_eur"]) is None]
+
+
+# Totale della prenotazione in centesimi dal testo "123.45" di totale_stimato_eur (per i trigger del saldo)
+BOOKING_TOTAL_CENT_SQL = "CAST(ROUND(COALESCE(CAST({row}.totale_stimato_eur AS REAL), 0) * 100) AS INTEGER)"
+
+
+# Storico modifiche: colonne escluse (derivate o con un registro proprio) e colonne di cui si
+# annota solo la lunghezza (firma in base64, testo del contratto ricavato dagli altri campi)
+AUDIT_SKIP_COLUMNS = {"id", "row_version", "paid_cent", "balance_cent", "child_key", "customer_id", "last_actor"}
+AUDIT_LENGTH_COLUMNS = {"firma_png_base64", "dettagli_contratto_text"}
+
+
+# Chi ha scritto, da bookings.last_actor (vedi actor_stamp). Niente funzioni registrate dall'app:
+# i trigger girano anche da sqlite3 o da altri strumenti, che lasciano l'autore vuoto.
+AUDIT_ACTOR_SQL = "substr(NEW.last_actor, 1, instr(NEW.last_actor || char(9), char(9)) - 1)"
+
+
+def audit_trigger_sql(columns: list, op: str) -> str:
+    """Trigger che scrive in audit_log solo i campi cambiati: {"campo": [prima, dopo]}."""
+    if op == "I":
+        return f"""
+        CREATE TRIGGER trg_audit_i AFTER INSERT ON bookings BEGIN
+            INSERT INTO audit_log (month, seq, booking_id, op, version, changed_at, actor, delta)
+            SELECT m, (SELECT COALESCE(MAX(seq), 0) + 1 FROM audit_log WHERE month = m), NEW.id, 'I', NEW.row_version,
+                   strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'), {AUDIT_ACTOR_SQL}, NULL
+            FROM (SELECT strftime('%Y-%m', 'now', 'localtime') AS m);
+        END"""
+    # Una modifica che non ha riscritto last_actor (fuori dall'app) non eredita l'autore precedente
+    event, row, version, actor = {
+        "U": ("AFTER UPDATE ON bookings", "NEW", "NEW.row_version",
+              f"CASE WHEN NEW.last_actor IS NOT OLD.last_actor THEN {AUDIT_ACTOR_SQL} END"),
+        "D": ("AFTER DELETE ON bookings WHEN NOT EXISTS (SELECT 1 FROM archived_bookings WHERE id = OLD.id)",
+              "OLD", "OLD.row_version", "NULL"),
+    }[op]
+
+    def val(prefix, c):
+        if c in AUDIT_LENGTH_COLUMNS:
+            return f"CASE WHEN {prefix}.{c} IS NULL THEN NULL ELSE length({prefix}.{c}) || ' caratteri' END"
+        return f"{prefix}.{c}"
+
+    pairs = " UNION ALL ".join(
+        f"SELECT '{c}' AS k, {val('OLD', c)} AS o, {'NULL' if op == 'D' else val('NEW', c)} AS n"
+        for c in columns if c not in AUDIT_SKIP_COLUMNS
+    )
+    return f"""
+        CREATE TRIGGER trg_audit_{op.lower()} {event} BEGIN
+            INSERT INTO audit_log (month, seq, booking_id, op, version, changed_at, actor, delta)
+            SELECT m, (SELECT COALESCE(MAX(seq), 0) + 1 FROM audit_log WHERE month = m), {row}.id, '{op}', {version},
+                   ts, {actor}, d
+            FROM (
+                SELECT strftime('%Y-%m', 'now', 'localtime') AS m,
+                       strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime') AS ts,
+                       (SELECT json_group_object(k, json_array(o, n)) FROM ({pairs}) WHERE o IS NOT n) AS d
+            )
+            WHERE d <> '{{}}';
+        END"""
+
+
+def install_audit_triggers(conn):
+    """(Ri)crea i trigger dello storico se le colonne di bookings sono cambiate."""
+    columns = [r["name"] for r in conn.execute("PRAGMA table_info(bookings)")]
+    for op in ("I", "U", "D"):
+        name = f"trg_audit_{op.lower()}"
+        sql = audit_trigger_sql(columns, op).strip()
+        r = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()
+        if r and r["sql"] == sql:
+            continue
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(sql)
+
+
+def stats_trigger_sql(row: str, sign: int) -> str:
+    """Statement del trigger che somma (sign=1) o toglie (sign=-1) una riga dai rollup."""
+    return f"""
+        INSERT INTO stats_monthly (month, pacchetto, slot_code, weekend, eventi, bimbi, adulti, ricavo_cent)
+        SELECT substr({row}.event_date, 1, 7), COALESCE({row}.pacchetto, ''), COALESCE({row}.slot_code, ''),
+               strftime('%w', {row}.event_date) IN ('0', '6'), {sign},
+               {sign} * COALESCE({row}.invitati_bambini, 0), {sign} * COALESCE({row}.invitati_adulti, 0),
+               {sign} * CAST(ROUND(COALESCE(CAST({row}.totale_stimato_eur AS REAL), 0) * 100) AS INTEGER)
+        WHERE {row}.event_date IS NOT NULL
+        ON CONFLICT (month, pacchetto, slot_code, weekend) DO UPDATE SET
+            eventi = eventi + excluded.eventi, bimbi = bimbi + excluded.bimbi,
+            adulti = adulti + excluded.adulti, ricavo_cent = ricavo_cent + excluded.ricavo_cent;
+        INSERT INTO stats_daily (day, slot_code, eventi)
+        SELECT {row}.event_date, COALESCE({row}.slot_code, ''), {sign} WHERE {row}.event_date IS NOT NULL
+        ON CONFLICT (day, slot_code) DO UPDATE SET eventi = eventi + excluded.eventi;
+    """
 
 
 def ensure_column(conn, table: str, col_name: str, col_type: str):
@@ -84,6 +445,106 @@ def ensure_column(conn, table: str, col_name: str, col_type: str):
         conn.execute(f"ALTER TABLE {table} ADD COLUMN {col_name} {col_type}")
 
 
+# Clienti: una riga per famiglia, trovata dai telefoni normalizzati (customer_phones) o dai
+# nomi dei genitori parola per parola (customer_names), entrambi cercabili per prefisso.
+CUSTOMER_FIELDS = ("madre_nome_cognome", "madre_telefono", "padre_nome_cognome", "padre_telefono", "indirizzo_residenza", "email")
+CUSTOMER_SUGGEST_LIMIT = 8
+
+
+def normalize_phone(value) -> str:
+    """Solo cifre, senza prefisso internazionale italiano; '' se non sembra un numero."""
+    raw = str(value or "").strip()
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    if digits.startswith("0039"):
+        digits = digits[4:]
+    elif raw.startswith("+39") or (digits.startswith("39") and len(digits) in (11, 12)):
+        digits = digits[2:]
+    return digits if len(digits) >= 6 else ""
+
+
+def name_key(text: str) -> str:
+    """Minuscolo e senza accenti, per confronti e indice dei nomi."""
+    decomposed = unicodedata.normalize("NFKD", str(text or "").lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def child_key(name: str) -> str:
+    """Nome del festeggiato normalizzato (spazi compresi) per il controllo doppioni."""
+    return " ".join(name_key(name).split())
+
+
+def upsert_customer(conn, data: dict, new_booking: bool = True):
+    """Collega i dati genitori della prenotazione alla famiglia (per telefono); ritorna l'id o None.
+
+    I campi non vuoti della prenotazione aggiornano la scheda: vale l'ultimo dato inserito.
+    new_booking=False (modifica di una prenotazione) non conta una festa in più.
+    """
+    phones = [p for p in dict.fromkeys(normalize_phone(data.get(k)) for k in ("madre_telefono", "padre_telefono")) if p]
+    if not phones:
+        return None
+    values = {f: (data.get(f) or "").strip() for f in CUSTOMER_FIELDS}
+    values["now"] = datetime.now().isoformat(timespec="seconds")
+    values["inc"] = 1 if new_booking else 0
+
+    marks = ",".join("?" * len(phones))
+    found = conn.execute(f"SELECT customer_id FROM customer_phones WHERE phone_norm IN ({marks}) LIMIT 1", phones).fetchone()
+    if found:
+        customer_id = found["customer_id"]
+        conn.execute(
+            """
+            UPDATE customers SET
+              madre_nome_cognome = COALESCE(NULLIF(:madre_nome_cognome, ''), madre_nome_cognome),
+              madre_telefono = COALESCE(NULLIF(:madre_telefono, ''), madre_telefono),
+              padre_nome_cognome = COALESCE(NULLIF(:padre_nome_cognome, ''), padre_nome_cognome),
+              padre_telefono = COALESCE(NULLIF(:padre_telefono, ''), padre_telefono),
+              indirizzo_residenza = COALESCE(NULLIF(:indirizzo_residenza, ''), indirizzo_residenza),
+              email = COALESCE(NULLIF(:email, ''), email),
+              updated_at = :now, bookings_count = bookings_count + :inc
+            WHERE id = :id
+            """,
+            {**values, "id": customer_id},
+        )
+    else:
+        customer_id = conn.execute(
+            """
+            INSERT INTO customers (madre_nome_cognome, madre_telefono, padre_nome_cognome, padre_telefono,
+                                   indirizzo_residenza, email, created_at, updated_at, bookings_count)
+            VALUES (:madre_nome_cognome, :madre_telefono, :padre_nome_cognome, :padre_telefono,
+                    :indirizzo_residenza, :email, :now, :now, :inc)
+            """,
+            values,
+        ).lastrowid
+
+    # Un numero già di un'altra famiglia resta a quella (INSERT OR IGNORE sulla chiave unica)
+    conn.executemany(
+        "INSERT OR IGNORE INTO customer_phones (phone_norm, customer_id) VALUES (?, ?)",
+        [(p, customer_id) for p in phones],
+    )
+    r = conn.execute("SELECT madre_nome_cognome, padre_nome_cognome FROM customers WHERE id = ?", (customer_id,)).fetchone()
+    keys = {w for n in (r["madre_nome_cognome"], r["padre_nome_cognome"]) for w in name_key(n).split() if len(w) >= 2}
+    conn.execute("DELETE FROM customer_names WHERE customer_id = ?", (customer_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO customer_names (name_key, customer_id) VALUES (?, ?)",
+        [(k, customer_id) for k in keys],
+    )
+    return customer_id
+
+
+def backfill_customers(conn) -> int:
+    """Crea le schede famiglia dalle prenotazioni esistenti (in ordine di inserimento)."""
+    rows = conn.execute(
+        f"SELECT id, {', '.join(CUSTOMER_FIELDS)} FROM bookings WHERE customer_id IS NULL ORDER BY id"
+    ).fetchall()
+    n = 0
+    for r in rows:
+        customer_id = upsert_customer(conn, dict(r))
+        if customer_id:
+            conn.execute("UPDATE bookings SET customer_id = ? WHERE id = ?", (customer_id, r["id"]))
+            n += 1
+    conn.commit()
+    return n
+
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
@@ -147,16 +608,397 @@ def init_db():
     ensure_column(conn, "bookings", "end_time", "TEXT")
     ensure_column(conn, "bookings", "area", "INTEGER")
 
+    # Chiave di idempotenza dell'invio del form (dedup di doppi invii e rinvii offline)
+    ensure_column(conn, "bookings", "idempotency_key", "TEXT")
+
     conn.execute("""
       CREATE INDEX IF NOT EXISTS idx_bookings_calendar
       ON bookings(event_date, slot_code)
     """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_idempotency ON bookings(idempotency_key)")
+
+    # Feed delle modifiche (append-only), scritto dai trigger: il MAX(seq) è il contatore
+    # globale delle modifiche usato per cache e sync token.
+    # op: I=insert, U=update, D=delete, M=update che sposta data/slot (riga con i valori vecchi)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS booking_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            event_date TEXT,
+            slot_code TEXT,
+            changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'))
+        )
+        """
+    )
+    cur.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_changes_ins AFTER INSERT ON bookings BEGIN
+            INSERT INTO booking_changes (booking_id, op, event_date, slot_code)
+            VALUES (NEW.id, 'I', NEW.event_date, NEW.slot_code);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_changes_upd AFTER UPDATE ON bookings BEGIN
+            INSERT INTO booking_changes (booking_id, op, event_date, slot_code)
+            VALUES (NEW.id, 'U', NEW.event_date, NEW.slot_code);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_changes_move AFTER UPDATE OF event_date, slot_code ON bookings
+        WHEN OLD.event_date IS NOT NEW.event_date OR OLD.slot_code IS NOT NEW.slot_code BEGIN
+            INSERT INTO booking_changes (booking_id, op, event_date, slot_code)
+            VALUES (OLD.id, 'M', OLD.event_date, OLD.slot_code);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_changes_del AFTER DELETE ON bookings BEGIN
+            INSERT INTO booking_changes (booking_id, op, event_date, slot_code)
+            VALUES (OLD.id, 'D', OLD.event_date, OLD.slot_code);
+        END;
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params_json TEXT NOT NULL,
+            dedupe_key TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            worker TEXT,
+            result_path TEXT,
+            result_mimetype TEXT,
+            result_filename TEXT,
+            error TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, run_after, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(dedupe_key)")
+    # Punto di ripresa di regenerate-contracts, uno per combinazione di filtri
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS regen_checkpoints (
+            run_key TEXT PRIMARY KEY,
+            params_json TEXT NOT NULL,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            updated INTEGER NOT NULL DEFAULT 0,
+            pdfs INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_booking_changes_booking ON booking_changes(booking_id, seq)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS job_workers (
+            name TEXT PRIMARY KEY,
+            heartbeat_at REAL
+        )
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_bookings (
+            id INTEGER PRIMARY KEY,
+            archive_year INTEGER NOT NULL
+        )
+        """
+    )
+
+    # Listini prezzi datati (vedi price_list_for); la versione 1 è il listino storico del codice
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS price_lists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            valid_from TEXT NOT NULL,
+            created_at TEXT,
+            note TEXT,
+            data_json TEXT NOT NULL
+        )
+        """
+    )
+    if not cur.execute("SELECT 1 FROM price_lists LIMIT 1").fetchone():
+        cur.execute(
+            "INSERT INTO price_lists (valid_from, created_at, note, data_json) VALUES (?,?,?,?)",
+            ("2000-01-01", datetime.now().isoformat(timespec="seconds"), "Listino iniziale",
+             price_list_to_json(DEFAULT_PRICE_LIST)),
+        )
+    ensure_column(conn, "bookings", "price_list_id", "INTEGER")
+
+    # Rollup per le statistiche: mantenuti dai trigger a ogni scrittura (vedi statistiche).
+    # Le cancellazioni dell'archiviazione non sottraggono: la riga è già in archived_bookings.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_monthly (
+            month TEXT NOT NULL,
+            pacchetto TEXT NOT NULL,
+            slot_code TEXT NOT NULL,
+            weekend INTEGER NOT NULL,
+            eventi INTEGER NOT NULL DEFAULT 0,
+            bimbi INTEGER NOT NULL DEFAULT 0,
+            adulti INTEGER NOT NULL DEFAULT 0,
+            ricavo_cent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, pacchetto, slot_code, weekend)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            slot_code TEXT NOT NULL,
+            eventi INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, slot_code)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_meta (id INTEGER PRIMARY KEY CHECK (id = 1), built_at TEXT)")
+    for name, event, sides in (
+        ("ins", "AFTER INSERT ON bookings", (("NEW", 1),)),
+        ("upd", "AFTER UPDATE OF event_date, slot_code, pacchetto, invitati_bambini, invitati_adulti, totale_stimato_eur ON bookings",
+         (("OLD", -1), ("NEW", 1))),
+        ("del", "AFTER DELETE ON bookings WHEN NOT EXISTS (SELECT 1 FROM archived_bookings WHERE id = OLD.id)", (("OLD", -1),)),
+    ):
+        body = "".join(stats_trigger_sql(row, sign) for row, sign in sides)
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_stats_{name} {event} BEGIN {body} END")
+
+    # Cache degli aggregati di produzione delle settimane concluse (vedi planner_days)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS planner_weeks (
+            week_start TEXT PRIMARY KEY,
+            data_json TEXT NOT NULL,
+            seq INTEGER NOT NULL
+        )
+        """
+    )
+
+    # Regole slot/aree (vedi SlotCalendar); rules_version avanza a ogni modifica
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS slot_templates (
+            code TEXT PRIMARY KEY,
+            label TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            weekdays TEXT NOT NULL,
+            sort_order INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS areas (
+            area INTEGER PRIMARY KEY,
+            label TEXT,
+            is_overflow INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS calendar_days (
+            day TEXT NOT NULL,
+            slot_code TEXT NOT NULL DEFAULT '',
+            kind TEXT NOT NULL,
+            note TEXT,
+            PRIMARY KEY (day, slot_code)
+        )
+        """
+    )
+    ensure_column(conn, "areas", "capacity", "INTEGER")  # ospiti massimi (NULL = senza limite)
+    cur.execute("CREATE TABLE IF NOT EXISTS rules_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    cur.execute("INSERT OR IGNORE INTO rules_version (id, version) VALUES (1, 0)")
+    for table in ("slot_templates", "areas", "calendar_days"):
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()} AFTER {op} ON {table} "
+                f"BEGIN UPDATE rules_version SET version = version + 1 WHERE id = 1; END"
+            )
+    # Regole storiche: mattina solo sabato/domenica, pomeriggio tutti i giorni, Area 3 su conferma
+    if not cur.execute("SELECT 1 FROM slot_templates LIMIT 1").fetchone():
+        cur.executemany(
+            "INSERT INTO slot_templates (code, label, start_time, end_time, weekdays, sort_order) VALUES (?,?,?,?,?,?)",
+            [
+                ("MORNING", "MATTINA", "09:30", "12:30", "5,6", 0),
+                ("AFTERNOON", "POMERIDIANO/SERALE", "17:00", "20:00", "0,1,2,3,4,5,6", 1),
+            ],
+        )
+    if not cur.execute("SELECT 1 FROM areas LIMIT 1").fetchone():
+        cur.executemany(
+            "INSERT INTO areas (area, label, is_overflow) VALUES (?,?,?)",
+            [(1, "Area 1", 0), (2, "Area 2", 0), (3, "Area 3", 1)],
+        )
+
+    # Famiglie ricorrenti (vedi upsert_customer e /clienti/cerca)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            madre_nome_cognome TEXT,
+            madre_telefono TEXT,
+            padre_nome_cognome TEXT,
+            padre_telefono TEXT,
+            indirizzo_residenza TEXT,
+            email TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            bookings_count INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS customer_phones (
+            phone_norm TEXT PRIMARY KEY,
+            customer_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS customer_names (
+            name_key TEXT NOT NULL,
+            customer_id INTEGER NOT NULL,
+            PRIMARY KEY (name_key, customer_id)
+        ) WITHOUT ROWID
+        """
+    )
+    ensure_column(conn, "bookings", "customer_id", "INTEGER")
+    if not cur.execute("SELECT 1 FROM customers LIMIT 1").fetchone():
+        backfill_customers(conn)
+
+    # Controllo doppioni: festeggiato e famiglia, entrambi con la data in coda all'indice
+    ensure_column(conn, "bookings", "child_key", "TEXT")
+    missing = cur.execute("SELECT id, nome_festeggiato FROM bookings WHERE child_key IS NULL").fetchall()
+    if missing:
+        conn.executemany("UPDATE bookings SET child_key = ? WHERE id = ?", [(child_key(r["nome_festeggiato"]), r["id"]) for r in missing])
+    conn.execute("DROP INDEX IF EXISTS idx_bookings_customer")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_customer_date ON bookings(customer_id, event_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_child_date ON bookings(child_key, event_date)")
+
+    # Lock ottimistico per le modifiche: ogni UPDATE dal form controlla e incrementa la versione
+    ensure_column(conn, "bookings", "row_version", "INTEGER NOT NULL DEFAULT 1")
+
+    # Pagamenti: registro a righe (importi in centesimi, rimborsi negativi). Incassato e saldo
+    # della prenotazione sono colonne tenute aggiornate dai trigger, mai ricalcolate con SUM.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            amount_cent INTEGER NOT NULL,
+            method TEXT NOT NULL DEFAULT '',
+            paid_at TEXT NOT NULL,
+            note TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_booking ON payments(booking_id, paid_at)")
+    had_balance = "balance_cent" in {r["name"] for r in cur.execute("PRAGMA table_info(bookings)")}
+    ensure_column(conn, "bookings", "paid_cent", "INTEGER NOT NULL DEFAULT 0")
+    ensure_column(conn, "bookings", "balance_cent", "INTEGER NOT NULL DEFAULT 0")
+    total_new = BOOKING_TOTAL_CENT_SQL.format(row="NEW")
+    cur.executescript(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_payments_ins AFTER INSERT ON payments BEGIN
+            UPDATE bookings SET paid_cent = paid_cent + NEW.amount_cent, balance_cent = balance_cent - NEW.amount_cent
+            WHERE id = NEW.booking_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_payments_del AFTER DELETE ON payments BEGIN
+            UPDATE bookings SET paid_cent = paid_cent - OLD.amount_cent, balance_cent = balance_cent + OLD.amount_cent
+            WHERE id = OLD.booking_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_payments_upd AFTER UPDATE OF booking_id, amount_cent ON payments BEGIN
+            UPDATE bookings SET paid_cent = paid_cent - OLD.amount_cent, balance_cent = balance_cent + OLD.amount_cent
+            WHERE id = OLD.booking_id;
+            UPDATE bookings SET paid_cent = paid_cent + NEW.amount_cent, balance_cent = balance_cent - NEW.amount_cent
+            WHERE id = NEW.booking_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_balance_ins AFTER INSERT ON bookings
+        WHEN NEW.balance_cent IS NOT {total_new} - NEW.paid_cent BEGIN
+            UPDATE bookings SET balance_cent = {total_new} - paid_cent WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_balance_upd AFTER UPDATE OF totale_stimato_eur ON bookings BEGIN
+            UPDATE bookings SET balance_cent = {total_new} - paid_cent WHERE id = NEW.id;
+        END;
+        """
+    )
+    # Solo gli eventi con saldo aperto entrano nell'indice: "da incassare nei prossimi N giorni"
+    # legge le righe del risultato, non la tabella
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_unpaid ON bookings(event_date, slot_code) WHERE balance_cent > 0")
+    if not had_balance:
+        # Primo avvio col registro: gli acconti già scritti nel campo di testo diventano pagamenti,
+        # ma solo se il testo è un importo e basta (il resto finisce tra gli acconti da verificare)
+        acconti = [
+            (r["id"], parse_eur_cents(r["acconto_eur"]), r["data_firma"] or r["created_at"] or "", r["created_at"] or "")
+            for r in cur.execute("SELECT id, acconto_eur, data_firma, created_at FROM bookings WHERE acconto_eur <> ''")
+        ]
+        conn.executemany(
+            "INSERT INTO payments (booking_id, amount_cent, paid_at, note, created_at) VALUES (?, ?, ?, 'Acconto alla firma', ?)",
+            [a for a in acconti if a[1]],
+        )
+        conn.execute(f"UPDATE bookings SET balance_cent = {BOOKING_TOTAL_CENT_SQL.format(row='bookings')} - paid_cent")
+
+    # Storico modifiche (in sola aggiunta): una riga per modifica con i soli campi cambiati,
+    # scritta dai trigger nella stessa transazione. La chiave (month, seq) tiene ogni mese
+    # contiguo su disco; l'indice per prenotazione porta con sé la chiave, quindi lo storico
+    # di una prenotazione esce già in ordine. Va tenuto per ultimo: i trigger elencano le
+    # colonne di bookings e si rigenerano se ne compare una nuova.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS audit_log (
+            month TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            booking_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            version INTEGER,
+            changed_at TEXT NOT NULL,
+            actor TEXT,
+            delta TEXT,
+            PRIMARY KEY (month, seq)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_booking ON audit_log(booking_id)")
+    cur.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_audit_log_no_update BEFORE UPDATE ON audit_log BEGIN
+            SELECT RAISE(ABORT, 'audit_log: storico in sola aggiunta');
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_audit_log_no_delete BEFORE DELETE ON audit_log BEGIN
+            SELECT RAISE(ABORT, 'audit_log: storico in sola aggiunta');
+        END;
+        """
+    )
+    ensure_column(conn, "bookings", "last_actor", "TEXT")
+    install_audit_triggers(conn)
+
+    conn.commit()
+    # WAL: il worker dei lavori e i worker web scrivono in parallelo senza bloccare le letture
+    conn.execute("PRAGMA journal_mode=WAL")
 
     conn.commit()
     conn.close()
 
 
-init_db()
+for _venue in VENUES:
+    with use_venue(_venue):
+        init_db()
 
 # -------------------------
 # Utility
@@ -165,6 +1007,12 @@ def is_logged_in():
     return session.get("ok") is True
 
 
+def booking_change_counter(conn) -> int:
+    """Contatore globale delle modifiche a bookings (ultimo seq del feed)."""
+    r = conn.execute("SELECT MAX(seq) AS seq FROM booking_changes").fetchone()
+    return int(r["seq"] or 0)
+
+
 def to_int(val):
     try:
         return int(val) if val not in (None, "",) else None
@@ -202,7 +1050,16 @@ def eur(d: Decimal) -> str:
     return s.replace(".", ",")
 
 
-def build_contract_text(payload: dict) -> str:
+def package_labels(prices: dict) -> dict:
+    """PACKAGE_LABELS col prezzo a persona del listino indicato."""
+    return {
+        k: f"{label.split(' EUR ')[0]} EUR {eur(prices['packages'][k])} a persona" if " EUR " in label else label
+        for k, label in PACKAGE_LABELS.items()
+    }
+
+
+def build_contract_text(payload: dict, prices: dict = None) -> str:
+    prices = prices or DEFAULT_PRICE_LIST
     pacchetto = payload.get("pacchetto", "")
     invitati_b = payload.get("invitati_bambini") or 0
     invitati_a = payload.get("invitati_adulti") or 0
@@ -210,7 +1067,7 @@ def build_contract_text(payload: dict) -> str:
 
     lines = []
     if pacchetto in ("Fai da Te", "Lullyland Experience", "Lullyland all-inclusive"):
-        price = PACKAGE_PRICES_EUR.get(pacchetto, Decimal("0.00"))
+        price = prices["packages"].get(pacchetto, Decimal("0.00"))
         lines.append(f"PACCHETTO: {pacchetto} - EUR {eur(price)} a persona")
     else:
         lines.append(f"PACCHETTO: {pacchetto}")
@@ -268,10 +1125,10 @@ def build_contract_text(payload: dict) -> str:
         if torta_choice == "esterna":
             lines += [
                 "TORTA (ESTERNA):",
-                f"- Torta esterna: +EUR {eur(TORTA_ESTERNASVC_EUR_PER_PERSON)} a persona (servizio torta)",
+                f"- Torta esterna: +EUR {eur(prices['torta_esterna_eur_per_person'])} a persona (servizio torta)",
             ]
         else:
-            lines.append(f"TORTA (SCELTA) (EUR {eur(TORTA_PRICE_EUR_PER_KG)} al chilo):")
+            lines.append(f"TORTA (SCELTA) (EUR {eur(prices['torta_eur_per_kg'])} al chilo):")
             if torta_choice == "interna":
                 if torta_interna_choice == "standard":
                     lines.append(f"- Torta interna (da noi): {TORTA_INTERNA_FLAVORS['standard']}")
@@ -287,8 +1144,8 @@ def build_contract_text(payload: dict) -> str:
             lines += ["", "SERVIZI EXTRA (selezionati):"]
             tot_extra = Decimal("0.00")
             for k in extra_keys:
-                if k in EXTRA_SERVIZI:
-                    name, price = EXTRA_SERVIZI[k]
+                if k in prices["extras"]:
+                    name, price = prices["extras"][k]
                     tot_extra += price
                     lines.append(f"- {name} EUR {eur(price)}")
             lines.append(f"Totale extra: EUR {eur(tot_extra)}")
@@ -360,8 +1217,8 @@ def build_contract_text(payload: dict) -> str:
             lines += ["", "SERVIZI EXTRA (selezionati):"]
             tot_extra = Decimal("0.00")
             for k in extra_keys:
-                if k in EXTRA_SERVIZI_ALL_INCLUSIVE:
-                    name, price = EXTRA_SERVIZI_ALL_INCLUSIVE[k]
+                if k in prices["extras_all_inclusive"]:
+                    name, price = prices["extras_all_inclusive"][k]
                     tot_extra += price
                     lines.append(f"- {name} EUR {eur(price)}")
             lines.append(f"Totale extra: EUR {eur(tot_extra)}")
@@ -382,13 +1239,14 @@ def build_contract_text(payload: dict) -> str:
     return "\n".join(lines)
 
 
-def compute_totals(payload: dict) -> dict:
+def compute_totals(payload: dict, prices: dict = None) -> dict:
+    prices = prices or DEFAULT_PRICE_LIST
     pacchetto = payload.get("pacchetto", "")
     invitati_b = int(payload.get("invitati_bambini") or 0)
     invitati_a = int(payload.get("invitati_adulti") or 0)
     tot_persone = invitati_b + invitati_a
 
-    base_price = PACKAGE_PRICES_EUR.get(pacchetto, Decimal("0.00"))
+    base_price = prices["packages"].get(pacchetto, Decimal("0.00"))
     totale_pacchetto = base_price * Decimal(tot_persone)
 
     torta_choice = payload.get("torta_choice") or ""
@@ -397,27 +1255,70 @@ def compute_totals(payload: dict) -> dict:
 
     if pacchetto == "Lullyland Experience":
         if torta_choice == "esterna":
-            totale_torta = TORTA_ESTERNASVC_EUR_PER_PERSON * Decimal(tot_persone)
+            totale_torta = prices["torta_esterna_eur_per_person"] * Decimal(tot_persone)
         elif torta_choice == "interna":
             torta_kg = (Decimal(tot_persone) * KG_PER_PERSON).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            totale_torta = TORTA_PRICE_EUR_PER_KG * torta_kg
+            totale_torta = prices["torta_eur_per_kg"] * torta_kg
 
     # All-inclusive: torta inclusa -> nessun costo
     extra_keys = payload.get("extra_keys", [])
     totale_extra = Decimal("0.00")
     if pacchetto == "Lullyland all-inclusive":
         for k in extra_keys:
-            if k in EXTRA_SERVIZI_ALL_INCLUSIVE:
-                totale_extra += EXTRA_SERVIZI_ALL_INCLUSIVE[k][1]
+            if k in prices["extras_all_inclusive"]:
+                totale_extra += prices["extras_all_inclusive"][k][1]
     else:
         for k in extra_keys:
-            if k in EXTRA_SERVIZI:
-                totale_extra += EXTRA_SERVIZI[k][1]
+            if k in prices["extras"]:
+                totale_extra += prices["extras"][k][1]
 
     totale = (totale_pacchetto + totale_torta + totale_extra).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
     return {"totale": totale, "totale_pacchetto": totale_pacchetto, "totale_torta": totale_torta, "totale_extra": totale_extra}
 
+
+def payload_from_row(row) -> dict:
+    """Ricostruisce il payload di booking_new da una riga salvata (per ricalcolare totali e contratto)."""
+    payload = {k: row[k] for k in row.keys()}
+    payload["extra_keys"] = [k for k in (row["extra_keys_csv"] or "").split(",") if k]
+    return payload
+
+
+# Listini: si aggiungono e non si modificano, quindi la cache per worker si rinnova solo
+# quando compare un id nuovo. {sede: (MAX(id), [(id, valid_from, listino)] per valid_from)}
+_PRICE_LISTS = {}
+
+
+def price_lists(conn) -> list:
+    venue = current_venue()
+    max_id = conn.execute("SELECT MAX(id) AS m FROM price_lists").fetchone()["m"]
+    cached = _PRICE_LISTS.get(venue)
+    if not cached or max_id != cached[0]:
+        lists = [
+            (r["id"], r["valid_from"], price_list_from_json(r["data_json"]))
+            for r in conn.execute("SELECT id, valid_from, data_json FROM price_lists ORDER BY valid_from, id")
+        ]
+        cached = _PRICE_LISTS[venue] = (max_id, lists)
+    return cached[1]
+
+
+def price_list_for(conn, event_date: str) -> tuple:
+    """(id, listino) in vigore per la data evento."""
+    current = (None, DEFAULT_PRICE_LIST)
+    for list_id, valid_from, prices in price_lists(conn):
+        if valid_from <= (event_date or ""):
+            current = (list_id, prices)
+    return current
+
+
+def booking_prices(conn, row) -> dict:
+    """Listino con cui è stata prezzata la prenotazione (o quello in vigore per la sua data)."""
+    list_id = row["price_list_id"] if "price_list_id" in row.keys() else None
+    for lid, _, prices in price_lists(conn):
+        if lid == list_id:
+            return prices
+    return price_list_for(conn, row["event_date"])[1]
+
 # -------------------------
 # PDF: contratto scaricabile
 # -------------------------
@@ -552,40 +1453,529 @@ def build_contract_pdf_bytes(row: sqlite3.Row) -> io.BytesIO:
     return buf
 
 # -------------------------
-# Calendario: slot rules
+# PDF: scaletta operativa del giorno
 # -------------------------
-def slots_for_date(d: date):
-    slots = [{"code": "AFTERNOON", "label": "POMERIDIANO/SERALE", "start": "17:00", "end": "20:00"}]
-    if d.weekday() in (5, 6):  # Sat/Sun
-        slots.insert(0, {"code": "MORNING", "label": "MATTINA", "start": "09:30", "end": "12:30"})
-    return slots
+# (titolo, x in mm dal margine, caratteri per riga)
+RUNSHEET_COLUMNS = [
+    ("Orario", 0, 12), ("Area", 24, 4), ("Festeggiato", 34, 24), ("Ospiti", 84, 12),
+    ("Pacchetto", 108, 20), ("Catering baby", 150, 13), ("Torta", 178, 24), ("Extra", 228, 26),
+]
+
+
+def runsheet_torta(row) -> tuple:
+    """(testo, kg) della torta di un evento; i kg come in compute_totals."""
+    if row["torta_choice"] == "esterna":
+        return "Esterna (servizio torta)", Decimal("0.00")
+    if row["torta_choice"] != "interna":
+        return "-", Decimal("0.00")
+    kg = (Decimal(party_size(row)) * KG_PER_PERSON).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    if row["torta_interna_choice"] == "altro":
+        gusto = row["torta_gusto_altro"] or "gusto da definire"
+    elif row["torta_interna_choice"] == "standard":
+        gusto = "standard"
+    else:
+        gusto = "da definire"
+    return f"{eur(kg)} kg - {gusto}", kg
 
 
-def slot_count(conn, event_date: str, slot_code: str) -> int:
-    r = conn.execute("SELECT COUNT(*) AS c FROM bookings WHERE event_date=? AND slot_code=?", (event_date, slot_code)).fetchone()
-    return int(r["c"])
+def runsheet_extras(row) -> str:
+    catalog = EXTRA_SERVIZI_ALL_INCLUSIVE if row["pacchetto"] == "Lullyland all-inclusive" else EXTRA_SERVIZI
+    keys = [k for k in (row["extra_keys_csv"] or "").split(",") if k in catalog]
+    return ", ".join(catalog[k][0] for k in keys) or "-"
 
 
-def next_area(conn, event_date: str, slot_code: str) -> int:
-    n = slot_count(conn, event_date, slot_code)
-    if n == 0:
-        return 1
-    if n == 1:
-        return 2
-    return 3
+def build_day_runsheet_pdf_bytes(day_iso: str, rows: list) -> io.BytesIO:
+    """Scaletta del giorno: una riga per evento (orario, area, ospiti, catering, torta, extra)."""
+    try:
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.pdfgen import canvas as pdf_canvas
+        from reportlab.lib.units import mm
+    except Exception as e:
+        raise RuntimeError("Per generare il PDF serve la libreria 'reportlab'. Installala con: pip install reportlab") from e
 
-# -------------------------
-# Auth
-# -------------------------
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        pin = request.form.get("pin", "")
-        if pin == APP_PIN:
-            session["ok"] = True
-            return redirect(url_for("calendar_month"))
-        return render_template_string(LOGIN_HTML, error="PIN errato.", app_name=APP_NAME)
-    return render_template_string(LOGIN_HTML, error=None, app_name=APP_NAME)
+    def safe(text):
+        return str(text if text is not None else "").encode("latin-1", "replace").decode("latin-1")
+
+    buf = io.BytesIO()
+    c = pdf_canvas.Canvas(buf, pagesize=landscape(A4))
+    w, h = landscape(A4)
+    margin = 12 * mm
+    leading = 11
+    top = h - margin - 34
+
+    # Intestazione e titoli colonna: disegnati una volta come form XObject e riusati su ogni pagina
+    c.beginForm("runsheet_head")
+    c.setFont("Helvetica-Bold", 15)
+    c.drawString(margin, h - margin - 6, safe(f"{APP_NAME} - Scaletta del {day_iso}"))
+    c.setFont("Helvetica-Bold", 9)
+    for title, x, _ in RUNSHEET_COLUMNS:
+        c.drawString(margin + x * mm, h - margin - 26, title)
+    c.line(margin, h - margin - 29, w - margin, h - margin - 29)
+    c.endForm()
+
+    page = 1
+
+    def new_page():
+        c.doForm("runsheet_head")
+        c.setFont("Helvetica", 8)
+        c.drawRightString(w - margin, margin - 12, f"Pagina {page}")
+
+    c.setTitle(f"Scaletta {APP_NAME} {day_iso}")
+    new_page()
+    y = top
+
+    totals = {"ospiti": 0, "kg": Decimal("0.00"), "catering": {}}
+    for r in rows:
+        torta, kg = runsheet_torta(r)
+        guests = party_size(r)
+        catering = CATERING_BABY_OPTIONS.get(r["catering_baby_choice"], "-")
+        totals["ospiti"] += guests
+        totals["kg"] += kg
+        if r["catering_baby_choice"] in CATERING_BABY_OPTIONS:
+            totals["catering"][catering] = totals["catering"].get(catering, 0) + int(r["invitati_bambini"] or 0)
+
+        cells = [
+            f"{r['start_time'] or ''}-{r['end_time'] or ''}",
+            str(r["area"] or "-"),
+            f"{r['nome_festeggiato'] or '-'} ({r['eta_festeggiato'] or '-'} anni)",
+            f"{r['invitati_bambini'] or 0} b / {r['invitati_adulti'] or 0} a",
+            r["pacchetto"] or "-",
+            catering,
+            torta,
+            runsheet_extras(r),
+        ]
+        wrapped = [_wrap_text(safe(text), max_chars) or [""] for text, (_, _, max_chars) in zip(cells, RUNSHEET_COLUMNS)]
+        if r["tema_evento"]:
+            wrapped[2] += _wrap_text(safe(f"Tema: {r['tema_evento']}"), RUNSHEET_COLUMNS[2][2])
+        height = max(len(lines) for lines in wrapped) * leading + 6
+        if y - height < margin + 30:
+            c.showPage()
+            page += 1
+            new_page()
+            y = top
+
+        c.setFont("Helvetica", 9)
+        for lines, (_, x, _) in zip(wrapped, RUNSHEET_COLUMNS):
+            for i, ln in enumerate(lines):
+                c.drawString(margin + x * mm, y - 10 - i * leading, ln)
+        y -= height
+        c.setLineWidth(0.3)
+        c.line(margin, y + 2, w - margin, y + 2)
+
+    c.setFont("Helvetica-Bold", 10)
+    if not rows:
+        c.drawString(margin, y - 14, "Nessun evento in programma.")
+    else:
+        catering_txt = ", ".join(f"{name}: {n}" for name, n in totals["catering"].items()) or "-"
+        c.drawString(
+            margin, y - 14,
+            safe(f"Eventi: {len(rows)}   Ospiti: {totals['ospiti']}   Torta interna: {eur(totals['kg'])} kg   Catering baby: {catering_txt}"),
+        )
+
+    c.showPage()
+    c.save()
+    buf.seek(0)
+    return buf
+
+# -------------------------
+# Calendario: slot rules
+# -------------------------
+# Le regole stanno in tabella (slot_templates, areas, calendar_days). Ogni modifica fa
+# avanzare rules_version (trigger): il calendario slot espanso di ogni worker si ricostruisce
+# solo quando la versione cambia, altrimenti slots_for_date è un lookup in un dict.
+BOOKING_HORIZON_DAYS = int(os.getenv("BOOKING_HORIZON_DAYS", "730"))
+RULES_CHECK_SECONDS = 2.0
+WEEKDAYS_IT = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
+
+
+def parse_weekdays(csv_value: str) -> frozenset:
+    return frozenset(int(x) for x in (csv_value or "").split(",") if x.strip().isdigit() and int(x) < 7)
+
+
+class SlotCalendar:
+    """Slot per data espansi per l'orizzonte di prenotazione (lookup O(1) per data).
+
+    calendar_days: kind 'holiday' = festivo, si applicano gli slot della domenica;
+    kind 'closed' = chiuso tutto il giorno (slot_code '') o solo lo slot indicato.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._built_for = None
+        self._templates = []
+        self._areas = []
+        self._capacities = {}
+        self._days = {}
+        self._by_day = {}
+
+    def _load(self, conn):
+        self._templates = [
+            {
+                "code": r["code"], "label": r["label"], "start": r["start_time"], "end": r["end_time"],
+                "weekdays": parse_weekdays(r["weekdays"]), "active": bool(r["active"]),
+            }
+            for r in conn.execute("SELECT * FROM slot_templates ORDER BY sort_order, start_time")
+        ]
+        rows = conn.execute("SELECT area, is_overflow, capacity FROM areas WHERE active = 1 ORDER BY area").fetchall()
+        self._areas = [(r["area"], bool(r["is_overflow"])) for r in rows]
+        self._capacities = {r["area"]: r["capacity"] for r in rows if r["capacity"]}
+        self._days = {}
+        for r in conn.execute("SELECT day, slot_code, kind FROM calendar_days"):
+            info = self._days.setdefault(r["day"], {"holiday": False, "closed": set()})
+            if r["kind"] == "holiday":
+                info["holiday"] = True
+            elif r["kind"] == "closed":
+                info["closed"].add(r["slot_code"] or "")
+
+    def _expand(self, d: date) -> tuple:
+        info = self._days.get(d.isoformat())
+        weekday = 6 if info and info["holiday"] else d.weekday()
+        closed = info["closed"] if info else ()
+        if "" in closed:
+            return ()
+        return tuple(
+            {"code": t["code"], "label": t["label"], "start": t["start"], "end": t["end"]}
+            for t in self._templates
+            if t["active"] and weekday in t["weekdays"] and t["code"] not in closed
+        )
+
+    def _refresh(self):
+        now = time.monotonic()
+        today = date.today()
+        if self._version is not None and self._built_for == today and now - self._checked_at < RULES_CHECK_SECONDS:
+            return
+        conn = get_db()
+        try:
+            version = conn.execute("SELECT version FROM rules_version WHERE id = 1").fetchone()["version"]
+            if version != self._version or self._built_for != today:
+                self._load(conn)
+                start = today - timedelta(days=31)
+                by_day = {}
+                for i in range(BOOKING_HORIZON_DAYS + 32):
+                    d = start + timedelta(days=i)
+                    by_day[d.toordinal()] = self._expand(d)
+                self._by_day = by_day
+                self._version = version
+                self._built_for = today
+        finally:
+            conn.close()
+        self._checked_at = now
+
+    def slots(self, d: date) -> list:
+        with self._lock:
+            self._refresh()
+            hit = self._by_day.get(d.toordinal())
+            if hit is None:  # fuori orizzonte (es. storico): calcolo al volo
+                hit = self._expand(d)
+        return list(hit)
+
+    def slot_choices(self, include_inactive: bool = False) -> list:
+        with self._lock:
+            self._refresh()
+            return [(t["code"], t["label"]) for t in self._templates if include_inactive or t["active"]]
+
+    def standard_areas(self) -> list:
+        with self._lock:
+            self._refresh()
+            return [a for a, overflow in self._areas if not overflow]
+
+    def overflow_areas(self) -> list:
+        with self._lock:
+            self._refresh()
+            return [a for a, overflow in self._areas if overflow]
+
+    def area_capacities(self) -> dict:
+        with self._lock:
+            self._refresh()
+            return self._capacities
+
+    def day_info(self, d: date):
+        with self._lock:
+            self._refresh()
+            return self._days.get(d.isoformat())
+
+
+SLOT_CALENDAR = PerVenue(SlotCalendar)
+
+
+def slots_for_date(d: date):
+    return SLOT_CALENDAR.slots(d)
+
+
+def slot_capacity() -> int:
+    """Eventi per slot senza conferma (numero di aree non di riserva)."""
+    return len(SLOT_CALENDAR.standard_areas())
+
+
+def slot_count(conn, event_date: str, slot_code: str) -> int:
+    r = conn.execute("SELECT COUNT(*) AS c FROM bookings WHERE event_date=? AND slot_code=?", (event_date, slot_code)).fetchone()
+    return int(r["c"])
+
+
+def party_size(row) -> int:
+    return int(row["invitati_bambini"] or 0) + int(row["invitati_adulti"] or 0)
+
+
+def area_capacity(capacities: dict, area) -> float:
+    return capacities.get(area) or float("inf")
+
+
+def plan_slot_areas(parties: list, standard: list, overflow: list, capacities: dict) -> dict:
+    """Piano aree di uno slot: {booking_id: area}.
+
+    parties: [(booking_id, ospiti, area_attuale)]. Si usano tutte le aree normali e quelle
+    su conferma solo per gli eventi in eccedenza. I gruppi, dal più numeroso, prendono la
+    propria area se ci stanno, altrimenti la più piccola che li contiene (o la più grande
+    rimasta). Aree ed eventi per slot sono al massimo 8: costo costante per slot.
+    """
+    areas = standard + overflow[:max(0, len(parties) - len(standard))]
+    if not areas:
+        return {pid: 1 for pid, _, _ in parties}
+    remaining = list(areas)
+    plan = {}
+    for pid, guests, current in sorted(parties, key=lambda p: (-p[1], p[0] is None, p[0] or 0)):
+        if not remaining:
+            plan[pid] = areas[-1]  # oltre le aree configurate si accoda all'ultima, come prima
+            continue
+        fits = [a for a in remaining if area_capacity(capacities, a) >= guests]
+        if current in fits:
+            area = current
+        elif fits:
+            area = min(fits, key=lambda a: (area_capacity(capacities, a), areas.index(a)))
+        else:
+            area = max(remaining, key=lambda a: (area_capacity(capacities, a), -areas.index(a)))
+        remaining.remove(area)
+        plan[pid] = area
+    return plan
+
+
+def allocate_area(conn, event_date: str, slot_code: str, guests: int, exclude_id: int = None) -> int:
+    """Area per un nuovo evento: l'area libera più piccola che contiene il gruppo.
+
+    Se nessuna area libera basta, ripianifica lo slot spostando gli eventi già presenti
+    (UPDATE nella stessa transazione dell'insert che segue). Ogni spostamento va nel log
+    e nello storico (audit_log), da cui lo mostra la pagina del giorno. exclude_id: la
+    prenotazione che si sta modificando, da non contare tra quelle già presenti.
+    """
+    rows = conn.execute(
+        "SELECT id, area, invitati_bambini, invitati_adulti FROM bookings WHERE event_date=? AND slot_code=? AND id IS NOT ?",
+        (event_date, slot_code, exclude_id),
+    ).fetchall()
+    standard, overflow = SLOT_CALENDAR.standard_areas(), SLOT_CALENDAR.overflow_areas()
+    if not standard and not overflow:
+        return 1
+    capacities = SLOT_CALENDAR.area_capacities()
+    candidates = standard + overflow[:max(0, len(rows) + 1 - len(standard))]
+    taken = {r["area"] for r in rows}
+    free = [a for a in candidates if a not in taken]
+    if not free:
+        return (standard + overflow)[-1]
+
+    fits = [a for a in free if area_capacity(capacities, a) >= guests]
+    if fits:
+        return min(fits, key=lambda a: (area_capacity(capacities, a), candidates.index(a)))
+
+    parties = [(r["id"], party_size(r), r["area"]) for r in rows] + [(None, guests, None)]
+    plan = plan_slot_areas(parties, standard, overflow, capacities)
+    if area_capacity(capacities, plan[None]) < guests:
+        # Non entra comunque: l'area libera più grande, senza spostare nessuno
+        return max(free, key=lambda a: (area_capacity(capacities, a), -candidates.index(a)))
+    for r in rows:
+        if plan[r["id"]] != r["area"]:
+            conn.execute("UPDATE bookings SET area=?, last_actor=? WHERE id=?", (plan[r["id"]], actor_stamp(), r["id"]))
+            app.logger.warning("Area ripianificata: prenotazione #%s del %s %s spostata da Area %s ad Area %s",
+                               r["id"], event_date, slot_code, r["area"], plan[r["id"]])
+    return plan[None]
+
+
+def replan_areas(date_from: str, date_to: str, dry_run: bool = False) -> tuple:
+    """Ripianifica le aree di tutti gli slot nel periodo.
+
+    Ritorna (slot analizzati, spostamenti); ogni spostamento è un dict con id, event_date,
+    slot_code, nome_festeggiato, da (area prima) e a (area dopo).
+    """
+    standard, overflow = SLOT_CALENDAR.standard_areas(), SLOT_CALENDAR.overflow_areas()
+    capacities = SLOT_CALENDAR.area_capacities()
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, event_date, slot_code, area, nome_festeggiato, invitati_bambini, invitati_adulti
+        FROM bookings WHERE event_date BETWEEN ? AND ?
+        ORDER BY event_date, slot_code, id
+        """,
+        (date_from, date_to),
+    ).fetchall()
+    slots = {}
+    for r in rows:
+        slots.setdefault((r["event_date"], r["slot_code"]), []).append(r)
+
+    moves = []
+    for slot_rows in slots.values():
+        plan = plan_slot_areas([(r["id"], party_size(r), r["area"]) for r in slot_rows], standard, overflow, capacities)
+        moves += [
+            {"id": r["id"], "event_date": r["event_date"], "slot_code": r["slot_code"],
+             "nome_festeggiato": r["nome_festeggiato"], "da": r["area"], "a": plan[r["id"]]}
+            for r in slot_rows if plan[r["id"]] != r["area"]
+        ]
+
+    if moves and not dry_run:
+        conn.executemany("UPDATE bookings SET area=?, last_actor=? WHERE id=?", [(m["a"], actor_stamp(), m["id"]) for m in moves])
+        conn.commit()
+    conn.close()
+    return len(slots), moves
+
+
+@app.cli.command("replan-areas")
+@click.option("--season", default=None, type=int, help="Anno da ripianificare (default: anno corrente).")
+@click.option("--include-past", is_flag=True, help="Ripianifica anche gli eventi già passati.")
+@click.option("--dry-run", is_flag=True, help="Mostra solo quanti eventi verrebbero spostati.")
+def replan_areas_command(season, include_past, dry_run):
+    """Riassegna le aree di una stagione in base a ospiti e capienza delle aree."""
+    season = season or date.today().year
+    date_from = f"{season}-01-01"
+    if not include_past:
+        date_from = max(date_from, date.today().isoformat())
+    n_slots, moves = replan_areas(date_from, f"{season}-12-31", dry_run=dry_run)
+    for m in moves:
+        click.echo(f"#{m['id']} {m['event_date']} {m['slot_code']} {m['nome_festeggiato'] or '-'}: "
+                   f"Area {m['da'] or '-'} -> Area {m['a']}")
+    verb = "da spostare" if dry_run else "spostati"
+    click.echo(f"{n_slots} slot analizzati, {len(moves)} eventi {verb}.")
+
+# -------------------------
+# Disponibilità: indice di occupazione (bitmap giorno/slot)
+# -------------------------
+class OccupancyIndex:
+    """Bitmap in memoria delle aree occupate: per ogni slot un bytearray con un byte per giorno.
+
+    Il bit (area - 1) è acceso se l'area è impegnata. L'indice viene caricato una volta
+    per worker e poi aggiornato in modo incrementale: subito dopo gli insert di questo
+    worker (mark) e, prima di ogni ricerca, ricalcolando solo le celle (giorno, slot)
+    toccate dal feed booking_changes dopo l'ultimo seq visto (scritture degli altri worker).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # slot_code -> bytearray dal giorno _base; uno per codice, senza limite al numero di
+        # slot (le regole cambiano nel tempo e i codici vecchi restano nelle prenotazioni)
+        self._bits = {}
+        self._base = None  # ordinal del primo giorno rappresentato
+        self._last_seq = None
+
+    def _cell(self, event_date: str, slot_code: str):
+        """(bytearray dello slot, posizione del giorno), estendendolo se serve; None se non indicizzabile."""
+        if not slot_code:
+            return None
+        try:
+            d = datetime.strptime(event_date or "", "%Y-%m-%d").date()
+        except ValueError:
+            return None
+
+        if self._base is None:
+            self._base = d.toordinal()
+        if d.toordinal() < self._base:
+            shift = self._base - d.toordinal()
+            for bits in self._bits.values():
+                bits[:0] = bytes(shift)
+            self._base = d.toordinal()
+        bits = self._bits.setdefault(slot_code, bytearray())
+        pos = d.toordinal() - self._base
+        if pos >= len(bits):
+            bits.extend(bytes(pos - len(bits) + 1))
+        return bits, pos
+
+    def _set(self, event_date: str, slot_code: str, area):
+        area = int(area or 0)
+        if not 1 <= area <= 8:
+            return
+        cell = self._cell(event_date, slot_code)
+        if cell is not None:
+            bits, pos = cell
+            bits[pos] |= 1 << (area - 1)
+
+    def _recompute(self, conn, event_date: str, slot_code: str):
+        cell = self._cell(event_date, slot_code)
+        if cell is None:
+            return
+        bits, pos = cell
+        bits[pos] = 0
+        for r in conn.execute("SELECT area FROM bookings WHERE event_date=? AND slot_code=?", (event_date, slot_code)):
+            self._set(event_date, slot_code, r["area"])
+
+    def refresh(self, conn):
+        with self._lock:
+            if self._last_seq is None:
+                self._last_seq = booking_change_counter(conn)
+                self._bits = {}
+                self._base = None
+                for r in conn.execute("SELECT event_date, slot_code, area FROM bookings WHERE event_date IS NOT NULL"):
+                    self._set(r["event_date"], r["slot_code"], r["area"])
+                return
+
+            changed = conn.execute(
+                "SELECT seq, event_date, slot_code FROM booking_changes WHERE seq > ? ORDER BY seq",
+                (self._last_seq,),
+            ).fetchall()
+            for ev_date, slot_code in {(r["event_date"], r["slot_code"]) for r in changed}:
+                self._recompute(conn, ev_date, slot_code)
+            if changed:
+                self._last_seq = changed[-1]["seq"]
+
+    def mark(self, event_date: str, slot_code: str, area):
+        # Aggiornamento immediato dopo un insert di questo worker; il feed lo riconfermerà.
+        with self._lock:
+            if self._last_seq is not None:
+                self._set(event_date, slot_code, area)
+
+    def areas_mask(self, d: date, slot_code: str) -> int:
+        bits = self._bits.get(slot_code)
+        if self._base is None or bits is None:
+            return 0
+        pos = d.toordinal() - self._base
+        if pos < 0 or pos >= len(bits):
+            return 0
+        return bits[pos]
+
+    def free_areas(self, d: date, slot_code: str) -> list:
+        mask = self.areas_mask(d, slot_code)
+        return [a for a in SLOT_CALENDAR.standard_areas() if not mask & (1 << (a - 1))]
+
+    def find_free_slots(self, conn, date_from: date, date_to: date, weekdays=None, slot_codes=None,
+                        min_free: int = 1, limit: int = 10) -> list:
+        self.refresh(conn)
+        out = []
+        d = date_from
+        while d <= date_to and len(out) < limit:
+            if not weekdays or d.weekday() in weekdays:
+                for s in slots_for_date(d):
+                    if slot_codes and s["code"] not in slot_codes:
+                        continue
+                    free = self.free_areas(d, s["code"])
+                    if len(free) >= min_free:
+                        out.append({"date": d, "slot": s, "free_areas": free})
+                        if len(out) >= limit:
+                            break
+            d += timedelta(days=1)
+        return out
+
+
+OCCUPANCY = PerVenue(OccupancyIndex)
+
+# -------------------------
+# Auth
+# -------------------------
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        pin = request.form.get("pin", "")
+        if pin == APP_PIN:
+            session["ok"] = True
+            session["device"] = secrets.token_hex(3)  # per lo storico modifiche: stesso PIN, dispositivi diversi
+            return redirect(url_for("calendar_month"))
+        return render_template_string(LOGIN_HTML, error="PIN errato.", app_name=APP_NAME)
+    return render_template_string(LOGIN_HTML, error=None, app_name=APP_NAME)
 
 
 @app.route("/logout")
@@ -622,15 +2012,61 @@ BASE_CSS = """
 </style>
 """
 
+# Patch in place di mese e giorno con gli eventi di /events (vedi booking_events)
+LIVE_JS = """
+<script data-events="%(events_url)s">
+(function() {
+  if (!window.EventSource) return;
+  const es = new EventSource(document.currentScript.dataset.events);
+  es.addEventListener('booking', function(msg) {
+    const ev = JSON.parse(msg.data);
+    const cell = document.querySelector('.cell[data-date="' + ev.date + '"]');
+    if (cell) {
+      const bar = cell.querySelector('.bar');
+      bar.textContent = ev.total + ' eventi';
+      bar.className = 'bar ' + (ev.total === 0 ? 'green' : ev.total === 1 ? 'yellow' : 'red');
+    }
+    const day = document.querySelector('[data-live-date="' + ev.date + '"]');
+    if (day) {
+      fetch(location.href, {credentials: 'same-origin'})
+        .then(r => r.text())
+        .then(html => {
+          const fresh = new DOMParser().parseFromString(html, 'text/html').querySelector('[data-live-date]');
+          if (fresh) day.innerHTML = fresh.innerHTML;
+        });
+    }
+  });
+})();
+</script>
+"""
+
+OFFLINE_SCRIPT_TAG = '<script src="%(root)s/offline.js"></script>'
+
+
+def live_js() -> str:
+    return LIVE_JS % {"events_url": url_for("booking_events")}
+
+
+def offline_script_tag() -> str:
+    return OFFLINE_SCRIPT_TAG % {"root": request.script_root}
+
 def topbar(active="month"):
     return f"""
     <div class="topbar">
       <div class="row">
         <a class="btn {'primary' if active=='month' else ''}" href="{url_for('calendar_month')}">📆 Calendario</a>
         <a class="btn {'primary' if active=='year' else ''}" href="{url_for('calendar_year')}">🗓️ Anno</a>
+        <a class="btn {'primary' if active=='availability' else ''}" href="{url_for('availability')}">🔎 Disponibilità</a>
         <a class="btn" href="{url_for('prenotazioni')}">📋 Prenotazioni</a>
+        <a class="btn {'primary' if active=='planner' else ''}" href="{url_for('produzione')}">🍕 Produzione</a>
+        <a class="btn {'primary' if active=='prices' else ''}" href="{url_for('listini')}">💶 Listini</a>
+        <a class="btn {'primary' if active=='stats' else ''}" href="{url_for('statistiche')}">📊 Statistiche</a>
+        <a class="btn {'primary' if active=='payments' else ''}" href="{url_for('incassi')}">💰 Incassi</a>
+        <a class="btn {'primary' if active=='archive' else ''}" href="{url_for('archivio')}">🗄️ Archivio</a>
+        <a class="btn {'primary' if active=='rules' else ''}" href="{url_for('regole')}">⚙️ Regole</a>
       </div>
       <div class="row">
+        {f'<span class="btn">📍 {xml_escape(current_venue().capitalize())}</span>' if MULTI_VENUE else ''}
         <a class="btn" href="{url_for('logout')}">Esci</a>
       </div>
     </div>
@@ -662,7 +2098,7 @@ def calendar_month():
             c = int(c)
             col = "green" if c == 0 else "yellow" if c == 1 else "red"
             cells_html += f"""
-              <div class="cell">
+              <div class="cell" data-date="{d_iso}">
                 <div class="daynum">{dnum}</div>
                 <div class="bar {col}">{c} eventi</div>
                 <a class="open" href="{url_for('day_view', date_iso=d_iso)}">Apri</a>
@@ -686,10 +2122,13 @@ def calendar_month():
       <a class="btn" href="{url_for('calendar_month', y=prev_y, m=prev_m)}">←</a>
       <a class="btn" href="{url_for('calendar_month', y=next_y, m=next_m)}">→</a>
       <a class="btn" href="{url_for('calendar_month', y=today.year, m=today.month)}">Oggi</a>
+      <a class="btn" href="{url_for('calendar_ics_links')}">📲 Feed iCal</a>
     </div>
   </div>
   <div class="grid">{cells_html}</div>
 </div>
+{live_js()}
+{offline_script_tag()}
 </body></html>
 """
 
@@ -752,21 +2191,45 @@ def day_view(date_iso):
 
     conn = get_db()
     blocks = ""
-    for s in slots_for_date(d):
-        c = slot_count(conn, date_iso, s["code"])
-        rows = conn.execute("""
-          SELECT id, area, nome_festeggiato, eta_festeggiato, invitati_bambini, invitati_adulti,
-                 tema_evento, pacchetto
-          FROM bookings
-          WHERE event_date=? AND slot_code=?
-          ORDER BY area ASC, id ASC
-        """, (date_iso, s["code"])).fetchall()
+    capacity = slot_capacity()
+    area_caps = SLOT_CALENDAR.area_capacities()
+    day_slots = slots_for_date(d)
+    by_slot = {}
+    for r in conn.execute("""
+      SELECT id, slot_code, start_time, end_time, area, nome_festeggiato, eta_festeggiato,
+             invitati_bambini, invitati_adulti, tema_evento, pacchetto
+      FROM bookings
+      WHERE event_date=?
+      ORDER BY start_time ASC, area ASC, id ASC
+    """, (date_iso,)):
+        by_slot.setdefault(r["slot_code"], []).append(r)
+    # Ultimo cambio d'area di ogni prenotazione (ripianificazioni comprese), dallo storico
+    day_ids = [r["id"] for rows in by_slot.values() for r in rows]
+    area_moves = {}
+    if day_ids:
+        for r in conn.execute(
+            f"""
+            SELECT booking_id, changed_at, json_extract(delta, '$.area[0]') AS da, json_extract(delta, '$.area[1]') AS a
+            FROM audit_log
+            WHERE booking_id IN ({','.join('?' * len(day_ids))}) AND op = 'U' AND json_extract(delta, '$.area') IS NOT NULL
+            ORDER BY month, seq
+            """,
+            day_ids,
+        ):
+            area_moves[r["booking_id"]] = r
+    conn.close()
 
+    def events_html(rows) -> str:
         ev_html = ""
         for r in rows:
+            over = party_size(r) > area_capacity(area_caps, r["area"])
+            mv = area_moves.get(r["id"])
+            moved = (f'<div class="muted">🔀 Spostata da Area {mv["da"] or "-"} ad Area {mv["a"]} il '
+                     f'{mv["changed_at"].replace("T", " ")}</div>') if mv and mv["a"] == r["area"] else ""
             ev_html += f"""
               <div class="eventline">
-                <b>Area {r['area'] or '-'}: {r['nome_festeggiato'] or '-'}</b>
+                <b>Area {r['area'] or '-'}: {r['nome_festeggiato'] or '-'}</b>{' <span class="muted">⚠️ oltre capienza area</span>' if over else ''}
+                {moved}
                 <div class="muted">{(r['eta_festeggiato'] or '-')} anni · {(r['invitati_bambini'] or 0)} bimbi / {(r['invitati_adulti'] or 0)} adulti</div>
                 <div class="muted">Tema: {(r['tema_evento'] or '-')} · Pacchetto: {(r['pacchetto'] or '-')}</div>
                 <div class="row" style="margin-top:8px;">
@@ -774,13 +2237,19 @@ def day_view(date_iso):
                 </div>
               </div>
             """
+        return ev_html
+
+    for s in day_slots:
+        rows = sorted(by_slot.pop(s["code"], []), key=lambda r: (r["area"] or 0, r["id"]))
+        c = len(rows)
+        ev_html = events_html(rows)
 
         blocks += f"""
           <div class="slot">
             <div class="slothead">
               <div>
                 <div style="font-weight:900;">{s['start']}–{s['end']} <span class="muted">({s['label']})</span></div>
-                <div class="muted">Prenotazioni nello slot: <b>{c}/2</b></div>
+                <div class="muted">Prenotazioni nello slot: <b>{c}/{capacity}</b></div>
                 {ev_html}
               </div>
               <a class="btn primary" href="{url_for('booking_new')}?date={date_iso}&slot={s['code']}">➕ Aggiungi evento</a>
@@ -788,7 +2257,25 @@ def day_view(date_iso):
           </div>
         """
 
-    conn.close()
+    if not day_slots:
+        blocks = "<p class='muted'>Giorno chiuso: nessuno slot prenotabile.</p>"
+    # Prenotazioni in slot che le regole di oggi non prevedono più (giorno chiuso dopo,
+    # slot disattivato o orari cambiati): restano visibili, con gli orari salvati
+    for code, rows in sorted(by_slot.items(), key=lambda kv: (kv[1][0]["start_time"] or "", kv[0] or "")):
+        blocks += f"""
+          <div class="slot" style="border-color:#e0a800;">
+            <div class="slothead">
+              <div>
+                <div style="font-weight:900;">{rows[0]['start_time'] or '?'}–{rows[0]['end_time'] or '?'} <span class="muted">({code or 'senza slot'})</span></div>
+                <div>⚠️ Slot non previsto dalle regole attuali per questo giorno: ricontrolla o sposta queste prenotazioni.</div>
+                <div class="muted">Prenotazioni nello slot: <b>{len(rows)}</b></div>
+                {events_html(rows)}
+              </div>
+            </div>
+          </div>
+        """
+    info = SLOT_CALENDAR.day_info(d)
+    day_note = " · festivo (orari della domenica)" if info and info["holiday"] else ""
 
     return f"""<!doctype html><html><head>
 <meta name="viewport" content="width=device-width, initial-scale=1">
@@ -796,347 +2283,3943 @@ def day_view(date_iso):
 {BASE_CSS}
 </head><body>
 {topbar('month')}
-<div class="card">
+<div class="card" data-live-date="{date_iso}">
   <div class="head">
     <div>
       <h2 style="margin:0;">{d.strftime('%A %d %B %Y')}</h2>
-      <div class="muted">Seleziona lo slot e aggiungi evento</div>
+      <div class="muted">Seleziona lo slot e aggiungi evento{day_note}</div>
+    </div>
+    <div class="row">
+      <a class="btn" href="{url_for('day_runsheet_pdf', date_iso=date_iso)}">🖨️ Scaletta PDF</a>
+      <a class="btn" href="{url_for('calendar_month', y=d.year, m=d.month)}">← Torna al mese</a>
     </div>
-    <a class="btn" href="{url_for('calendar_month', y=d.year, m=d.month)}">← Torna al mese</a>
   </div>
   {blocks}
 </div>
+{live_js()}
+{offline_script_tag()}
 </body></html>
 """
 
 
-@app.route("/booking/new", methods=["GET", "POST"])
-def booking_new():
+@app.route("/day/<date_iso>/scaletta.pdf")
+def day_runsheet_pdf(date_iso):
     if not is_logged_in():
         return redirect(url_for("login"))
+    try:
+        datetime.strptime(date_iso, "%Y-%m-%d")
+    except ValueError:
+        abort(404)
 
-    event_date = (request.args.get("date") or "").strip()
-    slot_code = (request.args.get("slot") or "").strip().upper()
+    # Una sola query per tutti gli eventi del giorno
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, slot_code, start_time, end_time, area, nome_festeggiato, eta_festeggiato,
+               invitati_bambini, invitati_adulti, pacchetto, tema_evento, catering_baby_choice,
+               torta_choice, torta_interna_choice, torta_gusto_altro, extra_keys_csv
+        FROM bookings
+        WHERE event_date = ?
+        ORDER BY start_time, area, id
+        """,
+        (date_iso,),
+    ).fetchall()
+    conn.close()
 
     try:
-        d = datetime.strptime(event_date, "%Y-%m-%d").date()
-    except Exception:
+        pdf_buf = build_day_runsheet_pdf_bytes(date_iso, rows)
+        return send_attachment(pdf_buf, "application/pdf", f"scaletta_{date_iso}.pdf")
+    except Exception as e:
+        return (
+            f"<h2>Errore generazione PDF</h2><pre>{str(e)}</pre>"
+            "<p>Controlla che sia installato il pacchetto reportlab (vedi requirements.txt).</p>",
+            500,
+        )
+
+
+# -------------------------
+# Doppioni e conflitti
+# -------------------------
+DUPLICATE_WINDOW_DAYS = 60  # stesso bambino e stessa famiglia entro due mesi: quasi sempre un doppio inserimento
+
+
+def find_booking_conflicts(conn, payload: dict, exclude_id: int = None) -> list:
+    """Prenotazioni che somigliano a quella in arrivo, con il motivo; solo lookup su indice.
+
+    - stesso festeggiato nello stesso giorno (qualsiasi famiglia), o entro la finestra se la famiglia coincide
+    - stessa famiglia (telefono) già presente nello stesso giorno con un altro festeggiato
+    """
+    event_date = payload["data_evento"]
+    child = child_key(payload.get("nome_festeggiato"))
+    phones = {normalize_phone(payload.get(k)) for k in ("madre_telefono", "padre_telefono")} - {""}
+    families = {
+        r["customer_id"]
+        for p in phones
+        for r in conn.execute("SELECT customer_id FROM customer_phones WHERE phone_norm = ?", (p,))
+    }
+    d = datetime.strptime(event_date, "%Y-%m-%d").date()
+    lo = (d - timedelta(days=DUPLICATE_WINDOW_DAYS)).isoformat()
+    hi = (d + timedelta(days=DUPLICATE_WINDOW_DAYS)).isoformat()
+    cols = "id, event_date, slot_code, start_time, nome_festeggiato, madre_nome_cognome, padre_nome_cognome, customer_id"
+
+    found = {}
+    if child:
+        for r in conn.execute(f"SELECT {cols} FROM bookings WHERE child_key = ? AND event_date BETWEEN ? AND ?", (child, lo, hi)):
+            if r["customer_id"] in families:
+                found[r["id"]] = (r, "Possibile doppione: stesso festeggiato e stessa famiglia")
+            elif r["event_date"] == event_date:
+                found[r["id"]] = (r, "Stesso nome festeggiato nello stesso giorno")
+    if families:
+        marks = ",".join("?" * len(families))
+        for r in conn.execute(f"SELECT {cols} FROM bookings WHERE customer_id IN ({marks}) AND event_date = ?", (*families, event_date)):
+            found.setdefault(r["id"], (r, "La stessa famiglia ha già una festa in questo giorno"))
+
+    found.pop(exclude_id, None)
+    return [
+        {
+            "id": r["id"],
+            "event_date": r["event_date"],
+            "slot_code": r["slot_code"],
+            "start_time": r["start_time"] or "",
+            "nome_festeggiato": r["nome_festeggiato"] or "",
+            "genitori": " / ".join(n for n in (r["madre_nome_cognome"], r["padre_nome_cognome"]) if n),
+            "reason": reason,
+        }
+        for r, reason in sorted(found.values(), key=lambda x: (x[0]["event_date"], x[0]["id"]))
+    ]
+
+
+@app.route("/clienti/cerca")
+def clienti_cerca():
+    """Suggerimenti famiglia per il form: prefisso di telefono o di nome/cognome di un genitore."""
+    if not is_logged_in():
+        return {"ok": False, "error": "Sessione scaduta: rientra col PIN."}, 401
+
+    q = (request.args.get("q") or "").strip()[:60]
+    conn = get_db()
+    ids = []
+    if q and not any(ch.isalpha() for ch in q):
+        digits = "".join(ch for ch in q if ch.isdigit())
+        if digits.startswith("0039"):
+            digits = digits[4:]
+        elif q.startswith("+39"):
+            digits = digits[2:]
+        if len(digits) >= 3:
+            ids = [r["customer_id"] for r in conn.execute(
+                "SELECT DISTINCT customer_id FROM customer_phones WHERE phone_norm >= ? AND phone_norm < ? LIMIT 50",
+                (digits, digits + ":"),
+            )]
+    else:
+        words = name_key(q).split()
+        if words and len(words[0]) >= 2:
+            ids = [r["customer_id"] for r in conn.execute(
+                "SELECT DISTINCT customer_id FROM customer_names WHERE name_key >= ? AND name_key < ? LIMIT 50",
+                (words[0], words[0] + "\uffff"),
+            )]
+
+    rows = []
+    if ids:
+        marks = ",".join("?" * len(ids))
+        rows = conn.execute(
+            f"SELECT * FROM customers WHERE id IN ({marks}) ORDER BY bookings_count DESC, updated_at DESC", ids
+        ).fetchall()
+        if not any(ch.isdigit() for ch in q):
+            # Più parole ("maria ross"): ognuna deve essere l'inizio di una parola dei nomi
+            words = name_key(q).split()
+            rows = [
+                r for r in rows
+                if all(any(w.startswith(t) for w in name_key(f"{r['madre_nome_cognome']} {r['padre_nome_cognome']}").split())
+                       for t in words)
+            ]
+    conn.close()
+
+    results = []
+    for r in rows[:CUSTOMER_SUGGEST_LIMIT]:
+        names = " / ".join(n for n in (r["madre_nome_cognome"], r["padre_nome_cognome"]) if n) or "-"
+        phone = r["madre_telefono"] or r["padre_telefono"] or ""
+        results.append({
+            "id": r["id"],
+            "label": f"{names} · {phone} · {r['bookings_count']} feste",
+            **{f: r[f] or "" for f in CUSTOMER_FIELDS},
+        })
+    resp = app.response_class(json.dumps({"ok": True, "results": results}), mimetype="application/json")
+    resp.headers["Cache-Control"] = "private, max-age=30"
+    return resp
+
+
+# -------------------------
+# Temi: suggerimenti da indice a prefissi in memoria
+# -------------------------
+THEME_SUGGEST_LIMIT = 8
+THEME_CHECK_SECONDS = 2.0
+
+
+def theme_key(text: str) -> str:
+    """Tema normalizzato: minuscolo, senza accenti, spazi e punteggiatura ("Spider-Man" = "spiderman")."""
+    return "".join(ch for ch in name_key(text) if ch.isalnum())
+
+
+class ThemeIndex:
+    """Trie dei temi normalizzati (per worker), pesati per numero di feste.
+
+    Costruito al primo uso da bookings, poi aggiornato con le sole prenotazioni inserite o
+    modificate lette dal feed booking_changes. Cancellazioni e archiviazione non tolgono peso:
+    un tema già fatto resta un buon suggerimento.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._root = None
+        self._seq = 0
+        self._checked_at = 0.0
+        self._by_booking = {}  # booking_id -> (chiave, testo)
+        self._spellings = {}   # chiave -> {testo digitato: feste}
+
+    def _count(self, key: str, text: str, n: int):
+        spellings = self._spellings.setdefault(key, {})
+        spellings[text] = spellings.get(text, 0) + n
+        if spellings[text] <= 0:
+            del spellings[text]
+        if n > 0:
+            node = self._root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[""] = key  # chiave vuota = fine parola (le chiavi hanno solo caratteri alfanumerici)
+
+    def _set(self, booking_id: int, text: str):
+        text = " ".join((text or "").split())
+        key = theme_key(text)
+        old = self._by_booking.pop(booking_id, None)
+        if old:
+            self._count(old[0], old[1], -1)
+        if key:
+            self._count(key, text, 1)
+            self._by_booking[booking_id] = (key, text)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._root is not None and now - self._checked_at < THEME_CHECK_SECONDS:
+            return
+        conn = get_db()
+        try:
+            seq_now = booking_change_counter(conn)
+            if self._root is None:
+                self._root = {}
+                rows = conn.execute("SELECT id, tema_evento FROM bookings WHERE tema_evento <> ''").fetchall()
+            elif seq_now > self._seq:
+                rows = conn.execute(
+                    """
+                    SELECT id, tema_evento FROM bookings WHERE id IN (
+                        SELECT booking_id FROM booking_changes WHERE seq > ? AND seq <= ? AND op IN ('I', 'U')
+                    )
+                    """,
+                    (self._seq, seq_now),
+                ).fetchall()
+            else:
+                rows = []
+            for r in rows:
+                self._set(r["id"], r["tema_evento"])
+            self._seq = seq_now
+            self._checked_at = now
+        finally:
+            conn.close()
+
+    def note(self, booking_id: int, text: str):
+        """Aggiorna subito dopo un inserimento in questo worker (gli altri lo leggono dal feed)."""
+        with self._lock:
+            if self._root is not None:
+                self._set(booking_id, text)
+
+    def label(self, key: str) -> str:
+        """Grafia più usata per un tema (per raggruppare nei report)."""
+        with self._lock:
+            self._refresh()
+            spellings = self._spellings.get(key)
+            return max(spellings, key=spellings.get) if spellings else ""
+
+    def suggest(self, prefix: str, limit: int = THEME_SUGGEST_LIMIT) -> list:
+        """[(tema, feste)] per i temi che iniziano con il prefisso, i più frequenti prima."""
+        key = theme_key(prefix)
+        if not key:
+            return []
+        with self._lock:
+            self._refresh()
+            node = self._root
+            for ch in key:
+                node = node.get(ch)
+                if node is None:
+                    return []
+            found = []
+            stack = [node]
+            while stack:
+                n = stack.pop()
+                for ch, child in n.items():
+                    if ch == "":
+                        spellings = self._spellings.get(child)
+                        if spellings:
+                            found.append((sum(spellings.values()), max(spellings, key=spellings.get)))
+                    else:
+                        stack.append(child)
+        found.sort(key=lambda x: (-x[0], x[1]))
+        return [(text, n) for n, text in found[:limit]]
+
+
+THEME_INDEX = PerVenue(ThemeIndex)
+
+
+@app.route("/temi/suggerisci")
+def temi_suggerisci():
+    if not is_logged_in():
+        return {"ok": False, "error": "Sessione scaduta: rientra col PIN."}, 401
+    results = [{"tema": t, "feste": n} for t, n in THEME_INDEX.suggest((request.args.get("q") or "")[:60])]
+    resp = app.response_class(json.dumps({"ok": True, "results": results}), mimetype="application/json")
+    resp.headers["Cache-Control"] = "private, max-age=30"
+    return resp
+
+
+@app.route("/disponibilita")
+def availability():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    today = date.today()
+    try:
+        d_from = datetime.strptime(request.args.get("from") or today.isoformat(), "%Y-%m-%d").date()
+        d_to = datetime.strptime(request.args.get("to") or (d_from + timedelta(days=90)).isoformat(), "%Y-%m-%d").date()
+    except ValueError:
         abort(400, "Data non valida.")
+    d_to = min(d_to, d_from + timedelta(days=730))
+
+    weekdays = {int(w) for w in request.args.getlist("wd") if w.isdigit() and int(w) < 7}
+    slot_choices = SLOT_CALENDAR.slot_choices()
+    slot_codes = {s for s in request.args.getlist("slot") if s in dict(slot_choices)}
+    capacity = slot_capacity()
+    min_free = max(1, min(capacity, to_int(request.args.get("free")) or 1))
+    limit = max(1, min(100, to_int(request.args.get("n")) or 10))
+
+    conn = get_db()
+    results = OCCUPANCY.find_free_slots(conn, d_from, d_to, weekdays, slot_codes, min_free, limit)
+    conn.close()
+
+    wd_html = "".join(
+        f"<label><input type='checkbox' name='wd' value='{i}' {'checked' if i in weekdays else ''}> {name[:3]}</label>"
+        for i, name in enumerate(WEEKDAYS_IT)
+    )
+    slot_html = "".join(
+        f"<label><input type='checkbox' name='slot' value='{code}' {'checked' if code in slot_codes else ''}> {label}</label>"
+        for code, label in slot_choices
+    )
+
+    res_html = ""
+    for r in results:
+        d_iso = r["date"].isoformat()
+        s = r["slot"]
+        res_html += f"""
+          <div class="eventline">
+            <b>{WEEKDAYS_IT[r['date'].weekday()]} {r['date'].strftime('%d/%m/%Y')}</b>
+            · {s['start']}–{s['end']} <span class="muted">({s['label']})</span>
+            <div class="muted">Aree libere: {', '.join(str(a) for a in r['free_areas'])}</div>
+            <div class="row" style="margin-top:8px;">
+              <a class="btn primary" href="{url_for('booking_new')}?date={d_iso}&slot={s['code']}">➕ Prenota</a>
+              <a class="btn" href="{url_for('day_view', date_iso=d_iso)}">Apri giorno</a>
+            </div>
+          </div>
+        """
+    if not results:
+        res_html = "<p class='muted'>Nessuno slot libero con questi filtri.</p>"
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Disponibilità</title>
+{BASE_CSS}
+</head><body>
+{topbar('availability')}
+<div class="card">
+  <h2 style="margin:0 0 10px;">Cerca disponibilità</h2>
+  <form method="get" class="row">
+    <label>Dal <input type="date" name="from" value="{d_from.isoformat()}"></label>
+    <label>Al <input type="date" name="to" value="{d_to.isoformat()}"></label>
+    <div class="row">{wd_html}</div>
+    <div class="row">{slot_html}</div>
+    <label>Aree libere min. <input type="number" name="free" min="1" max="{capacity}" value="{min_free}" style="width:60px"></label>
+    <label>Risultati <input type="number" name="n" min="1" max="100" value="{limit}" style="width:60px"></label>
+    <button class="btn primary" type="submit">Cerca</button>
+  </form>
+  {res_html}
+</div>
+</body></html>
+"""
 
-    allowed = {s["code"] for s in slots_for_date(d)}
-    if slot_code not in allowed:
-        abort(400, "Slot non valido per questa data.")
 
-    slot = next(s for s in slots_for_date(d) if s["code"] == slot_code)
+@app.route("/regole", methods=["GET", "POST"])
+def regole():
+    if not is_logged_in():
+        return redirect(url_for("login"))
 
     conn = get_db()
-    is_full = slot_count(conn, event_date, slot_code) >= 2
+    if request.method == "POST":
+        f = request.form
+        action = f.get("action")
+        if action == "slot":
+            code = (f.get("code") or "").strip().upper()
+            label = (f.get("label") or "").strip()
+            start, end = (f.get("start_time") or "").strip(), (f.get("end_time") or "").strip()
+            weekdays = ",".join(str(w) for w in sorted(parse_weekdays(",".join(f.getlist("wd")))))
+            if not code.replace("_", "").isalnum() or not label:
+                conn.close()
+                abort(400, "Codice e nome dello slot sono obbligatori.")
+            try:
+                datetime.strptime(start, "%H:%M")
+                datetime.strptime(end, "%H:%M")
+            except ValueError:
+                conn.close()
+                abort(400, "Orario non valido (HH:MM).")
+            conn.execute(
+                """
+                INSERT INTO slot_templates (code, label, start_time, end_time, weekdays, sort_order, active)
+                VALUES (?,?,?,?,?,?,?)
+                ON CONFLICT(code) DO UPDATE SET
+                  label=excluded.label, start_time=excluded.start_time, end_time=excluded.end_time,
+                  weekdays=excluded.weekdays, sort_order=excluded.sort_order, active=excluded.active
+                """,
+                (code, label, start, end, weekdays, to_int(f.get("sort_order")) or 0, 1 if f.get("active") else 0),
+            )
+        elif action == "area":
+            area = to_int(f.get("area"))
+            if not area or not 1 <= area <= 8:
+                conn.close()
+                abort(400, "Numero area non valido (1-8).")
+            conn.execute(
+                """
+                INSERT INTO areas (area, label, capacity, is_overflow, active) VALUES (?,?,?,?,?)
+                ON CONFLICT(area) DO UPDATE SET
+                  label=excluded.label, capacity=excluded.capacity, is_overflow=excluded.is_overflow, active=excluded.active
+                """,
+                (
+                area, (f.get("label") or f"Area {area}").strip(), to_int(f.get("capacity")),
+                1 if f.get("is_overflow") else 0, 1 if f.get("active") else 0,
+            ),
+            )
+        elif action == "day":
+            try:
+                day = datetime.strptime(f.get("day") or "", "%Y-%m-%d").date().isoformat()
+            except ValueError:
+                conn.close()
+                abort(400, "Data non valida.")
+            kind = f.get("kind")
+            if kind not in ("holiday", "closed"):
+                conn.close()
+                abort(400, "Tipo non valido.")
+            slot_code = "" if kind == "holiday" else (f.get("slot_code") or "").strip().upper()
+            conn.execute(
+                "INSERT OR REPLACE INTO calendar_days (day, slot_code, kind, note) VALUES (?,?,?,?)",
+                (day, slot_code, kind, (f.get("note") or "").strip()),
+            )
+        elif action == "day_delete":
+            conn.execute("DELETE FROM calendar_days WHERE day = ? AND slot_code = ?", (f.get("day"), f.get("slot_code") or ""))
+        else:
+            conn.close()
+            abort(400, "Azione non valida.")
+        conn.commit()
+        conn.close()
+        return redirect(url_for("regole"))
 
-    def render_form(error, form):
-        return render_template_string(
-            BOOKING_HTML,
-            app_name=APP_NAME,
-            error=error,
-            today=datetime.now().strftime("%Y-%m-%d"),
-            form=form,
-            package_labels=PACKAGE_LABELS,
-            dessert_options=DESSERT_OPTIONS,
-            torta_interna_flavors=TORTA_INTERNA_FLAVORS,
-            extra_servizi=EXTRA_SERVIZI,
-            extra_servizi_ai=EXTRA_SERVIZI_ALL_INCLUSIVE,
-            event_date=event_date,
-            slot=slot,
-            is_full=is_full,
+    templates = conn.execute("SELECT * FROM slot_templates ORDER BY sort_order, start_time").fetchall()
+    area_rows = conn.execute("SELECT * FROM areas ORDER BY area").fetchall()
+    days = conn.execute(
+        "SELECT * FROM calendar_days WHERE day >= ? ORDER BY day, slot_code", ((date.today() - timedelta(days=31)).isoformat(),)
+    ).fetchall()
+    conn.close()
+
+    def wd_boxes(selected):
+        return "".join(
+            f"<label><input type='checkbox' name='wd' value='{i}' {'checked' if i in selected else ''}> {name[:3]}</label>"
+            for i, name in enumerate(WEEKDAYS_IT)
         )
 
-    if request.method == "POST":
-        consenso_privacy = 1 if request.form.get("consenso_privacy") else 0
-        consenso_foto = 1 if request.form.get("consenso_foto") else 0
+    def slot_form(t=None):
+        t = t or {"code": "", "label": "", "start_time": "", "end_time": "", "weekdays": "", "sort_order": len(templates), "active": 1}
+        code_input = (
+            f"<input type='hidden' name='code' value='{t['code']}'><b>{t['code']}</b>" if t["code"]
+            else "<input name='code' placeholder='CODICE' style='width:110px'>"
+        )
+        return f"""
+          <form method="post" class="eventline row">
+            <input type="hidden" name="action" value="slot">
+            {code_input}
+            <input name="label" value="{t['label']}" placeholder="Nome" style="width:170px">
+            <input type="time" name="start_time" value="{t['start_time']}"> – <input type="time" name="end_time" value="{t['end_time']}">
+            <div class="row">{wd_boxes(parse_weekdays(t['weekdays']))}</div>
+            <label>Ordine <input type="number" name="sort_order" value="{t['sort_order']}" style="width:50px"></label>
+            <label><input type="checkbox" name="active" {'checked' if t['active'] else ''}> Attivo</label>
+            <button class="btn" type="submit">{'Salva' if t['code'] else '➕ Aggiungi slot'}</button>
+          </form>
+        """
 
-        if consenso_privacy != 1:
-            conn.close()
-            return render_form("Devi accettare l'informativa privacy per continuare.", request.form)
+    def area_form(a=None):
+        a = a or {"area": "", "label": "", "capacity": None, "is_overflow": 0, "active": 1}
+        area_input = (
+            f"<input type='hidden' name='area' value='{a['area']}'><b>#{a['area']}</b>" if a["area"]
+            else "<input type='number' name='area' min='1' max='8' placeholder='N.' style='width:60px'>"
+        )
+        return f"""
+          <form method="post" class="eventline row">
+            <input type="hidden" name="action" value="area">
+            {area_input}
+            <input name="label" value="{a['label'] or ''}" placeholder="Nome" style="width:170px">
+            <label>Ospiti max <input type="number" name="capacity" min="1" value="{a['capacity'] or ''}" style="width:70px"></label>
+            <label><input type="checkbox" name="is_overflow" {'checked' if a['is_overflow'] else ''}> Solo su conferma</label>
+            <label><input type="checkbox" name="active" {'checked' if a['active'] else ''}> Attiva</label>
+            <button class="btn" type="submit">{'Salva' if a['area'] else '➕ Aggiungi area'}</button>
+          </form>
+        """
 
-        firma_png_base64 = (request.form.get("firma_png_base64") or "").strip()
-        data_firma = (request.form.get("data_firma") or "").strip()
+    kinds = {"holiday": "Festivo (orari della domenica)", "closed": "Chiuso"}
+    days_html = "".join(
+        f"""
+          <form method="post" class="eventline row">
+            <input type="hidden" name="action" value="day_delete">
+            <input type="hidden" name="day" value="{r['day']}">
+            <input type="hidden" name="slot_code" value="{r['slot_code']}">
+            <b>{r['day']}</b> · {kinds.get(r['kind'], r['kind'])}{(' · slot ' + r['slot_code']) if r['slot_code'] else ''}
+            <span class="muted">{r['note'] or ''}</span>
+            <button class="btn" type="submit">Rimuovi</button>
+          </form>
+        """
+        for r in days
+    ) or "<p class='muted'>Nessuna eccezione.</p>"
+    slot_options = "<option value=''>Tutto il giorno</option>" + "".join(
+        f"<option value='{t['code']}'>{t['label']}</option>" for t in templates
+    )
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Regole</title>
+{BASE_CSS}
+</head><body>
+{topbar('rules')}
+<div class="card">
+  <h2 style="margin:0 0 10px;">Slot</h2>
+  {''.join(slot_form(t) for t in templates)}
+  {slot_form()}
+</div>
+<div class="card" style="margin-top:12px;">
+  <h2 style="margin:0 0 10px;">Aree</h2>
+  <div class="muted">Le aree normali fanno la capienza dello slot; quelle "solo su conferma" si usano quando sono tutte piene.
+    Gli ospiti max guidano l'assegnazione automatica (gruppi grandi nelle aree grandi); vuoto = senza limite.</div>
+  {''.join(area_form(a) for a in area_rows)}
+  {area_form()}
+</div>
+<div class="card" style="margin-top:12px;">
+  <h2 style="margin:0 0 10px;">Festivi e chiusure</h2>
+  <form method="post" class="row">
+    <input type="hidden" name="action" value="day">
+    <input type="date" name="day" required>
+    <select name="kind"><option value="closed">Chiuso</option><option value="holiday">Festivo</option></select>
+    <select name="slot_code">{slot_options}</select>
+    <input name="note" placeholder="Nota (es. Natale)">
+    <button class="btn primary" type="submit">➕ Aggiungi</button>
+  </form>
+  {days_html}
+</div>
+</body></html>
+"""
+
+
+def booking_payload_from_form(form, event_date: str, prices: dict) -> tuple:
+    """Campi evento dal form (nuova prenotazione o modifica) e primo errore di validazione, o None.
+
+    Firma e consensi restano fuori: si raccolgono solo alla creazione. prices è il listino
+    della prenotazione, per i prezzi citati nei messaggi.
+    """
+    extra_keys = []
+    if (form.get("pacchetto") or "").strip() == "Lullyland all-inclusive":
+        for k in EXTRA_SERVIZI_ALL_INCLUSIVE.keys():
+            if form.get(f"extra_{k}"):
+                extra_keys.append(k)
+    else:
+        for k in EXTRA_SERVIZI.keys():
+            if form.get(f"extra_{k}"):
+                extra_keys.append(k)
+
+    # IMPORTANT: alcuni campi hanno lo stesso name in sezioni diverse (Experience vs All-inclusive).
+    # - lato client: disabilitiamo i campi delle sezioni nascoste (vedi JS)
+    # - lato server: per sicurezza prendiamo l'ULTIMO valore non-vuoto quando arrivano più valori
+    catering_baby_choice = last_nonempty(form.getlist("catering_baby_choice"))
+
+    payload = {
+        "nome_festeggiato": (form.get("nome_festeggiato") or "").strip(),
+        "eta_festeggiato": to_int(form.get("eta_festeggiato")),
+        "data_compleanno": (form.get("data_compleanno") or "").strip(),
+        "data_evento": event_date,
+        "madre_nome_cognome": (form.get("madre_nome_cognome") or "").strip(),
+        "madre_telefono": (form.get("madre_telefono") or "").strip(),
+        "padre_nome_cognome": (form.get("padre_nome_cognome") or "").strip(),
+        "padre_telefono": (form.get("padre_telefono") or "").strip(),
+        "indirizzo_residenza": (form.get("indirizzo_residenza") or "").strip(),
+        "email": (form.get("email") or "").strip(),
+        "invitati_bambini": to_int(form.get("invitati_bambini")),
+        "invitati_adulti": to_int(form.get("invitati_adulti")),
+        "pacchetto": (form.get("pacchetto") or "").strip(),
+        "tema_evento": (form.get("tema_evento") or "").strip(),
+        "note": (form.get("note") or "").strip(),
+        "acconto_eur": (form.get("acconto_eur") or "").strip(),
+        "pacchetto_personalizzato_dettagli": (form.get("pacchetto_personalizzato_dettagli") or "").strip(),
+        "catering_baby_choice": (catering_baby_choice or "").strip(),
+        "dessert_bimbi_choice": (form.get("dessert_bimbi_choice") or "").strip(),
+        "dessert_adulti_choice": (form.get("dessert_adulti_choice") or "").strip(),
+        "torta_choice": (form.get("torta_choice") or "").strip(),
+        "torta_interna_choice": first_nonempty(form.getlist("torta_interna_choice")),
+        "torta_gusto_altro": first_nonempty(form.getlist("torta_gusto_altro")),
+        "extra_keys": extra_keys,
+    }
+
+    if not payload["nome_festeggiato"]:
+        return payload, "Inserisci il nome del festeggiato."
+
+    if payload["pacchetto"] not in PACKAGE_LABELS:
+        return payload, "Seleziona un pacchetto valido."
+
+    if payload["acconto_eur"] and parse_eur_cents(payload["acconto_eur"]) is None:
+        return payload, "Acconto non leggibile: scrivi solo l'importo (es. 50,00)."
+
+    if payload["pacchetto"] == "Personalizzato" and not payload["pacchetto_personalizzato_dettagli"]:
+        return payload, "Hai scelto Personalizzato: inserisci i dettagli."
+
+    if payload["pacchetto"] == "Lullyland Experience":
+        cb = payload["catering_baby_choice"]
+        if cb not in CATERING_BABY_OPTIONS:
+            return payload, "Per Experience scegli Catering baby (Menu pizza o Box merenda)."
+
+        tc = payload["torta_choice"]
+        if tc not in ("esterna", "interna"):
+            return payload, (f"Per Experience scegli torta: Esterna (+EUR {eur(prices['torta_esterna_eur_per_person'])} a persona) "
+                             f"oppure Interna (EUR {eur(prices['torta_eur_per_kg'])}/kg).")
+
+        if tc == "interna":
+            ti = payload["torta_interna_choice"]
+            if ti not in ("standard", "altro"):
+                return payload, "Se hai scelto torta interna, seleziona Classica o Altro."
+            if ti == "altro" and not payload["torta_gusto_altro"]:
+                return payload, "Hai scelto Altro: scrivi il gusto della torta."
+
+    if payload["pacchetto"] == "Lullyland all-inclusive":
+        if payload["dessert_bimbi_choice"] and payload["dessert_bimbi_choice"] not in ("muffin_nutella", "torta_compleanno"):
+            return payload, "All-inclusive: dessert bimbi non valido."
+        if payload["dessert_adulti_choice"] and payload["dessert_adulti_choice"] not in ("muffin_nutella", "torta_compleanno"):
+            return payload, "All-inclusive: dessert adulti non valido."
+
+        need_torta = (payload["dessert_bimbi_choice"] == "torta_compleanno") or (payload["dessert_adulti_choice"] == "torta_compleanno")
+        if need_torta:
+            payload["torta_choice"] = "interna"  # sempre interna e inclusa
+            if payload["torta_interna_choice"] and payload["torta_interna_choice"] not in ("standard", "altro"):
+                return payload, "All-inclusive: scelta torta non valida."
+        else:
+            payload["torta_choice"] = ""
+            payload["torta_interna_choice"] = ""
+            payload["torta_gusto_altro"] = ""
+
+    return payload, None
+
+
+@app.route("/booking/new", methods=["GET", "POST"])
+def booking_new():
+    # Il form (anche quando rinvia invii salvati offline) chiede JSON: niente redirect/HTML da interpretare
+    wants_json = request.method == "POST" and request.accept_mimetypes.best == "application/json"
+
+    if not is_logged_in():
+        if wants_json:
+            return {"ok": False, "error": "Sessione scaduta: rientra col PIN."}, 401
+        return redirect(url_for("login"))
+
+    event_date = (request.args.get("date") or "").strip()
+    slot_code = (request.args.get("slot") or "").strip().upper()
+
+    try:
+        d = datetime.strptime(event_date, "%Y-%m-%d").date()
+    except Exception:
+        abort(400, "Data non valida.")
+
+    slot = next((s for s in slots_for_date(d) if s["code"] == slot_code), None)
+    if slot is None:
+        abort(400, "Slot non valido per questa data.")
+
+    conn = get_db()
+    price_list_id, prices = price_list_for(conn, event_date)
+    standard_areas = SLOT_CALENDAR.standard_areas()
+    overflow_areas = SLOT_CALENDAR.overflow_areas()
+    is_full = slot_count(conn, event_date, slot_code) >= len(standard_areas)
+    areas_label = "Area " + " e ".join(str(a) for a in standard_areas) if standard_areas else "Nessuna area"
+    overflow_label = f"Area {overflow_areas[0]}" if overflow_areas else None
+
+    def render_form(error, form, conflicts=None):
+        if wants_json:
+            return {"ok": False, "error": error, "conflicts": conflicts or []}, 422
+        return render_template_string(
+            BOOKING_HTML,
+            app_name=APP_NAME,
+            error=error,
+            today=datetime.now().strftime("%Y-%m-%d"),
+            form=form,
+            package_labels=package_labels(prices),
+            prices=prices,
+            dessert_options=DESSERT_OPTIONS,
+            torta_interna_flavors=TORTA_INTERNA_FLAVORS,
+            extra_servizi=prices["extras"],
+            extra_servizi_ai=prices["extras_all_inclusive"],
+            event_date=event_date,
+            slot=slot,
+            is_full=is_full,
+            areas_label=areas_label,
+            overflow_label=overflow_label,
+            conflicts=conflicts or [],
+        )
+
+    def saved(booking_id: int, duplicate: bool = False):
+        # Un invio ripetuto ritorna la prenotazione originale
+        target = url_for("prenotazione_dettaglio", booking_id=booking_id) if duplicate else url_for("day_view", date_iso=event_date)
+        if wants_json:
+            return {"ok": True, "booking_id": booking_id, "duplicate": duplicate, "redirect": target}
+        return redirect(target)
+
+    if request.method == "POST":
+        # Stesso invio ripetuto (doppio tap, rinvio della coda offline): nessuna nuova scrittura
+        idempotency_key = (request.form.get("idempotency_key") or "").strip()[:64] or None
+        if idempotency_key:
+            dup = conn.execute("SELECT id FROM bookings WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            if dup:
+                conn.close()
+                return saved(dup["id"], duplicate=True)
+
+        consenso_privacy = 1 if request.form.get("consenso_privacy") else 0
+        consenso_foto = 1 if request.form.get("consenso_foto") else 0
+
+        if consenso_privacy != 1:
+            conn.close()
+            return render_form("Devi accettare l'informativa privacy per continuare.", request.form)
+
+        firma_png_base64 = (request.form.get("firma_png_base64") or "").strip()
+        data_firma = (request.form.get("data_firma") or "").strip()
+
+        if not data_firma:
+            conn.close()
+            return render_form("Inserisci la data firma.", request.form)
+
+        if not firma_png_base64.startswith("data:image/png;base64,"):
+            conn.close()
+            return render_form("Firma mancante: firma nel riquadro prima di salvare.", request.form)
+
+        confirm_area3 = (request.form.get("confirm_area3") == "on")
+        if slot_count(conn, event_date, slot_code) >= len(standard_areas):
+            if not overflow_label:
+                conn.close()
+                return render_form(f"{areas_label}: slot al completo.", request.form)
+            if not confirm_area3:
+                conn.close()
+                return render_form(f"{areas_label} già impegnate. Se vuoi inserire comunque, conferma {overflow_label}.", request.form)
+
+        payload, error = booking_payload_from_form(request.form, event_date, prices)
+        if error:
+            conn.close()
+            return render_form(error, request.form)
+        payload.update({
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "data_firma": data_firma,
+            "firma_png_base64": firma_png_base64,
+            "consenso_privacy": consenso_privacy,
+            "consenso_foto": consenso_foto,
+        })
+
+        conflicts = find_booking_conflicts(conn, payload)
+        if conflicts and request.form.get("confirm_duplicate") != "on":
+            conn.close()
+            return render_form("Attenzione: esistono prenotazioni simili. Controlla e conferma per salvare comunque.", request.form, conflicts)
+
+        totals = compute_totals(payload, prices)
+        contract_text = build_contract_text(payload, prices)
+        area = allocate_area(conn, event_date, slot_code, party_size(payload))
+
+        customer_id = upsert_customer(conn, payload)
+
+        try:
+            cur = conn.execute(
+                """
+                INSERT INTO bookings (
+                    created_at,
+                    nome_festeggiato, eta_festeggiato, data_compleanno, data_evento,
+                    madre_nome_cognome, madre_telefono,
+                    padre_nome_cognome, padre_telefono,
+                    indirizzo_residenza, email,
+                    invitati_bambini, invitati_adulti,
+                    pacchetto, tema_evento, note,
+                    data_firma, firma_png_base64,
+                    consenso_privacy, consenso_foto,
+                    acconto_eur,
+                    pacchetto_personalizzato_dettagli,
+                    catering_baby_choice,
+                    dessert_bimbi_choice,
+                    dessert_adulti_choice,
+                    torta_choice, torta_interna_choice, torta_gusto_altro,
+                    extra_keys_csv,
+                    totale_stimato_eur,
+                    dettagli_contratto_text,
+                    event_date, slot_code, start_time, end_time, area,
+                    idempotency_key, price_list_id, customer_id, child_key, balance_cent, last_actor
+                ) VALUES (
+                    :created_at,
+                    :nome_festeggiato, :eta_festeggiato, :data_compleanno, :data_evento,
+                    :madre_nome_cognome, :madre_telefono,
+                    :padre_nome_cognome, :padre_telefono,
+                    :indirizzo_residenza, :email,
+                    :invitati_bambini, :invitati_adulti,
+                    :pacchetto, :tema_evento, :note,
+                    :data_firma, :firma_png_base64,
+                    :consenso_privacy, :consenso_foto,
+                    :acconto_eur,
+                    :pacchetto_personalizzato_dettagli,
+                    :catering_baby_choice,
+                    :dessert_bimbi_choice,
+                    :dessert_adulti_choice,
+                    :torta_choice, :torta_interna_choice, :torta_gusto_altro,
+                    :extra_keys_csv,
+                    :totale_stimato_eur,
+                    :dettagli_contratto_text,
+                    :event_date, :slot_code, :start_time, :end_time, :area,
+                    :idempotency_key, :price_list_id, :customer_id, :child_key, :balance_cent, :last_actor
+                )
+                """,
+                {
+                    **payload,
+                    "extra_keys_csv": ",".join(payload["extra_keys"]),
+                    "totale_stimato_eur": str(totals["totale"]),
+                    "dettagli_contratto_text": contract_text,
+                    "event_date": event_date,
+                    "slot_code": slot_code,
+                    "start_time": slot["start"],
+                    "end_time": slot["end"],
+                    "area": area,
+                    "idempotency_key": idempotency_key,
+                    "price_list_id": price_list_id,
+                    "customer_id": customer_id,
+                    "child_key": child_key(payload["nome_festeggiato"]),
+                    "balance_cent": int(totals["totale"] * 100),
+                    "last_actor": actor_stamp(),
+                },
+            )
+            acconto_cent = parse_eur_cents(payload["acconto_eur"])
+            if acconto_cent:
+                add_payment(conn, cur.lastrowid, acconto_cent, "", payload["data_firma"], "Acconto alla firma")
+        except sqlite3.IntegrityError:
+            # Invio gemello arrivato in contemporanea: vince il primo, questo ritorna quello
+            conn.rollback()
+            dup = conn.execute("SELECT id FROM bookings WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            conn.close()
+            if not dup:
+                raise
+            return saved(dup["id"], duplicate=True)
+        conn.commit()
+        conn.close()
+        OCCUPANCY.mark(event_date, slot_code, area)
+        THEME_INDEX.note(cur.lastrowid, payload["tema_evento"])
+        return saved(cur.lastrowid)
+
+    conn.close()
+    # Token di idempotenza emesso col GET: ogni invio di questo form (doppio tap, reinvio del
+    # browser, coda offline) porta lo stesso token e il server salva una sola prenotazione.
+    return render_form(None, {"idempotency_key": secrets.token_urlsafe(16)})
+
+# -------------------------
+# Modifica prenotazione
+# -------------------------
+# Derivati e colonne da cui dipendono: alla modifica si ricalcola solo ciò che ha un input cambiato.
+# Occupazione, rollup statistiche e cache delle righe seguono da soli (feed booking_changes e trigger).
+TOTALS_INPUT_COLUMNS = {"pacchetto", "invitati_bambini", "invitati_adulti", "torta_choice", "extra_keys_csv"}
+CONTRACT_INPUT_COLUMNS = TOTALS_INPUT_COLUMNS | {
+    "pacchetto_personalizzato_dettagli", "catering_baby_choice", "dessert_bimbi_choice", "dessert_adulti_choice",
+    "torta_interna_choice", "torta_gusto_altro",
+}
+AREA_INPUT_COLUMNS = {"event_date", "slot_code", "invitati_bambini", "invitati_adulti"}
+CONFLICT_INPUT_COLUMNS = {"event_date", "nome_festeggiato", "madre_telefono", "padre_telefono"}
+# Colonne che non sono stampate nel contratto: cambiarle non invalida il PDF già generato
+CONTRACT_PDF_IGNORED_COLUMNS = {"row_version", "customer_id", "child_key", "idempotency_key", "price_list_id", "last_actor"}
+
+
+def _same_value(a, b) -> bool:
+    return ("" if a is None else str(a)) == ("" if b is None else str(b))
+
+
+def booking_form_values(row) -> dict:
+    """Valori del form di modifica a partire dalla riga salvata."""
+    form = {k: ("" if row[k] is None else str(row[k])) for k in row.keys() if k != "firma_png_base64"}
+    for k in (row["extra_keys_csv"] or "").split(","):
+        if k:
+            form[f"extra_{k}"] = "on"
+    return form
+
+
+@app.route("/prenotazioni/<int:booking_id>/modifica", methods=["GET", "POST"])
+def prenotazione_modifica(booking_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    conn = get_db()
+    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    if not row:
+        conn.close()
+        abort(404)
+    prices = booking_prices(conn, row)
+    standard_areas = SLOT_CALENDAR.standard_areas()
+    overflow_areas = SLOT_CALENDAR.overflow_areas()
+    areas_label = "Area " + " e ".join(str(a) for a in standard_areas) if standard_areas else "Nessuna area"
+    overflow_label = f"Area {overflow_areas[0]}" if overflow_areas else None
+
+    def render_form(error, form, conflicts=None, is_full=False):
+        return render_template_string(
+            BOOKING_HTML,
+            app_name=APP_NAME,
+            error=error,
+            today=datetime.now().strftime("%Y-%m-%d"),
+            form=form,
+            package_labels=package_labels(prices),
+            prices=prices,
+            dessert_options=DESSERT_OPTIONS,
+            torta_interna_flavors=TORTA_INTERNA_FLAVORS,
+            extra_servizi=prices["extras"],
+            extra_servizi_ai=prices["extras_all_inclusive"],
+            event_date=row["event_date"],
+            slot={"code": row["slot_code"], "start": row["start_time"], "end": row["end_time"], "label": row["slot_code"]},
+            is_full=is_full,
+            areas_label=areas_label,
+            overflow_label=overflow_label,
+            conflicts=conflicts or [],
+            edit=True,
+            booking_id=booking_id,
+            acconto=row["acconto_eur"] or "",
+            slot_choices=SLOT_CALENDAR.slot_choices(),
+        )
+
+    if request.method == "GET":
+        conn.close()
+        return render_form(None, booking_form_values(row))
+
+    form = request.form
+    if to_int(form.get("row_version")) != row["row_version"]:
+        conn.close()
+        return render_form("Nel frattempo la prenotazione è stata modificata da un altro dispositivo: riapri la pagina per vedere i dati aggiornati.", form), 409
+
+    event_date = (form.get("event_date") or "").strip()
+    slot_code = (form.get("slot_code") or "").strip().upper()
+    try:
+        d = datetime.strptime(event_date, "%Y-%m-%d").date()
+    except ValueError:
+        conn.close()
+        return render_form("Data evento non valida.", form)
+    slot = next((s for s in slots_for_date(d) if s["code"] == slot_code), None)
+    if slot is None:
+        conn.close()
+        return render_form("Slot non disponibile in questa data.", form)
+
+    payload, error = booking_payload_from_form(form, event_date, prices)
+    if error:
+        conn.close()
+        return render_form(error, form)
+    # L'acconto è la prima riga del registro pagamenti: dopo la creazione non si tocca da qui
+    payload["acconto_eur"] = row["acconto_eur"] or ""
+
+    new = {k: v for k, v in payload.items() if k in row.keys()}
+    new.update({
+        "event_date": event_date,
+        "slot_code": slot_code,
+        "start_time": slot["start"],
+        "end_time": slot["end"],
+        "extra_keys_csv": ",".join(payload["extra_keys"]),
+        "child_key": child_key(payload["nome_festeggiato"]),
+    })
+    changed = {k for k, v in new.items() if not _same_value(v, row[k])}
+    if not changed:
+        conn.close()
+        return redirect(url_for("prenotazione_dettaglio", booking_id=booking_id))
+
+    moved = bool(changed & {"event_date", "slot_code"})
+    if moved and slot_count(conn, event_date, slot_code) >= len(standard_areas):
+        if not overflow_label:
+            conn.close()
+            return render_form(f"{areas_label}: slot al completo.", form)
+        if form.get("confirm_area3") != "on":
+            conn.close()
+            return render_form(f"{areas_label} già impegnate. Se vuoi spostarla comunque, conferma {overflow_label}.", form, is_full=True)
+
+    if changed & CONFLICT_INPUT_COLUMNS:
+        conflicts = find_booking_conflicts(conn, payload, exclude_id=booking_id)
+        if conflicts and form.get("confirm_duplicate") != "on":
+            conn.close()
+            return render_form("Attenzione: esistono prenotazioni simili. Controlla e conferma per salvare comunque.", form, conflicts)
+
+    full = {**payload_from_row(row), **payload}
+    if changed & TOTALS_INPUT_COLUMNS:
+        new["totale_stimato_eur"] = str(compute_totals(full, prices)["totale"])
+    if changed & CONTRACT_INPUT_COLUMNS:
+        new["dettagli_contratto_text"] = build_contract_text(full, prices)
+    if changed & AREA_INPUT_COLUMNS:
+        new["area"] = allocate_area(conn, event_date, slot_code, party_size(new), exclude_id=booking_id)
+    if changed & set(CUSTOMER_FIELDS):
+        customer_id = upsert_customer(conn, payload, new_booking=False)
+        if customer_id != row["customer_id"]:
+            conn.execute("UPDATE customers SET bookings_count = bookings_count + 1 WHERE id = ?", (customer_id,))
+            conn.execute("UPDATE customers SET bookings_count = bookings_count - 1 WHERE id = ?", (row["customer_id"],))
+        new["customer_id"] = customer_id
+
+    cols = [k for k, v in new.items() if not _same_value(v, row[k])]
+    cur = conn.execute(
+        f"UPDATE bookings SET {', '.join(f'{c} = :{c}' for c in cols)}, row_version = row_version + 1, last_actor = :last_actor "
+        "WHERE id = :booking_id AND row_version = :row_version",
+        {**{c: new[c] for c in cols}, "booking_id": booking_id, "row_version": row["row_version"], "last_actor": actor_stamp()},
+    )
+    if cur.rowcount != 1:
+        # Un altro salvataggio è passato tra la lettura e questo UPDATE
+        conn.rollback()
+        conn.close()
+        return render_form("Nel frattempo la prenotazione è stata modificata da un altro dispositivo: riapri la pagina per vedere i dati aggiornati.", form), 409
+    conn.commit()
+    conn.close()
+    if "tema_evento" in changed:
+        THEME_INDEX.note(booking_id, new["tema_evento"])
+    return redirect(url_for("prenotazione_dettaglio", booking_id=booking_id))
+
+
+# -------------------------
+# Pagamenti e saldi
+# -------------------------
+PAYMENT_METHODS = {"contanti": "Contanti", "carta": "Carta / POS", "bonifico": "Bonifico", "satispay": "Satispay"}
+UNPAID_DEFAULT_DAYS = 14
+
+
+def add_payment(conn, booking_id: int, amount_cent: int, method: str = "", paid_at: str = "", note: str = "") -> int:
+    """Registra un pagamento (negativo = rimborso); incassato e saldo li aggiornano i trigger."""
+    now = datetime.now().isoformat(timespec="seconds")
+    return conn.execute(
+        "INSERT INTO payments (booking_id, amount_cent, method, paid_at, note, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (booking_id, amount_cent, method, paid_at or now, note, now),
+    ).lastrowid
+
+
+def cents_label(cents) -> str:
+    return eur(Decimal(int(cents or 0)) / 100)
+
+
+def unpaid_bookings(conn, days: int, today: date = None) -> list:
+    """Eventi da oggi a +days con saldo ancora aperto (indice parziale su balance_cent > 0)."""
+    today = today or date.today()
+    return conn.execute(
+        """
+        SELECT id, event_date, slot_code, start_time, area, nome_festeggiato, madre_nome_cognome, madre_telefono,
+               totale_stimato_eur, paid_cent, balance_cent
+        FROM bookings INDEXED BY idx_bookings_unpaid
+        WHERE balance_cent > 0 AND event_date BETWEEN ? AND ?
+        ORDER BY event_date, slot_code
+        """,
+        (today.isoformat(), (today + timedelta(days=days)).isoformat()),
+    ).fetchall()
+
+
+@app.route("/prenotazioni/<int:booking_id>/pagamenti", methods=["POST"])
+def prenotazione_pagamento(booking_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    amount_cent = parse_eur_cents(request.form.get("importo"))
+    if not amount_cent or amount_cent < 0:
+        abort(400, "Importo non valido.")
+    if request.form.get("tipo") == "rimborso":
+        amount_cent = -amount_cent
+    method = (request.form.get("metodo") or "").strip()
+    if method not in PAYMENT_METHODS:
+        abort(400, "Metodo di pagamento non valido.")
+    paid_at = (request.form.get("data") or "").strip() or date.today().isoformat()
+    try:
+        datetime.strptime(paid_at, "%Y-%m-%d")
+    except ValueError:
+        abort(400, "Data pagamento non valida.")
+
+    conn = get_db()
+    if not conn.execute("SELECT 1 FROM bookings WHERE id = ?", (booking_id,)).fetchone():
+        conn.close()
+        abort(404)
+    add_payment(conn, booking_id, amount_cent, method, paid_at, (request.form.get("note") or "").strip()[:200])
+    conn.commit()
+    conn.close()
+    return redirect(url_for("prenotazione_dettaglio", booking_id=booking_id) + "#pagamenti")
+
+
+@app.route("/incassi")
+def incassi():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    days = max(1, min(to_int(request.args.get("giorni")) or UNPAID_DEFAULT_DAYS, 366))
+    conn = get_db()
+    rows = unpaid_bookings(conn, days)
+    unparsed = unparsed_deposits(conn)
+    conn.close()
+
+    body = "".join(
+        f"<tr><td>{r['event_date']} {r['start_time'] or ''}</td><td>Area {r['area'] or '-'}</td>"
+        f"<td><a href='{url_for('prenotazione_dettaglio', booking_id=r['id'])}#pagamenti'>{xml_escape(r['nome_festeggiato'] or '-')}</a></td>"
+        f"<td>{xml_escape(r['madre_nome_cognome'] or '')} {xml_escape(r['madre_telefono'] or '')}</td>"
+        f"<td>{eur(Decimal(str(r['totale_stimato_eur'] or 0)))}</td><td>{cents_label(r['paid_cent'])}</td>"
+        f"<td><b>{cents_label(r['balance_cent'])}</b></td></tr>"
+        for r in rows
+    ) or "<tr><td colspan='7' class='muted'>Nessun saldo aperto nel periodo.</td></tr>"
+    total = sum(r["balance_cent"] for r in rows)
+    choices = "".join(
+        f"<a class='btn {'primary' if n == days else ''}' href='{url_for('incassi', giorni=n)}'>{n} gg</a>" for n in (7, 14, 30, 90)
+    )
+    unparsed_html = ""
+    if unparsed:
+        unparsed_rows = "".join(
+            f"<tr><td>{r['event_date']}</td>"
+            f"<td><a href='{url_for('prenotazione_dettaglio', booking_id=r['id'])}#pagamenti'>{xml_escape(r['nome_festeggiato'] or '-')}</a></td>"
+            f"<td>{xml_escape(r['acconto_eur'])}</td></tr>"
+            for r in unparsed
+        )
+        unparsed_html = f"""
+<div class="card" style="margin-top:12px;">
+  <h3 style="margin:0;">Acconti da registrare a mano ({len(unparsed)})</h3>
+  <div class="muted">Il campo acconto non contiene solo un importo: leggi la nota e registra il pagamento dalla prenotazione.</div>
+  <table class="stats" style="margin-top:8px;">
+    <tr><th>Evento</th><th>Festeggiato</th><th>Acconto scritto</th></tr>
+    {unparsed_rows}
+  </table>
+</div>"""
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Incassi</title>
+{BASE_CSS}
+<style>
+  .stats{{border-collapse:collapse;background:#fff;font-size:13px;width:100%;}}
+  .stats th,.stats td{{border:1px solid #e5e5e5;padding:6px 8px;text-align:left;white-space:nowrap;}}
+</style>
+</head><body>
+{topbar('payments')}
+<div class="card">
+  <div class="head">
+    <h2 style="margin:0;">Da incassare nei prossimi {days} giorni</h2>
+    <div class="row">{choices}</div>
+  </div>
+  <div style="overflow-x:auto;margin-top:10px;">
+    <table class="stats">
+      <tr><th>Evento</th><th>Area</th><th>Festeggiato</th><th>Contatto</th><th>Totale EUR</th><th>Incassato EUR</th><th>Saldo EUR</th></tr>
+      {body}
+    </table>
+  </div>
+  <div class="muted" style="margin-top:8px;">{len(rows)} eventi · saldo aperto EUR {cents_label(total)}</div>
+</div>
+{unparsed_html}
+</body></html>
+"""
+
+
+@app.route("/prenotazioni")
+def prenotazioni():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+    conn = get_db()
+    rows = conn.execute(
+        """
+        SELECT id, created_at, nome_festeggiato, data_evento, pacchetto,
+               invitati_bambini, invitati_adulti, totale_stimato_eur,
+               event_date, slot_code, area
+        FROM bookings
+        ORDER BY id DESC
+        """
+    ).fetchall()
+    export_columns = [c for c in booking_columns(conn) if c not in EXPORT_EXCLUDED_BY_DEFAULT]
+    conn.close()
+    return render_template_string(LIST_HTML, app_name=APP_NAME, rows=rows, export_columns=export_columns)
+
+AUDIT_OPS = {"I": "Creata", "U": "Modificata", "D": "Eliminata"}
+
+
+def booking_audit(conn, booking_id: int, limit: int = 100) -> list:
+    """Storico di una prenotazione, dal più recente (indice idx_audit_booking)."""
+    rows = conn.execute(
+        """
+        SELECT op, version, changed_at, actor, delta FROM audit_log
+        WHERE booking_id = ? ORDER BY month DESC, seq DESC LIMIT ?
+        """,
+        (booking_id, limit),
+    ).fetchall()
+    return [
+        {
+            "op": AUDIT_OPS.get(r["op"], r["op"]),
+            "version": r["version"],
+            "changed_at": r["changed_at"],
+            "actor": r["actor"] or "fuori dall'app",
+            "changes": sorted(json.loads(r["delta"]).items()) if r["delta"] else [],
+        }
+        for r in rows
+    ]
+
+
+@app.route("/prenotazioni/<int:booking_id>")
+def prenotazione_dettaglio(booking_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    conn = get_db()
+    row = BOOKING_ROWS.get(conn, booking_id)
+    if not row:
+        conn.close()
+        abort(404)
+    prices = booking_prices(conn, row)
+    editable = conn.execute("SELECT 1 FROM bookings WHERE id = ?", (booking_id,)).fetchone() is not None
+    payments = conn.execute(
+        "SELECT amount_cent, method, paid_at, note FROM payments WHERE booking_id = ? ORDER BY paid_at, id", (booking_id,)
+    ).fetchall()
+    audit = booking_audit(conn, booking_id)
+    conn.close()
+
+    invitati_b = int(row["invitati_bambini"] or 0)
+    invitati_a = int(row["invitati_adulti"] or 0)
+    tot_persone = invitati_b + invitati_a
+
+    torta_info = "-"
+    if row["pacchetto"] == "Lullyland Experience":
+        tc = (row["torta_choice"] or "").strip()
+        if tc == "interna":
+            torta_kg = (Decimal(tot_persone) * KG_PER_PERSON).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            torta_info = f"{tot_persone} persone -> ~ {torta_kg} kg (100g a testa) a EUR {eur(prices['torta_eur_per_kg'])}/kg"
+        elif tc == "esterna":
+            svc_price = prices["torta_esterna_eur_per_person"]
+            svc_tot = (svc_price * Decimal(tot_persone)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            torta_info = f"{tot_persone} persone -> Servizio torta: EUR {eur(svc_price)} x {tot_persone} = EUR {eur(svc_tot)}"
+    elif row["pacchetto"] == "Lullyland all-inclusive":
+        need_torta = (row["dessert_bimbi_choice"] == "torta_compleanno") or (row["dessert_adulti_choice"] == "torta_compleanno")
+        if need_torta:
+            ti = (row["torta_interna_choice"] or "").strip()
+            if ti == "standard":
+                torta_info = f"Torta interna (inclusa) - {TORTA_INTERNA_FLAVORS['standard']}"
+            elif ti == "altro":
+                gust = (row["torta_gusto_altro"] or "").strip() or "(da compilare)"
+                torta_info = f"Torta interna (inclusa) - Gusto: {gust}"
+            else:
+                torta_info = "Torta interna (inclusa) - (da definire)"
+        else:
+            torta_info = "-"
+
+    return render_template_string(
+        DETAIL_HTML, app_name=APP_NAME, b=row, torta_info=torta_info, editable=editable,
+        payments=payments, payment_methods=PAYMENT_METHODS, cents_label=cents_label, today=date.today().isoformat(),
+        audit=audit,
+    )
+
+def contract_pdf_fingerprint(row) -> str:
+    """Impronta dei campi che finiscono nel PDF del contratto."""
+    h = hashlib.sha1()
+    for k in row.keys():
+        if k not in CONTRACT_PDF_IGNORED_COLUMNS:
+            h.update(f"{k}={row[k]}\x1f".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+@app.route("/prenotazioni/<int:booking_id>/contratto.pdf")
+def prenotazione_contratto_pdf(booking_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    conn = get_db()
+    row = BOOKING_ROWS.get(conn, booking_id)
+    if not row:
+        conn.close()
+        abort(404)
+
+    if jobs_worker_alive(conn):
+        # Il PDF lo genera il worker: qui si accoda e basta. La chiave è l'impronta dei campi
+        # stampati, così un PDF già pronto resta valido finché non cambia qualcosa che contiene.
+        job_id = enqueue_job(conn, "contract_pdf", {"booking_id": booking_id},
+                             dedupe_key=f"contract_pdf:{booking_id}:{contract_pdf_fingerprint(row)}")
+        job = conn.execute("SELECT status, result_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        if job["status"] == "done" and job["result_path"]:
+            return redirect(url_for("job_download", job_id=job_id))
+        return redirect(url_for("job_status", job_id=job_id))
+    conn.close()
+
+    try:
+        pdf_buf = build_contract_pdf_bytes(row)
+        return send_attachment(pdf_buf, "application/pdf", f"contratto_prenotazione_{booking_id}.pdf")
+    except Exception as e:
+        return (
+            f"<h2>Errore generazione PDF</h2><pre>{str(e)}</pre>"
+            "<p>Controlla che siano installati i pacchetti: reportlab e Pillow (vedi requirements.txt).</p>",
+            500,
+        )
+
+# -------------------------
+# Export prenotazioni (CSV / XLSX in streaming)
+# -------------------------
+EXPORT_FETCH_SIZE = 500
+
+# La firma è un PNG in base64 (decine di KB per riga): esclusa se non richiesta esplicitamente
+EXPORT_EXCLUDED_BY_DEFAULT = {"firma_png_base64", "last_actor"}
+
+# Colonne TEXT che contengono importi "123.45": in XLSX le scriviamo come numeri
+EXPORT_NUMERIC_TEXT_COLUMNS = {"totale_stimato_eur"}
+
+
+def booking_columns(conn) -> list:
+    return [r["name"] for r in conn.execute("PRAGMA table_info(bookings)").fetchall()]
+
+
+def export_params():
+    """Legge e valida da request.args: intervallo date, colonne, separatore."""
+    date_from = (request.args.get("from") or "").strip()
+    date_to = (request.args.get("to") or "").strip()
+    for v in (date_from, date_to):
+        if v:
+            try:
+                datetime.strptime(v, "%Y-%m-%d")
+            except ValueError:
+                abort(400, "Data non valida (formato YYYY-MM-DD).")
+
+    conn = get_db()
+    all_cols = booking_columns(conn)
+    conn.close()
+
+    requested = [c.strip() for c in request.args.getlist("col") if c.strip()]
+    if not requested and request.args.get("cols"):
+        requested = [c.strip() for c in request.args["cols"].split(",") if c.strip()]
+
+    if requested:
+        unknown = [c for c in requested if c not in all_cols]
+        if unknown:
+            abort(400, f"Colonne non valide: {', '.join(unknown)}")
+        cols = requested
+    else:
+        cols = [c for c in all_cols if c not in EXPORT_EXCLUDED_BY_DEFAULT]
+
+    if request.args.get("firma") == "1" and "firma_png_base64" not in cols:
+        cols.append("firma_png_base64")
+
+    sep = request.args.get("sep", ";")
+    if sep not in (";", ","):
+        abort(400, "Separatore non valido.")
+
+    return date_from, date_to, cols, sep
+
+
+def iter_booking_batches(cols, date_from="", date_to=""):
+    """Scorre le prenotazioni con un cursore e fetchmany: in memoria c'è un solo batch per volta."""
+    where, params = [], []
+    if date_from:
+        where.append("event_date >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("event_date <= ?")
+        params.append(date_to)
+    sql = f"SELECT {', '.join(cols)} FROM bookings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY event_date, slot_code, area, id"
+
+    conn = get_db()
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def generate_bookings_csv(cols, date_from="", date_to="", sep=";"):
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=sep)
+    # BOM: Excel riconosce l'UTF-8 (accenti nei nomi)
+    buf.write("\ufeff")
+    writer.writerow(cols)
+    for rows in iter_booking_batches(cols, date_from, date_to):
+        for r in rows:
+            writer.writerow(["" if v is None else v for v in r])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """File-like non seekable: accumula i byte scritti dallo zip finché il generatore non li consuma."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class XlsxStreamWriter:
+    """Writer XLSX minimale a memoria costante.
+
+    Un solo foglio, scritto riga per riga in uno zip in streaming, con stringhe inline
+    (niente sharedStrings, che richiederebbe di tenere tutte le stringhe in memoria).
+    """
+
+    _CONTENT_TYPES = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    )
+    _RELS = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    )
+    _WORKBOOK_RELS = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    )
+
+    def __init__(self, fileobj, sheet_name="Foglio1"):
+        self._zip = zipfile.ZipFile(fileobj, mode="w", compression=zipfile.ZIP_DEFLATED)
+        self._zip.writestr("[Content_Types].xml", self._CONTENT_TYPES)
+        self._zip.writestr("_rels/.rels", self._RELS)
+        self._zip.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{xml_escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        )
+        self._zip.writestr("xl/_rels/workbook.xml.rels", self._WORKBOOK_RELS)
+        self._sheet = self._zip.open("xl/worksheets/sheet1.xml", mode="w", force_zip64=True)
+        self._sheet.write(
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        )
+
+    @staticmethod
+    def _cell(v) -> str:
+        if v is None or v == "":
+            return "<c/>"
+        if isinstance(v, bool):
+            v = int(v)
+        if isinstance(v, (int, float, Decimal)):
+            return f'<c t="n"><v>{v}</v></c>'
+        s = "".join(ch for ch in str(v) if ch in "\t\n\r" or ord(ch) >= 0x20)
+        return f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(s)}</t></is></c>'
+
+    def write_row(self, values):
+        self._sheet.write(("<row>" + "".join(self._cell(v) for v in values) + "</row>").encode("utf-8"))
+
+    def close(self):
+        self._sheet.write(b"</sheetData></worksheet>")
+        self._sheet.close()
+        self._zip.close()
+
+
+def generate_bookings_xlsx(cols, date_from="", date_to=""):
+    sink = _ChunkSink()
+    xl = XlsxStreamWriter(sink, sheet_name="Prenotazioni")
+    xl.write_row(cols)
+    numeric_idx = [i for i, c in enumerate(cols) if c in EXPORT_NUMERIC_TEXT_COLUMNS]
+    for rows in iter_booking_batches(cols, date_from, date_to):
+        for r in rows:
+            values = list(r)
+            for i in numeric_idx:
+                try:
+                    values[i] = Decimal(str(values[i]))
+                except Exception:
+                    pass
+            xl.write_row(values)
+        yield sink.drain()
+    xl.close()
+    yield sink.drain()
+
+
+def export_filename(ext: str, date_from: str, date_to: str) -> str:
+    parts = ["prenotazioni"]
+    if date_from:
+        parts.append(f"dal_{date_from}")
+    if date_to:
+        parts.append(f"al_{date_to}")
+    return "_".join(parts) + f".{ext}"
+
+
+@app.route("/export/prenotazioni.csv")
+def export_bookings_csv():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    date_from, date_to, cols, sep = export_params()
+    return Response(
+        stream_with_context(generate_bookings_csv(cols, date_from, date_to, sep)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename("csv", date_from, date_to)}"'},
+    )
+
+
+@app.route("/export/prenotazioni.xlsx")
+def export_bookings_xlsx():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    date_from, date_to, cols, _sep = export_params()
+    return Response(
+        stream_with_context(generate_bookings_xlsx(cols, date_from, date_to)),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename("xlsx", date_from, date_to)}"'},
+    )
+
+# -------------------------
+# Import prenotazioni da CSV (migrazione dal foglio di calcolo)
+# -------------------------
+# Stesse colonne dell'export (un export si reimporta così com'è); "data_evento" vale come
+# "event_date" ed "extra_keys_csv" elenca gli extra separati da virgola. Ogni riga passa dalle
+# regole di booking_new (slot aperto, capienza, doppioni); solo firma e consensi non si
+# chiedono. Le conferme del form sono colonne: confirm_area3 e confirm_duplicate ("si").
+# Le valide vanno in executemany a blocchi, un commit per blocco.
+IMPORT_BATCH_ROWS = 500
+IMPORT_MAX_REPORTED_ERRORS = 1000
+IMPORT_TRUE_VALUES = {"1", "si", "sì", "s", "x", "on", "true", "yes"}
+
+IMPORT_INSERT_COLUMNS = (
+    "created_at", "nome_festeggiato", "eta_festeggiato", "data_compleanno", "data_evento",
+    "madre_nome_cognome", "madre_telefono", "padre_nome_cognome", "padre_telefono", "indirizzo_residenza", "email",
+    "invitati_bambini", "invitati_adulti", "pacchetto", "tema_evento", "note",
+    "data_firma", "firma_png_base64", "consenso_privacy", "consenso_foto", "acconto_eur",
+    "pacchetto_personalizzato_dettagli", "catering_baby_choice", "dessert_bimbi_choice", "dessert_adulti_choice",
+    "torta_choice", "torta_interna_choice", "torta_gusto_altro", "extra_keys_csv",
+    "totale_stimato_eur", "dettagli_contratto_text",
+    "event_date", "slot_code", "start_time", "end_time", "area",
+    "idempotency_key", "price_list_id", "customer_id", "child_key", "balance_cent", "last_actor",
+)
+
+
+def detect_csv_separator(header_line: str) -> str:
+    return max((";", ",", "\t"), key=header_line.count)
+
+
+@contextmanager
+def scratch_db_copy():
+    """Copia usa e getta del DB della sede (VACUUM INTO): la prova d'import scrive lì e il DB vero resta libero."""
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="import-prova-")
+    os.close(fd)
+    os.remove(path)  # VACUUM INTO vuole un file che non esiste
+    src = get_db()
+    try:
+        src.execute("VACUUM INTO ?", (path,))
+    finally:
+        src.close()
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def import_bookings_csv(lines, sep: str = None, conn=None) -> dict:
+    """Importa prenotazioni da righe CSV (file di testo o iterabile, letto in streaming).
+
+    Ritorna {"read", "imported", "skipped", "errors": [(riga, messaggio)]}. Le righe già
+    presenti (stessa idempotency_key o stesso id dell'export, altrimenti stessa chiave
+    calcolata dal contenuto) vengono saltate: rilanciare lo stesso file non crea doppioni.
+    Con conn scrive lì (per la prova: una copia usa e getta, vedi scratch_db_copy).
+    """
+    lines = iter(lines)
+    header = next(lines, "")
+    sep = sep or detect_csv_separator(header)
+    reader = csv.DictReader(itertools.chain([header], lines), delimiter=sep)
+    fields = {(f or "").strip().lstrip("\ufeff") for f in (reader.fieldnames or [])}
+    if "nome_festeggiato" not in fields or not fields & {"event_date", "data_evento"} or "slot_code" not in fields:
+        raise ValueError("Intestazione CSV: servono almeno le colonne nome_festeggiato, event_date (o data_evento), slot_code.")
+
+    insert_sql = (
+        f"INSERT INTO bookings ({', '.join(IMPORT_INSERT_COLUMNS)}) "
+        f"VALUES ({', '.join(':' + c for c in IMPORT_INSERT_COLUMNS)})"
+    )
+    result = {"read": 0, "imported": 0, "skipped": 0, "errors": []}
+    batch, batch_slots, batch_children, batch_phones, seen = [], set(), set(), set(), set()
+    now = datetime.now().isoformat(timespec="seconds")
+    own_conn = conn is None
+    conn = conn or get_db()
+
+    def error(line: int, message: str):
+        if len(result["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+            result["errors"].append((line, message))
+
+    def flush():
+        if not batch:
+            return
+        conn.executemany(insert_sql, batch)
+        # Acconti nel registro pagamenti: l'id della prenotazione si ritrova dalla chiave di import
+        conn.executemany(
+            """
+            INSERT INTO payments (booking_id, amount_cent, paid_at, note, created_at)
+            SELECT id, ?, ?, 'Acconto alla firma', ? FROM bookings WHERE idempotency_key = ?
+            """,
+            [(b["_acconto_cent"], b["data_firma"] or b["created_at"], now, b["idempotency_key"]) for b in batch if b["_acconto_cent"]],
+        )
+        conn.commit()
+        result["imported"] += len(batch)
+        batch.clear()
+        batch_slots.clear()
+        batch_children.clear()
+        batch_phones.clear()
+
+    try:
+        for rec in reader:
+            result["read"] += 1
+            line = reader.line_num
+            rec = {(k or "").strip().lstrip("\ufeff"): (v or "").strip() for k, v in rec.items() if k}
+
+            event_date = rec.get("event_date") or rec.get("data_evento") or ""
+            try:
+                d = datetime.strptime(event_date, "%Y-%m-%d").date()
+            except ValueError:
+                error(line, f"Data evento non valida: '{event_date}' (formato AAAA-MM-GG).")
+                continue
+            slot_code = rec.get("slot_code", "").upper()
+            slot = next((s for s in slots_for_date(d) if s["code"] == slot_code), None)
+            if slot is None:
+                error(line, f"Slot '{slot_code}' non disponibile il {event_date} (giorno chiuso, slot disattivato o sconosciuto).")
+                continue
+
+            form = MultiDict(rec)
+            for k in rec.get("extra_keys_csv", "").split(","):
+                if k.strip():
+                    form.add(f"extra_{k.strip()}", "on")
+            price_list_id, prices = price_list_for(conn, event_date)
+            payload, message = booking_payload_from_form(form, event_date, prices)
+            if message:
+                error(line, message)
+                continue
+
+            # Chiave della riga: quella dell'export se c'è, altrimenti dai soli campi del form
+            # (colonne calcolate, id e date di servizio cambiano da un export all'altro)
+            key = rec.get("idempotency_key", "")[:64] or "import:" + hashlib.sha1(
+                json.dumps([event_date, slot_code, sorted(payload.items())], ensure_ascii=False, default=str).encode("utf-8")
+            ).hexdigest()[:24]
+            if (
+                key in seen
+                or conn.execute("SELECT 1 FROM bookings WHERE idempotency_key = ?", (key,)).fetchone()
+                or (to_int(rec.get("id")) and conn.execute(
+                    "SELECT 1 FROM bookings WHERE id = ? AND event_date = ? AND child_key IS ?",
+                    (to_int(rec.get("id")), event_date, child_key(payload["nome_festeggiato"])),
+                ).fetchone())
+            ):
+                result["skipped"] += 1
+                continue
+            seen.add(key)
+
+            # Capienza, aree e doppioni si leggono dal DB: se la riga tocca lo slot, il festeggiato
+            # o la famiglia di una riga del blocco in attesa, prima si scrive il blocco
+            ckey = child_key(payload["nome_festeggiato"])
+            phones = {normalize_phone(payload.get(k)) for k in ("madre_telefono", "padre_telefono")} - {""}
+            if (event_date, slot_code) in batch_slots or ckey in batch_children or phones & batch_phones:
+                flush()
+
+            booked = slot_count(conn, event_date, slot_code)
+            standard, overflow = SLOT_CALENDAR.standard_areas(), SLOT_CALENDAR.overflow_areas()
+            if booked >= len(standard) + len(overflow):
+                error(line, f"Slot {slot_code} del {event_date} al completo.")
+                continue
+            if booked >= len(standard) and rec.get("confirm_area3", "").lower() not in IMPORT_TRUE_VALUES:
+                error(line, f"Slot {slot_code} del {event_date}: aree standard già impegnate. "
+                            f"Per usare l'Area {overflow[0]} metti 'si' nella colonna confirm_area3.")
+                continue
+            conflicts = find_booking_conflicts(conn, payload)
+            if conflicts and rec.get("confirm_duplicate", "").lower() not in IMPORT_TRUE_VALUES:
+                c = conflicts[0]
+                error(line, f"{c['reason']}: #{c['id']} del {c['event_date']} ({c['nome_festeggiato']}). "
+                            f"Se è corretto metti 'si' nella colonna confirm_duplicate.")
+                continue
+            totals = compute_totals(payload, prices)
+            payload.update({
+                "created_at": rec.get("created_at") or now,
+                "data_firma": rec.get("data_firma", ""),
+                "firma_png_base64": rec.get("firma_png_base64", ""),
+                "consenso_privacy": 1 if rec.get("consenso_privacy", "").lower() in IMPORT_TRUE_VALUES else 0,
+                "consenso_foto": 1 if rec.get("consenso_foto", "").lower() in IMPORT_TRUE_VALUES else 0,
+            })
+            batch.append({
+                **payload,
+                "extra_keys_csv": ",".join(payload["extra_keys"]),
+                "totale_stimato_eur": str(totals["totale"]),
+                "dettagli_contratto_text": build_contract_text(payload, prices),
+                "event_date": event_date,
+                "slot_code": slot_code,
+                "start_time": rec.get("start_time") or slot["start"],
+                "end_time": rec.get("end_time") or slot["end"],
+                "area": allocate_area(conn, event_date, slot_code, party_size(payload)),
+                "idempotency_key": key,
+                "price_list_id": price_list_id,
+                "customer_id": upsert_customer(conn, payload),
+                "child_key": ckey,
+                "balance_cent": int(totals["totale"] * 100),
+                "last_actor": actor_stamp(),
+                "_acconto_cent": parse_eur_cents(payload["acconto_eur"]),
+            })
+            batch_slots.add((event_date, slot_code))
+            batch_children.add(ckey)
+            batch_phones.update(phones)
+
+            if len(batch) >= IMPORT_BATCH_ROWS:
+                flush()
+        flush()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if own_conn:
+            conn.close()
+    return result
+
+
+def import_report_lines(result: dict) -> list:
+    lines = [f"riga {line}: {message}" for line, message in result["errors"]]
+    if len(result["errors"]) >= IMPORT_MAX_REPORTED_ERRORS:
+        lines.append(f"(mostrati solo i primi {IMPORT_MAX_REPORTED_ERRORS} errori)")
+    return lines
+
+
+@app.cli.command("import-bookings")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--sep", default=None, help="Separatore (default: rilevato dall'intestazione).")
+@click.option("--dry-run", is_flag=True, help="Valida e calcola senza salvare.")
+@click.option("--report", "report_path", default=None, type=click.Path(dir_okay=False), help="Scrive gli errori per riga in un CSV.")
+def import_bookings_command(csv_path, sep, dry_run, report_path):
+    """Importa prenotazioni da CSV (stesse colonne dell'export)."""
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        try:
+            if dry_run:
+                with scratch_db_copy() as scratch:
+                    result = import_bookings_csv(f, sep=sep, conn=scratch)
+            else:
+                result = import_bookings_csv(f, sep=sep)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    for line in import_report_lines(result):
+        click.echo(line)
+    if report_path:
+        with open(report_path, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f, delimiter=";")
+            w.writerow(["riga", "errore"])
+            w.writerows(result["errors"])
+    click.echo(
+        f"Righe lette: {result['read']} · {'da importare' if dry_run else 'importate'}: {result['imported']} · "
+        f"già presenti: {result['skipped']} · con errori: {result['read'] - result['imported'] - result['skipped']}"
+    )
+
+
+@app.route("/import", methods=["GET", "POST"])
+def import_prenotazioni():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    summary = ""
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            abort(400, "Seleziona un file CSV.")
+        dry_run = bool(request.form.get("dry_run"))
+        conn = get_db()
+        if jobs_worker_alive(conn):
+            # Il file va su disco e l'import lo fa il worker: niente lock di scrittura tenuto dalla richiesta.
+            os.makedirs(jobs_dir(), exist_ok=True)
+            fd, path = tempfile.mkstemp(suffix=".csv", prefix="import-", dir=jobs_dir())
+            with os.fdopen(fd, "wb") as f:
+                upload.save(f)
+            params = {"path": os.path.abspath(path), "filename": upload.filename, "dry_run": dry_run}
+            job_id = enqueue_job(conn, "import_bookings", params, max_attempts=1)
+            conn.close()
+            return redirect(url_for("job_status", job_id=job_id))
+        conn.close()
+
+        # Nessun worker: import qui, a blocchi di IMPORT_BATCH_ROWS righe con un commit per blocco
+        # (il lock di scrittura si libera tra un blocco e l'altro)
+        lines = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+        try:
+            if dry_run:
+                with scratch_db_copy() as scratch:
+                    result = import_bookings_csv(lines, conn=scratch)
+            else:
+                result = import_bookings_csv(lines)
+        except (ValueError, UnicodeDecodeError) as e:
+            abort(400, f"File non importabile: {e}")
+        errors = "".join(f"<tr><td>{xml_escape(line)}</td></tr>" for line in import_report_lines(result))
+        n_err = result["read"] - result["imported"] - result["skipped"]
+        summary = f"""
+<div class="card" style="margin-top:12px;">
+  <h3 style="margin:0 0 8px;">{'Prova (nessun dato salvato)' if dry_run else 'Import completato'}: {xml_escape(upload.filename)}</h3>
+  <div>Righe lette: <b>{result['read']}</b> · {'da importare' if dry_run else 'importate'}: <b>{result['imported']}</b>
+   · già presenti: <b>{result['skipped']}</b> · con errori: <b>{n_err}</b></div>
+  {f"<table class='stats' style='margin-top:10px;'><tr><th>Errore</th></tr>{errors}</table>" if errors else ""}
+</div>"""
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Import CSV</title>
+{BASE_CSS}
+<style>
+  .stats{{border-collapse:collapse;background:#fff;font-size:13px;}}
+  .stats th,.stats td{{border:1px solid #e5e5e5;padding:6px 8px;text-align:left;}}
+</style>
+</head><body>
+{topbar('list')}
+<div class="card">
+  <h2 style="margin:0;">Importa prenotazioni da CSV</h2>
+  <div class="muted">Stesse colonne dell'export (separatore ; o ,). Obbligatorie: nome_festeggiato, event_date (AAAA-MM-GG), slot_code,
+  pacchetto e i campi richiesti dal pacchetto. Le righe già importate vengono saltate.
+  Con il worker dei lavori attivo l'import gira in coda e a fine lavoro si scarica il resoconto con gli errori per riga.</div>
+  <form method="post" enctype="multipart/form-data" class="row" style="margin-top:10px;">
+    <input type="file" name="file" accept=".csv,text/csv" required>
+    <label><input type="checkbox" name="dry_run" value="1" checked> Solo prova</label>
+    <button class="btn primary" type="submit">Importa</button>
+  </form>
+</div>
+{summary}
+</body></html>
+"""
+
+# -------------------------
+# Feed iCalendar (.ics) per i calendari dei telefoni
+# -------------------------
+# I calendari dei telefoni non fanno login col PIN: il feed si autentica con un token nell'URL.
+# Il token è ICS_TOKEN o, in mancanza, derivato da SECRET_KEY. Con la SECRET_KEY di default
+# sarebbe calcolabile da chiunque: in quel caso il feed resta spento (ICS_TOKEN vuoto).
+ICS_TOKEN = os.getenv("ICS_TOKEN") or (
+    hashlib.sha256(f"{app.secret_key}:ics".encode()).hexdigest()[:24] if app.secret_key != DEFAULT_SECRET_KEY else ""
+)
+
+# Cache del feed completo per filtro: {(sede, slot, area): (contatore modifiche, bytes)}
+_ICS_CACHE = {}
+_ICS_CACHE_LOCK = threading.Lock()
+
+
+def _ics_escape(text) -> str:
+    s = str(text or "")
+    return s.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def _ics_fold(line: str) -> str:
+    """Spezza le righe oltre 75 ottetti come da RFC 5545 (continuazione con uno spazio)."""
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line
+    parts, cur = [], b""
+    for ch in line:
+        b = ch.encode("utf-8")
+        if len(cur) + len(b) > (75 if not parts else 74):
+            parts.append(cur.decode("utf-8"))
+            cur = b""
+        cur += b
+    parts.append(cur.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+
+def _ics_dt(day: str, hhmm: str) -> str:
+    # Ora locale "floating" (senza fuso): il telefono la mostra all'ora del locale.
+    return day.replace("-", "") + "T" + (hhmm or "00:00").replace(":", "") + "00"
+
+
+def _ics_uid(booking_id: int) -> str:
+    # Gli id si ripetono tra le sedi: con più sedi la sede entra nell'UID, altrimenti un
+    # telefono iscritto a due feed fonderebbe eventi diversi
+    host = f"{current_venue()}.{APP_NAME.lower()}" if MULTI_VENUE else APP_NAME.lower()
+    return f"booking-{booking_id}@{host}"
+
+
+def _ics_event_lines(r, dtstamp: str) -> list:
+    summary = f"Area {r['area'] or '-'}: {r['nome_festeggiato'] or '-'}"
+    if r["eta_festeggiato"]:
+        summary += f" ({r['eta_festeggiato']} anni)"
+    desc = (
+        f"{r['invitati_bambini'] or 0} bimbi / {r['invitati_adulti'] or 0} adulti\n"
+        f"Pacchetto: {r['pacchetto'] or '-'}\n"
+        f"Tema: {r['tema_evento'] or '-'}"
+    )
+    location = f"{APP_NAME} - Area {r['area'] or '-'}"
+    return [
+        "BEGIN:VEVENT",
+        f"UID:{_ics_uid(r['id'])}",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART:{_ics_dt(r['event_date'], r['start_time'])}",
+        f"DTEND:{_ics_dt(r['event_date'], r['end_time'])}",
+        f"SUMMARY:{_ics_escape(summary)}",
+        f"DESCRIPTION:{_ics_escape(desc)}",
+        f"LOCATION:{_ics_escape(location)}",
+        "STATUS:CONFIRMED",
+        "END:VEVENT",
+    ]
+
+
+def _ics_cancel_lines(booking_id: int, dtstamp: str, day: str, hhmm: str) -> list:
+    # DTSTART è obbligatorio anche qui (RFC 5545, calendario senza METHOD): l'inizio originale
+    return [
+        "BEGIN:VEVENT",
+        f"UID:{_ics_uid(booking_id)}",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART:{_ics_dt(day, hhmm)}",
+        "STATUS:CANCELLED",
+        "END:VEVENT",
+    ]
+
+
+def _ics_cancel_start(conn, booking_id: int) -> tuple:
+    """(giorno, ora) d'inizio di un evento tolto dal feed: dalla riga se c'è ancora (uscita dal
+    filtro), altrimenti dall'ultimo passaggio nel feed booking_changes e dalle regole slot."""
+    r = conn.execute("SELECT event_date, start_time FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    if r and r["event_date"]:
+        return r["event_date"], r["start_time"]
+    r = conn.execute(
+        "SELECT event_date, slot_code FROM booking_changes WHERE booking_id = ? AND event_date IS NOT NULL "
+        "ORDER BY seq DESC LIMIT 1",
+        (booking_id,),
+    ).fetchone()
+    if not r:
+        return None, None
+    try:
+        slots = slots_for_date(datetime.strptime(r["event_date"], "%Y-%m-%d").date())
+    except ValueError:
+        return None, None
+    return r["event_date"], next((s["start"] for s in slots if s["code"] == r["slot_code"]), None)
+
+
+def _ics_calendar(name: str, sync_token: int, events: list) -> bytes:
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:-//{APP_NAME}//Prenotazioni//IT",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_ics_escape(name)}",
+        f"X-SYNC-TOKEN:{sync_token}",
+    ]
+    lines += events
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(_ics_fold(ln) for ln in lines) + "\r\n").encode("utf-8")
+
+
+ICS_COLUMNS = """id, event_date, start_time, end_time, slot_code, area, nome_festeggiato, eta_festeggiato,
+                 invitati_bambini, invitati_adulti, pacchetto, tema_evento"""
+
+
+def _ics_filter_sql(slot_code: str, area):
+    where = ["event_date IS NOT NULL", "start_time IS NOT NULL"]
+    params = []
+    if slot_code:
+        where.append("slot_code = ?")
+        params.append(slot_code)
+    if area:
+        where.append("area = ?")
+        params.append(area)
+    return " AND ".join(where), params
+
+
+def build_ics_full(conn, slot_code: str, area, counter: int, name: str) -> bytes:
+    dtstamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    where, params = _ics_filter_sql(slot_code, area)
+    events = []
+    for r in conn.execute(f"SELECT {ICS_COLUMNS} FROM bookings WHERE {where} ORDER BY event_date, start_time, area", params):
+        events += _ics_event_lines(r, dtstamp)
+    return _ics_calendar(name, counter, events)
+
+
+def build_ics_delta(conn, slot_code: str, area, since: int, counter: int, name: str) -> bytes:
+    """Solo gli eventi modificati dopo `since`; quelli cancellati (o usciti dal filtro) come CANCELLED."""
+    dtstamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    changed_ids = [
+        r["booking_id"]
+        for r in conn.execute(
+            "SELECT DISTINCT booking_id FROM booking_changes WHERE seq > ? AND seq <= ? AND op != 'M'",
+            (since, counter),
+        )
+    ]
+    events = []
+    found = set()
+    for i in range(0, len(changed_ids), 500):
+        chunk = changed_ids[i:i + 500]
+        where, params = _ics_filter_sql(slot_code, area)
+        sql = f"SELECT {ICS_COLUMNS} FROM bookings WHERE {where} AND id IN ({','.join('?' * len(chunk))})"
+        for r in conn.execute(sql, params + chunk):
+            found.add(r["id"])
+            events += _ics_event_lines(r, dtstamp)
+    for bid in changed_ids:
+        if bid not in found:
+            day, hhmm = _ics_cancel_start(conn, bid)
+            if day:
+                events += _ics_cancel_lines(bid, dtstamp, day, hhmm)
+    return _ics_calendar(name, counter, events)
+
+
+def ics_authorized() -> bool:
+    return is_logged_in() or hmac.compare_digest(request.args.get("token", ""), ICS_TOKEN)
+
+
+ICS_DISABLED_MESSAGE = "Feed calendario disattivato: imposta ICS_TOKEN oppure una SECRET_KEY diversa da quella di default."
+
+
+@app.route("/calendario.ics")
+def calendar_ics():
+    if not ICS_TOKEN:
+        abort(503, ICS_DISABLED_MESSAGE)
+    if not ics_authorized():
+        abort(403)
+
+    slot_code = (request.args.get("slot") or "").strip().upper()
+    if slot_code and slot_code not in dict(SLOT_CALENDAR.slot_choices(include_inactive=True)):
+        abort(400, "Slot non valido.")
+    area = to_int(request.args.get("area"))
+    since = to_int(request.args.get("since") or request.args.get("sync_token"))
+
+    name = APP_NAME
+    if slot_code:
+        name += f" - {slot_code}"
+    if area:
+        name += f" - Area {area}"
+
+    conn = get_db()
+    counter = booking_change_counter(conn)
+    etag = f'"{current_venue()}-{counter}-{slot_code}-{area or ""}-{since if since is not None else ""}"'
+    if request.headers.get("If-None-Match") == etag:
+        conn.close()
+        return Response(status=304, headers={"ETag": etag, "X-Sync-Token": str(counter)})
+
+    if since is not None:
+        body = build_ics_delta(conn, slot_code, area, since, counter, name)
+    else:
+        key = (current_venue(), slot_code, area)
+        with _ICS_CACHE_LOCK:
+            cached = _ICS_CACHE.get(key)
+        if cached and cached[0] == counter:
+            body = cached[1]
+        else:
+            body = build_ics_full(conn, slot_code, area, counter, name)
+            with _ICS_CACHE_LOCK:
+                _ICS_CACHE[key] = (counter, body)
+    conn.close()
+
+    return Response(
+        body,
+        mimetype="text/calendar",
+        headers={"ETag": etag, "X-Sync-Token": str(counter), "Content-Disposition": 'inline; filename="lullyland.ics"'},
+    )
+
+
+@app.route("/calendario-telefono")
+def calendar_ics_links():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    feeds = [("Tutte le prenotazioni", {})]
+    feeds += [(f"Slot {label}", {"slot": code}) for code, label in SLOT_CALENDAR.slot_choices()]
+    feeds += [(f"Area {a}", {"area": a}) for a in SLOT_CALENDAR.standard_areas() + SLOT_CALENDAR.overflow_areas()]
+
+    items = "" if ICS_TOKEN else f"<p><b>⚠️ {ICS_DISABLED_MESSAGE}</b></p>"
+    for label, params in feeds if ICS_TOKEN else []:
+        url = url_for("calendar_ics", token=ICS_TOKEN, _external=True, **params)
+        webcal = "webcal://" + url.split("://", 1)[1]
+        items += f"""
+          <div class="eventline">
+            <b>{label}</b>
+            <div class="muted" style="word-break:break-all;">{url}</div>
+            <div class="row" style="margin-top:8px;"><a class="btn primary" href="{webcal}">📲 Iscriviti</a></div>
+          </div>
+        """
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Calendario telefono</title>
+{BASE_CSS}
+</head><body>
+{topbar('month')}
+<div class="card">
+  <h2 style="margin:0;">Calendario sul telefono</h2>
+  <div class="muted">Aggiungi il feed come calendario in abbonamento (iPhone: Impostazioni › Calendario › Account › Aggiungi calendario).</div>
+  {items}
+</div>
+</body></html>
+"""
+
+# -------------------------
+# Coda lavori in background (PDF, export, rigenerazioni)
+# -------------------------
+# I worker web accodano soltanto; il lavoro pesante lo fa un processo separato:
+#   flask --app app jobs-worker
+# Se nessun worker è vivo (heartbeat recente), le route ripiegano sull'esecuzione sincrona.
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs_output")
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", "2"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", "1.0"))
+JOBS_WORKER_STALE_SECONDS = 30
+JOBS_RESULT_TTL_HOURS = int(os.getenv("JOBS_RESULT_TTL_HOURS", "24"))
+
+
+def jobs_dir() -> str:
+    """Cartella dei risultati: una per sede, gli id dei lavori si ripetono tra i DB."""
+    return os.path.join(JOBS_DIR, current_venue()) if MULTI_VENUE else JOBS_DIR
+
+
+def job_contract_pdf(params: dict, out_path: str):
+    conn = get_db()
+    row = fetch_booking(conn, params["booking_id"])
+    conn.close()
+    if not row:
+        raise ValueError(f"Prenotazione #{params['booking_id']} non trovata")
+    with open(out_path, "wb") as f:
+        f.write(build_contract_pdf_bytes(row).getvalue())
+    return "application/pdf", f"contratto_prenotazione_{row['id']}.pdf"
+
+
+def job_export_csv(params: dict, out_path: str):
+    with open(out_path, "wb") as f:
+        for chunk in generate_bookings_csv(params["cols"], params.get("from", ""), params.get("to", ""), params.get("sep", ";")):
+            f.write(chunk)
+    return "text/csv", export_filename("csv", params.get("from", ""), params.get("to", ""))
+
+
+def job_export_xlsx(params: dict, out_path: str):
+    with open(out_path, "wb") as f:
+        for chunk in generate_bookings_xlsx(params["cols"], params.get("from", ""), params.get("to", "")):
+            f.write(chunk)
+    return (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        export_filename("xlsx", params.get("from", ""), params.get("to", "")),
+    )
+
+
+def job_regenerate_contract(params: dict, out_path: str):
+    """Ricalcola testo contratto e totale di una prenotazione dai dati salvati."""
+    conn = get_db()
+    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (params["booking_id"],)).fetchone()
+    if not row:
+        conn.close()
+        raise ValueError(f"Prenotazione #{params['booking_id']} non trovata")
+    payload = payload_from_row(row)
+    prices = booking_prices(conn, row)
+    conn.execute(
+        "UPDATE bookings SET dettagli_contratto_text = ?, totale_stimato_eur = ?, last_actor = ? WHERE id = ?",
+        (build_contract_text(payload, prices), str(compute_totals(payload, prices)["totale"]), actor_stamp(), row["id"]),
+    )
+    conn.commit()
+    conn.close()
+    return None
+
+
+def job_import_bookings(params: dict, out_path: str):
+    """Import CSV caricato da /import; il risultato è il resoconto (riepilogo + errori per riga)."""
+    try:
+        with open(params["path"], encoding="utf-8-sig", newline="") as f:
+            if params.get("dry_run"):
+                with scratch_db_copy() as scratch:
+                    result = import_bookings_csv(f, conn=scratch)
+            else:
+                result = import_bookings_csv(f)
+    finally:
+        if os.path.exists(params["path"]):
+            os.remove(params["path"])
+    n_err = result["read"] - result["imported"] - result["skipped"]
+    with open(out_path, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(["riga", "errore"])
+        w.writerow([
+            "",
+            f"{'Prova (nessun dato salvato)' if params.get('dry_run') else 'Import'}: righe lette {result['read']}, "
+            f"{'da importare' if params.get('dry_run') else 'importate'} {result['imported']}, "
+            f"già presenti {result['skipped']}, con errori {n_err}",
+        ])
+        w.writerows(result["errors"])
+        if len(result["errors"]) >= IMPORT_MAX_REPORTED_ERRORS:
+            w.writerow(["", f"(mostrati solo i primi {IMPORT_MAX_REPORTED_ERRORS} errori)"])
+    name = os.path.splitext(os.path.basename(params.get("filename") or "import"))[0]
+    return "text/csv", f"import_{secure_filename(name) or 'csv'}_resoconto.csv"
+
+
+def job_reprice_bookings(params: dict, out_path: str):
+    """Ricalcolo coi listini in vigore delle prenotazioni da date_from (pulsante in /listini)."""
+    reprice_bookings(params["date_from"], apply=True)
+    return None
+
+
+# kind -> (handler, estensione del file risultato)
+JOB_HANDLERS = {
+    "contract_pdf": (job_contract_pdf, "pdf"),
+    "export_csv": (job_export_csv, "csv"),
+    "export_xlsx": (job_export_xlsx, "xlsx"),
+    "regenerate_contract": (job_regenerate_contract, None),
+    "import_bookings": (job_import_bookings, "csv"),
+    "reprice_bookings": (job_reprice_bookings, None),
+}
+
+
+def enqueue_job(conn, kind: str, params: dict, dedupe_key: str = None, max_attempts: int = None) -> int:
+    """Accoda un lavoro e ritorna l'id. Con dedupe_key riusa un lavoro uguale non fallito."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Tipo di lavoro sconosciuto: {kind}")
+    if dedupe_key:
+        r = conn.execute(
+            "SELECT id, status, result_path FROM jobs WHERE dedupe_key = ? AND status != 'failed' ORDER BY id DESC LIMIT 1",
+            (dedupe_key,),
+        ).fetchone()
+        if r and (r["status"] != "done" or not r["result_path"] or os.path.exists(r["result_path"])):
+            return r["id"]
+
+    cur = conn.execute(
+        """
+        INSERT INTO jobs (kind, params_json, dedupe_key, status, attempts, max_attempts, run_after, created_at)
+        VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)
+        """,
+        (kind, json.dumps(params), dedupe_key, max_attempts or JOBS_MAX_ATTEMPTS, time.time(),
+         datetime.now().isoformat(timespec="seconds")),
+    )
+    conn.commit()
+    return cur.lastrowid
+
+
+def jobs_worker_alive(conn) -> bool:
+    r = conn.execute("SELECT MAX(heartbeat_at) AS hb FROM job_workers").fetchone()
+    return bool(r["hb"]) and r["hb"] > time.time() - JOBS_WORKER_STALE_SECONDS
+
+
+def claim_job(conn, worker_name: str):
+    """Prende il prossimo lavoro pronto, rispettando il limite globale di lavori in esecuzione."""
+    r = conn.execute(
+        """
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, worker = ?
+        WHERE id = (
+            SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY id LIMIT 1
+        )
+        AND (SELECT COUNT(*) FROM jobs WHERE status = 'running') < ?
+        RETURNING id, kind, params_json
+        """,
+        (datetime.now().isoformat(timespec="seconds"), worker_name, time.time(), JOBS_CONCURRENCY),
+    ).fetchone()
+    conn.commit()
+    return r
+
+
+def execute_job(job_id: int, kind: str, params_json: str) -> dict:
+    """Eseguito nel pool di processi: scrive il risultato su file e ne ritorna i metadati."""
+    handler, ext = JOB_HANDLERS[kind]
+    os.makedirs(jobs_dir(), exist_ok=True)
+    out_path = os.path.abspath(os.path.join(jobs_dir(), f"job_{job_id}.{ext}")) if ext else None
+    tmp_path = f"{out_path}.tmp" if out_path else None
+    meta = handler(json.loads(params_json), tmp_path)
+    if not out_path:
+        return {"result_path": None, "result_mimetype": None, "result_filename": None}
+    os.replace(tmp_path, out_path)
+    mimetype, filename = meta
+    return {"result_path": out_path, "result_mimetype": mimetype, "result_filename": filename}
+
+
+def finish_job(conn, job_id: int, result: dict = None, error: str = None):
+    now = datetime.now().isoformat(timespec="seconds")
+    if error is None:
+        conn.execute(
+            """
+            UPDATE jobs SET status = 'done', finished_at = ?, error = NULL,
+                   result_path = ?, result_mimetype = ?, result_filename = ?
+            WHERE id = ?
+            """,
+            (now, result["result_path"], result["result_mimetype"], result["result_filename"], job_id),
+        )
+    else:
+        r = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if r and r["attempts"] < r["max_attempts"]:
+            # Backoff esponenziale: 5s, 10s, 20s...
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', run_after = ?, error = ? WHERE id = ?",
+                (time.time() + 5 * 2 ** (r["attempts"] - 1), error, job_id),
+            )
+        else:
+            conn.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?", (now, error, job_id))
+    conn.commit()
+
+
+def requeue_stale_jobs(conn):
+    """Rimette in coda i lavori 'running' di worker morti (heartbeat scaduto); quelli che
+    hanno già usato tutti i tentativi falliscono, come in finish_job."""
+    stale = "status = 'running' AND worker NOT IN (SELECT name FROM job_workers WHERE heartbeat_at > ?)"
+    cutoff = time.time() - JOBS_WORKER_STALE_SECONDS
+    conn.execute(
+        f"UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE {stale} AND attempts >= max_attempts",
+        (datetime.now().isoformat(timespec="seconds"), "Worker interrotto durante l'esecuzione", cutoff),
+    )
+    conn.execute(f"UPDATE jobs SET status = 'queued', run_after = ? WHERE {stale}", (time.time(), cutoff))
+    conn.commit()
+
+
+def purge_old_job_results(conn):
+    cutoff = (datetime.now() - timedelta(hours=JOBS_RESULT_TTL_HOURS)).isoformat(timespec="seconds")
+    rows = conn.execute(
+        "SELECT id, result_path FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+    ).fetchall()
+    for r in rows:
+        if r["result_path"] and os.path.exists(r["result_path"]):
+            os.remove(r["result_path"])
+    conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,))
+    conn.commit()
+
+
+def run_job_worker(concurrency: int = JOBS_CONCURRENCY):
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    conn = get_db()
+    last_purge = 0.0
+    running = {}  # future -> job_id
+    pool = ProcessPoolExecutor(max_workers=concurrency)
+
+    def restart_pool(error: str):
+        # Un processo del pool morto (memoria, segfault) rompe tutto il pool: i lavori ancora
+        # in corso si chiudono con l'errore (riprovano se hanno tentativi) e si riparte da capo
+        nonlocal pool
+        for job_id in running.values():
+            finish_job(conn, job_id, error=error)
+        running.clear()
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = ProcessPoolExecutor(max_workers=concurrency)
+
+    try:
+        while True:
+            conn.execute(
+                "INSERT INTO job_workers (name, heartbeat_at) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                (worker_name, time.time()),
+            )
+            conn.commit()
+
+            if time.time() - last_purge > 600:
+                requeue_stale_jobs(conn)
+                purge_old_job_results(conn)
+                last_purge = time.time()
+
+            broken = None
+            for fut in [f for f in running if f.done()]:
+                job_id = running.pop(fut)
+                try:
+                    finish_job(conn, job_id, result=fut.result())
+                except BrokenProcessPool as e:
+                    broken = f"{type(e).__name__}: {e}"
+                    finish_job(conn, job_id, error=broken)
+                except Exception as e:
+                    finish_job(conn, job_id, error=f"{type(e).__name__}: {e}")
+            if broken:
+                restart_pool(broken)
+
+            while len(running) < concurrency:
+                job = claim_job(conn, worker_name)
+                if not job:
+                    break
+                try:
+                    running[pool.submit(execute_job, job["id"], job["kind"], job["params_json"])] = job["id"]
+                except BrokenProcessPool as e:
+                    finish_job(conn, job["id"], error=f"{type(e).__name__}: {e}")
+                    restart_pool(f"{type(e).__name__}: {e}")
+
+            if running:
+                wait(list(running), timeout=JOBS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(JOBS_POLL_SECONDS)
+    finally:
+        pool.shutdown()
+
+
+@app.cli.command("jobs-worker")
+@click.option("--concurrency", default=JOBS_CONCURRENCY, show_default=True, help="Processi in parallelo.")
+def jobs_worker_command(concurrency):
+    """Esegue i lavori in coda (PDF contratti, export, rigenerazioni)."""
+    run_job_worker(concurrency)
+
+
+def send_attachment(fileobj_or_path, mimetype: str, filename: str):
+    # Flask >= 2 usa "download_name", Flask < 2 usa "attachment_filename"
+    try:
+        return send_file(fileobj_or_path, mimetype=mimetype, as_attachment=True, download_name=filename)
+    except TypeError:
+        return send_file(fileobj_or_path, mimetype=mimetype, as_attachment=True, attachment_filename=filename)
+
+
+@app.route("/jobs/export", methods=["POST"])
+def job_export():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    fmt = request.form.get("format", "csv")
+    if fmt not in ("csv", "xlsx"):
+        abort(400, "Formato non valido.")
+
+    conn = get_db()
+    all_cols = booking_columns(conn)
+    cols = [c for c in request.form.getlist("col") if c in all_cols] or [c for c in all_cols if c not in EXPORT_EXCLUDED_BY_DEFAULT]
+    if request.form.get("firma") == "1" and "firma_png_base64" not in cols:
+        cols.append("firma_png_base64")
+    params = {"cols": cols, "from": request.form.get("from", ""), "to": request.form.get("to", ""), "sep": ";"}
+    job_id = enqueue_job(conn, f"export_{fmt}", params)
+    conn.close()
+    return redirect(url_for("job_status", job_id=job_id))
+
+
+def job_row(job_id: int):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if not row:
+        abort(404)
+    return row
+
+
+@app.route("/jobs/<int:job_id>.json")
+def job_status_json(job_id: int):
+    if not is_logged_in():
+        abort(403)
+    row = job_row(job_id)
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "error": row["error"],
+        "download_url": url_for("job_download", job_id=job_id) if row["status"] == "done" and row["result_path"] else None,
+    }
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    row = job_row(job_id)
+    pending = row["status"] in ("queued", "running")
+    labels = {"queued": "In coda", "running": "In lavorazione", "done": "Pronto", "failed": "Fallito"}
+
+    body = f"<div class='muted'>Stato: <b>{labels.get(row['status'], row['status'])}</b> · tentativi {row['attempts']}/{row['max_attempts']}</div>"
+    if row["status"] == "done" and row["result_path"]:
+        body += f"<div class='row' style='margin-top:10px;'><a class='btn primary' href='{url_for('job_download', job_id=job_id)}'>⬇️ Scarica {row['result_filename']}</a></div>"
+    elif row["status"] == "done":
+        body += "<p>Completato.</p>"
+    elif row["status"] == "failed":
+        body += f"<pre>{row['error'] or ''}</pre>"
+    else:
+        body += "<p class='muted'>La pagina si aggiorna da sola.</p>"
+        conn = get_db()
+        if row["status"] == "queued" and not jobs_worker_alive(conn):
+            body += "<p>⚠️ Nessun worker attivo: il lavoro parte quando gira <code>flask --app app jobs-worker</code>.</p>"
+        conn.close()
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+{'<meta http-equiv="refresh" content="2">' if pending else ''}
+<title>{APP_NAME} – Lavoro #{job_id}</title>
+{BASE_CSS}
+</head><body>
+{topbar('')}
+<div class="card">
+  <h2 style="margin:0 0 8px;">Lavoro #{job_id} ({row['kind']})</h2>
+  {body}
+</div>
+</body></html>
+"""
+
+
+@app.route("/jobs/<int:job_id>/download")
+def job_download(job_id: int):
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    row = job_row(job_id)
+    if row["status"] != "done" or not row["result_path"] or not os.path.exists(row["result_path"]):
+        abort(404)
+    return send_attachment(row["result_path"], row["result_mimetype"], row["result_filename"])
+
+# -------------------------
+# Backup online del database (VACUUM INTO)
+# -------------------------
+# VACUUM INTO scrive la copia dentro una sola transazione di lettura: in WAL gli insert di
+# booking_new e l'heartbeat dei lavori continuano a passare. La backup API a blocchi, invece,
+# ricomincia da capo a ogni scrittura sul DB e con l'heartbeat ogni secondo non finirebbe mai.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "1") == "1"
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))  # 0 = nessun backup automatico
+
+
+def _backup_prefix() -> str:
+    return os.path.splitext(os.path.basename(venue_db_path()))[0] + "-"
+
+
+def rotate_backups(dest_dir: str, keep: int):
+    names = sorted(
+        n for n in os.listdir(dest_dir)
+        if n.startswith(_backup_prefix()) and (n.endswith(".db") or n.endswith(".db.gz"))
+    )
+    for n in names[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(dest_dir, n))
+
+
+def backup_database(dest_dir: str = None, compress: bool = None, keep: int = None) -> str:
+    """Backup consistente del DB in esercizio, verificato con integrity_check. Ritorna il percorso."""
+    dest_dir = dest_dir or BACKUP_DIR
+    compress = BACKUP_COMPRESS if compress is None else compress
+    keep = BACKUP_KEEP if keep is None else keep
+    os.makedirs(dest_dir, exist_ok=True)
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    final_path = os.path.join(dest_dir, f"{_backup_prefix()}{stamp}.db")
+    part_path = final_path + ".part"
+    if os.path.exists(part_path):  # avanzo di un backup interrotto: VACUUM INTO non sovrascrive
+        os.remove(part_path)
+
+    src = sqlite3.connect(venue_db_path())
+    try:
+        src.execute("VACUUM INTO ?", (part_path,))
+    finally:
+        src.close()
+    dst = sqlite3.connect(part_path)
+    try:
+        result = dst.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        dst.close()
+
+    if result != "ok":
+        os.remove(part_path)
+        raise RuntimeError(f"Backup non valido (integrity_check: {result})")
+
+    if compress:
+        final_path += ".gz"
+        with open(part_path, "rb") as f_in, gzip.open(final_path + ".part", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, length=1024 * 1024)
+        os.remove(part_path)
+        part_path = final_path + ".part"
+    os.replace(part_path, final_path)
+
+    rotate_backups(dest_dir, keep)
+    return final_path
+
+
+def _backup_scheduler_loop(interval_seconds: float):
+    while True:
+        time.sleep(interval_seconds)
+        for venue in VENUES:
+            with use_venue(venue):
+                try:
+                    path = backup_database()
+                    app.logger.info("Backup completato: %s", path)
+                except Exception:
+                    app.logger.exception("Backup fallito (%s)", venue_db_path())
+
+
+_backup_scheduler_tried = False
+
+
+def start_backup_scheduler():
+    """Avvia il thread dei backup periodici in un solo processo (lock file tra i worker gunicorn)."""
+    global _backup_scheduler_tried
+    if _backup_scheduler_tried or BACKUP_INTERVAL_HOURS <= 0:
+        return
+    _backup_scheduler_tried = True
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    lock_f = open(os.path.join(BACKUP_DIR, ".scheduler.lock"), "w")
+    try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_f.close()
+        return  # un altro processo ha già lo scheduler
+    t = threading.Thread(target=_backup_scheduler_loop, args=(BACKUP_INTERVAL_HOURS * 3600,), daemon=True)
+    t._lock_file = lock_f  # tiene aperto (e quindi bloccato) il lock finché vive il processo
+    t.start()
+
+
+@app.cli.command("backup")
+@click.option("--dest", default=None, help=f"Cartella di destinazione (default: {BACKUP_DIR}).")
+@click.option("--keep", default=None, type=int, help=f"Backup da conservare (default: {BACKUP_KEEP}).")
+@click.option("--compress/--no-compress", default=None, help="Comprimi con gzip (default: BACKUP_COMPRESS).")
+def backup_command(dest, keep, compress):
+    """Backup online del database, senza fermare l'app."""
+    path = backup_database(dest_dir=dest, compress=compress, keep=keep)
+    click.echo(f"Backup OK: {path}")
+
+
+@app.before_request
+def start_backup_scheduler_in_web_server():
+    # Solo i processi che servono richieste: i comandi flask (backup, import, jobs-worker...)
+    # importano l'app ma non devono tenere il lock né far partire backup propri.
+    start_backup_scheduler()
+
+# -------------------------
+# Archivio stagioni passate (database annuali collegati con ATTACH)
+# -------------------------
+# Le prenotazioni più vecchie dell'orizzonte escono dalla tabella "calda" e finiscono in un
+# file SQLite per anno, aperto con ATTACH solo dalle viste storiche. archived_bookings
+# (nel DB principale) dice in che anno è finita ogni prenotazione.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "365"))
+
+# Limite di memoria della cache righe per worker (le firme PNG pesano decine di KB l'una)
+ROW_CACHE_MAX_BYTES = int(os.getenv("ROW_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+
+def archive_db_path(year: int) -> str:
+    base = os.path.splitext(os.path.basename(venue_db_path()))[0]
+    return os.path.join(ARCHIVE_DIR, f"{base}-archivio-{int(year)}.db")
+
+
+def archived_years() -> list:
+    conn = get_db()
+    years = [r["archive_year"] for r in conn.execute(
+        "SELECT DISTINCT archive_year FROM archived_bookings ORDER BY archive_year DESC"
+    )]
+    conn.close()
+    return years
+
+
+def attach_archive(conn, year: int, create: bool = False):
+    """ATTACH del DB d'archivio dell'anno; ritorna il nome dello schema (None se non esiste)."""
+    path = archive_db_path(year)
+    if not create and not os.path.exists(path):
+        return None
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    schema = f"arch_{int(year)}"
+    conn.execute("ATTACH DATABASE ? AS " + schema, (path,))
+    return schema
+
+
+def detach_archive(conn, schema: str):
+    if schema:
+        conn.execute(f"DETACH DATABASE {schema}")
+
+
+def ensure_archive_schema(conn, schema: str):
+    """Stessa struttura di main.bookings (colonne aggiunte dopo comprese)."""
+    create_sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name='bookings'").fetchone()["sql"]
+    create_sql = create_sql.replace("CREATE TABLE bookings", f"CREATE TABLE IF NOT EXISTS {schema}.bookings", 1)
+    conn.execute(create_sql)
+    have = {r["name"] for r in conn.execute(f"PRAGMA {schema}.table_info(bookings)")}
+    for r in conn.execute("PRAGMA main.table_info(bookings)").fetchall():
+        if r["name"] not in have:
+            conn.execute(f"ALTER TABLE {schema}.bookings ADD COLUMN {r['name']} {r['type']}")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_bookings_calendar ON bookings(event_date, slot_code)")
+
+
+def archive_old_bookings(horizon_days: int = None, dry_run: bool = False) -> dict:
+    """Sposta negli archivi annuali le prenotazioni con event_date precedente all'orizzonte.
+
+    Ritorna {anno: righe spostate}. Con WAL il commit su più DB collegati non è atomico, quindi
+    per ogni anno: copia nell'archivio (commit), verifica che l'archivio abbia tutte le righe,
+    poi in un secondo passo cancella dal DB principale. Se ci si ferma a metà le righe restano
+    in entrambi e il giro successivo le ricopia (INSERT OR REPLACE) prima di cancellarle.
+    """
+    horizon_days = ARCHIVE_HORIZON_DAYS if horizon_days is None else horizon_days
+    cutoff = (date.today() - timedelta(days=horizon_days)).isoformat()
+
+    conn = get_db()
+    years = [int(r["y"]) for r in conn.execute(
+        "SELECT DISTINCT substr(event_date, 1, 4) AS y FROM bookings WHERE event_date < ? ORDER BY y", (cutoff,)
+    )]
+    cols = ", ".join(booking_columns(conn))
+    moved = {}
+    for year in years:
+        start = f"{year:04d}-01-01"
+        end = min(f"{year + 1:04d}-01-01", cutoff)
+        n = conn.execute(
+            "SELECT COUNT(*) AS c FROM bookings WHERE event_date >= ? AND event_date < ?", (start, end)
+        ).fetchone()["c"]
+        moved[year] = n
+        if dry_run or not n:
+            continue
+
+        schema = attach_archive(conn, year, create=True)
+        try:
+            ensure_archive_schema(conn, schema)
+            with conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {schema}.bookings ({cols}) "
+                    f"SELECT {cols} FROM main.bookings WHERE event_date >= ? AND event_date < ?",
+                    (start, end),
+                )
+            # Secondo passo: si cancella solo ciò che l'archivio contiene davvero
+            in_archive = f"event_date >= ? AND event_date < ? AND id IN (SELECT id FROM {schema}.bookings)"
+            copied = conn.execute(f"SELECT COUNT(*) AS c FROM main.bookings WHERE {in_archive}", (start, end)).fetchone()["c"]
+            if copied < n:
+                raise RuntimeError(f"Archivio {year}: copiate {copied} righe su {n}, nessuna cancellata")
+            with conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO archived_bookings (id, archive_year) SELECT id, ? FROM main.bookings WHERE {in_archive}",
+                    (year, start, end),
+                )
+                moved[year] = conn.execute(f"DELETE FROM main.bookings WHERE {in_archive}", (start, end)).rowcount
+        finally:
+            detach_archive(conn, schema)
+
+    if not dry_run and any(moved.values()):
+        conn.execute("PRAGMA optimize")
+    conn.close()
+    return moved
+
+
+def fetch_booking(conn, booking_id: int):
+    """Riga completa di una prenotazione: tabella calda, altrimenti l'archivio del suo anno."""
+    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    if row:
+        return row
+    r = conn.execute("SELECT archive_year FROM archived_bookings WHERE id = ?", (booking_id,)).fetchone()
+    if not r:
+        return None
+    schema = attach_archive(conn, r["archive_year"])
+    if not schema:
+        return None
+    try:
+        return conn.execute(f"SELECT * FROM {schema}.bookings WHERE id = ?", (booking_id,)).fetchone()
+    finally:
+        detach_archive(conn, schema)
+
+
+class BookingRowCache:
+    """Cache LRU per worker delle righe complete di bookings, limitata in byte.
+
+    La validità si controlla col contatore globale del feed booking_changes (una lettura
+    di MAX(seq) sull'indice della chiave primaria): se è avanzato, si scartano solo le
+    prenotazioni toccate dopo l'ultimo seq visto, anche se le ha modificate un altro worker.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._rows = OrderedDict()  # booking_id -> (row, size)
+        self._bytes = 0
+        self._seq = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(row) -> int:
+        return 64 + sum(len(v) if isinstance(v, (str, bytes)) else 16 for v in row)
+
+    def _evict(self, booking_id):
+        item = self._rows.pop(booking_id, None)
+        if item:
+            self._bytes -= item[1]
+
+    def _sync(self, conn):
+        seq = booking_change_counter(conn)
+        if self._seq is not None and seq != self._seq:
+            if seq - self._seq > 1000:
+                self._rows.clear()
+                self._bytes = 0
+            else:
+                for r in conn.execute(
+                    "SELECT DISTINCT booking_id FROM booking_changes WHERE seq > ? AND seq <= ?", (self._seq, seq)
+                ):
+                    self._evict(r["booking_id"])
+        self._seq = seq
+
+    def get(self, conn, booking_id: int):
+        with self._lock:
+            self._sync(conn)
+            item = self._rows.get(booking_id)
+            if item:
+                self._rows.move_to_end(booking_id)
+                return item[0]
+            seen = self._seq
+
+        row = fetch_booking(conn, booking_id)
+        if row is None:
+            return None
+
+        size = self._size(row)
+        with self._lock:
+            # Mentre leggevamo, un altro thread può aver già sincronizzato oltre una modifica di
+            # questa prenotazione: la riga letta potrebbe essere quella vecchia, e nessun _sync
+            # successivo la scarterebbe più. In quel caso non si mette in cache.
+            if self._seq != seen and conn.execute(
+                "SELECT 1 FROM booking_changes WHERE booking_id = ? AND seq > ? LIMIT 1", (booking_id, seen)
+            ).fetchone():
+                return row
+            if size <= self.max_bytes:
+                self._evict(booking_id)
+                self._rows[booking_id] = (row, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, old_size) = self._rows.popitem(last=False)
+                    self._bytes -= old_size
+        return row
+
+
+BOOKING_ROWS = PerVenue(lambda: BookingRowCache(ROW_CACHE_MAX_BYTES))
+
+
+@app.cli.command("archive")
+@click.option("--horizon-days", default=None, type=int, help=f"Archivia gli eventi più vecchi di N giorni (default: {ARCHIVE_HORIZON_DAYS}).")
+@click.option("--dry-run", is_flag=True, help="Mostra solo quante prenotazioni verrebbero spostate.")
+def archive_command(horizon_days, dry_run):
+    """Sposta le stagioni passate negli archivi annuali."""
+    moved = archive_old_bookings(horizon_days, dry_run=dry_run)
+    for year, n in moved.items():
+        click.echo(f"{year}: {n} prenotazioni {'da archiviare' if dry_run else 'archiviate'}")
+    if not moved:
+        click.echo("Niente da archiviare.")
+
+
+@app.route("/archivio")
+def archivio():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    years = archived_years()
+    year = to_int(request.args.get("anno")) or (years[0] if years else None)
+    q = (request.args.get("q") or "").strip()
+
+    rows = []
+    if year in years:
+        conn = get_db()
+        schema = attach_archive(conn, year)
+        if schema:
+            sql = f"""
+              SELECT id, event_date, slot_code, area, nome_festeggiato, pacchetto,
+                     invitati_bambini, invitati_adulti, totale_stimato_eur
+              FROM {schema}.bookings
+            """
+            params = []
+            if q:
+                sql += " WHERE nome_festeggiato LIKE ? OR madre_nome_cognome LIKE ? OR padre_nome_cognome LIKE ?"
+                params = [f"%{q}%"] * 3
+            sql += " ORDER BY event_date, slot_code, area"
+            rows = conn.execute(sql, params).fetchall()
+            detach_archive(conn, schema)
+        conn.close()
+
+    years_html = "".join(
+        f"<a class='btn {'primary' if y == year else ''}' href='{url_for('archivio', anno=y)}'>{y}</a>" for y in years
+    ) or "<span class='muted'>Nessuna stagione archiviata.</span>"
+    rows_html = "".join(
+        f"""
+          <div class="eventline">
+            <b>{r['event_date']} · {escape(r['slot_code'] or '-')} · Area {r['area'] or '-'}: {escape(r['nome_festeggiato'] or '-')}</b>
+            <div class="muted">{escape(r['pacchetto'] or '-')} · {(r['invitati_bambini'] or 0)} bimbi / {(r['invitati_adulti'] or 0)} adulti</div>
+            <a class="open" href="{url_for('prenotazione_dettaglio', booking_id=r['id'])}">Apri</a>
+          </div>
+        """
+        for r in rows
+    )
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Archivio</title>
+{BASE_CSS}
+</head><body>
+{topbar('archive')}
+<div class="card">
+  <div class="head">
+    <h2 style="margin:0;">Archivio {year or ''}</h2>
+    <div class="row">{years_html}</div>
+  </div>
+  <form method="get" class="row" style="margin-top:10px;">
+    <input type="hidden" name="anno" value="{year or ''}">
+    <input name="q" value="{escape(q)}" placeholder="Cerca festeggiato o genitore" style="padding:10px;border-radius:10px;border:1px solid #ddd;">
+    <button class="btn" type="submit">Cerca</button>
+  </form>
+  {rows_html}
+</div>
+</body></html>
+"""
+
+# -------------------------
+# Pianificazione produzione e fornitori (aggregati per giorno/settimana)
+# -------------------------
+# Le quantità si sommano in SQL (una riga per giorno); le settimane già passate si salvano
+# in planner_weeks e si ricalcolano solo se il feed booking_changes tocca i loro giorni.
+# Le cancellazioni ('D') le fa solo l'archiviazione, che sposta le righe senza cambiare i
+# numeri: non invalidano la cache (e l'aggregazione legge comunque anche gli archivi).
+PLANNER_MAX_DAYS = 366
+KG_SCALE = 100  # torta_kg in centesimi di kg per restare su interi in SQL
+
+
+def planner_metrics() -> list:
+    """[(nome, espressione SQL)] delle quantità per giorno; i cataloghi sono costanti del codice."""
+    bimbi = "COALESCE(invitati_bambini, 0)"
+    adulti = "COALESCE(invitati_adulti, 0)"
+    metrics = [
+        ("eventi", "COUNT(*)"),
+        ("bimbi", f"SUM({bimbi})"),
+        ("adulti", f"SUM({adulti})"),
+    ]
+    metrics += [(f"catering_{k}", f"SUM(CASE WHEN catering_baby_choice = '{k}' THEN {bimbi} ELSE 0 END)")
+                for k in CATERING_BABY_OPTIONS]
+    metrics += [
+        ("torte_interne", "SUM(torta_choice = 'interna')"),
+        ("torte_gusto_altro", "SUM(torta_choice = 'interna' AND torta_interna_choice = 'altro')"),
+        ("torte_esterne", "SUM(torta_choice = 'esterna')"),
+        # kg come compute_totals: persone * KG_PER_PERSON (KG_PER_PERSON ha due decimali)
+        ("torta_kg_cent", f"SUM(CASE WHEN torta_choice = 'interna' THEN ({bimbi} + {adulti}) * {int(KG_PER_PERSON * KG_SCALE)} ELSE 0 END)"),
+    ]
+    metrics += [(f"dessert_bimbi_{k}", f"SUM(CASE WHEN dessert_bimbi_choice = '{k}' THEN {bimbi} ELSE 0 END)")
+                for k in DESSERT_OPTIONS]
+    metrics += [(f"dessert_adulti_{k}", f"SUM(CASE WHEN dessert_adulti_choice = '{k}' THEN {adulti} ELSE 0 END)")
+                for k in DESSERT_OPTIONS]
+    extras = {**EXTRA_SERVIZI, **EXTRA_SERVIZI_ALL_INCLUSIVE}
+    metrics += [(f"extra_{k}", f"SUM(instr(',' || COALESCE(extra_keys_csv, '') || ',', ',{k},') > 0)")
+                for k in extras]
+    return metrics
+
+
+def planner_labels() -> dict:
+    labels = {"eventi": "Eventi", "bimbi": "Bimbi", "adulti": "Adulti"}
+    labels.update({f"catering_{k}": f"Catering: {v}" for k, v in CATERING_BABY_OPTIONS.items()})
+    labels.update({
+        "torte_interne": "Torte interne", "torte_gusto_altro": "di cui gusto concordato",
+        "torte_esterne": "Torte esterne", "torta_kg_cent": "Torta (kg)",
+    })
+    labels.update({f"dessert_bimbi_{k}": f"Dessert bimbi: {v}" for k, v in DESSERT_OPTIONS.items()})
+    labels.update({f"dessert_adulti_{k}": f"Dessert adulti: {v}" for k, v in DESSERT_OPTIONS.items()})
+    labels.update({f"extra_{k}": name for k, (name, _) in {**EXTRA_SERVIZI, **EXTRA_SERVIZI_ALL_INCLUSIVE}.items()})
+    return labels
+
+
+def week_start(d: date) -> date:
+    return d - timedelta(days=d.weekday())
+
+
+def aggregate_days(conn, date_from: str, date_to: str) -> dict:
+    """{giorno ISO: {metrica: int}} con una sola query (tabella calda + archivi degli anni coinvolti)."""
+    metrics = planner_metrics()
+    select = ", ".join(f"{expr} AS {name}" for name, expr in metrics)
+    archived = {r["archive_year"] for r in conn.execute(
+        "SELECT DISTINCT archive_year FROM archived_bookings WHERE archive_year BETWEEN ? AND ?",
+        (int(date_from[:4]), int(date_to[:4])),
+    )}
+    cols = ("event_date, invitati_bambini, invitati_adulti, catering_baby_choice, torta_choice, torta_interna_choice, "
+            "dessert_bimbi_choice, dessert_adulti_choice, extra_keys_csv")
+    schemas = [s for s in (attach_archive(conn, y) for y in sorted(archived)) if s]
+    try:
+        sources = " UNION ALL ".join(
+            f"SELECT {cols} FROM {s}.bookings WHERE event_date BETWEEN :f AND :t" for s in ["main", *schemas]
+        )
+        rows = conn.execute(
+            f"SELECT event_date, {select} FROM ({sources}) GROUP BY event_date",
+            {"f": date_from, "t": date_to},
+        ).fetchall()
+    finally:
+        for s in schemas:
+            detach_archive(conn, s)
+    return {r["event_date"]: {name: int(r[name] or 0) for name, _ in metrics} for r in rows}
+
+
+def planner_days(date_from: date, date_to: date) -> dict:
+    """Aggregati per giorno nel periodo; le settimane concluse arrivano da planner_weeks."""
+    today = date.today()
+    conn = get_db()
+    seq_now = booking_change_counter(conn)
+    past_weeks = []
+    wk = week_start(date_from)
+    while wk <= date_to and wk + timedelta(days=6) < today:
+        past_weeks.append(wk.isoformat())
+        wk += timedelta(days=7)
+
+    cached = {}
+    if past_weeks:
+        marks = ",".join("?" * len(past_weeks))
+        cached = {r["week_start"]: r for r in conn.execute(
+            f"SELECT week_start, data_json, seq FROM planner_weeks WHERE week_start IN ({marks})", past_weeks
+        )}
+    if cached:
+        min_seq = min(r["seq"] for r in cached.values())
+        touched = conn.execute(
+            """
+            SELECT date(event_date, '-' || ((CAST(strftime('%w', event_date) AS INTEGER) + 6) % 7) || ' days') AS wk,
+                   MAX(seq) AS seq
+            FROM booking_changes
+            WHERE seq > ? AND op <> 'D' AND event_date BETWEEN ? AND ?
+            GROUP BY wk
+            """,
+            (min_seq, past_weeks[0], (date.fromisoformat(past_weeks[-1]) + timedelta(days=6)).isoformat()),
+        ).fetchall()
+        for r in touched:
+            if r["wk"] in cached and r["seq"] > cached[r["wk"]]["seq"]:
+                del cached[r["wk"]]
+
+    days = {}
+    for r in cached.values():
+        days.update(json.loads(r["data_json"]))
+    missing = [w for w in past_weeks if w not in cached]
+    if missing:
+        fresh = aggregate_days(conn, missing[0], (date.fromisoformat(missing[-1]) + timedelta(days=6)).isoformat())
+        with conn:
+            for w in missing:
+                week_days = {k: v for k, v in fresh.items() if w <= k <= (date.fromisoformat(w) + timedelta(days=6)).isoformat()}
+                conn.execute(
+                    "INSERT OR REPLACE INTO planner_weeks (week_start, data_json, seq) VALUES (?,?,?)",
+                    (w, json.dumps(week_days), seq_now),
+                )
+                days.update(week_days)
+
+    # Settimana corrente e future: sempre dal vivo
+    live_from = max(date_from, week_start(today)) if past_weeks else date_from
+    if live_from <= date_to:
+        days.update(aggregate_days(conn, live_from.isoformat(), date_to.isoformat()))
+    conn.close()
+    lo, hi = date_from.isoformat(), date_to.isoformat()
+    return {k: v for k, v in sorted(days.items()) if lo <= k <= hi}
+
+
+def planner_rollup(days: dict, group: str) -> list:
+    """[(etichetta, {metrica: int})] per giorno o per settimana (lunedì)."""
+    if group == "day":
+        return list(days.items())
+    weeks = {}
+    for k, metrics in days.items():
+        wk = week_start(date.fromisoformat(k)).isoformat()
+        acc = weeks.setdefault(wk, dict.fromkeys(metrics, 0))
+        for name, v in metrics.items():
+            acc[name] += v
+    return sorted(weeks.items())
+
+
+def planner_value(name: str, value: int) -> str:
+    if name == "torta_kg_cent":
+        return eur(Decimal(value) / KG_SCALE)
+    return str(value)
+
+
+@app.route("/produzione")
+def produzione():
+    if not is_logged_in():
+        return redirect(url_for("login"))
+
+    today = date.today()
+    try:
+        d_from = datetime.strptime(request.args.get("from") or week_start(today).isoformat(), "%Y-%m-%d").date()
+        d_to = datetime.strptime(request.args.get("to") or (d_from + timedelta(days=27)).isoformat(), "%Y-%m-%d").date()
+    except ValueError:
+        abort(400, "Data non valida.")
+    if d_to < d_from:
+        abort(400, "Intervallo non valido.")
+    d_to = min(d_to, d_from + timedelta(days=PLANNER_MAX_DAYS))
+    group = "day" if request.args.get("group") == "day" else "week"
+
+    rollup = planner_rollup(planner_days(d_from, d_to), group)
+    labels = planner_labels()
+
+    if request.accept_mimetypes.best == "application/json":
+        return {
+            "from": d_from.isoformat(), "to": d_to.isoformat(), "group": group,
+            "rows": [
+                {"period": k, **{n: v for n, v in m.items() if n != "torta_kg_cent"},
+                 "torta_kg": f"{Decimal(m['torta_kg_cent']) / KG_SCALE:.2f}"}
+                for k, m in rollup
+            ],
+        }
+
+    # Solo le colonne con almeno una quantità nel periodo
+    used = [n for n in labels if any(m.get(n) for _, m in rollup)]
+    head = "".join(f"<th>{labels[n]}</th>" for n in used)
+    body = ""
+    for k, m in rollup:
+        d = date.fromisoformat(k)
+        period = (f"{WEEKDAYS_IT[d.weekday()][:3]} {d.strftime('%d/%m')}" if group == "day"
+                  else f"Sett. {d.strftime('%d/%m')}–{(d + timedelta(days=6)).strftime('%d/%m')}")
+        body += f"<tr><td><b>{period}</b></td>" + "".join(f"<td>{planner_value(n, m[n])}</td>" for n in used) + "</tr>"
+    table = (
+        f"<div style='overflow-x:auto;margin-top:10px;'><table class='plan'><tr><th>Periodo</th>{head}</tr>{body}</table></div>"
+        if rollup else "<p class='muted'>Nessun evento nel periodo.</p>"
+    )
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Produzione</title>
+{BASE_CSS}
+<style>
+  .plan{{border-collapse:collapse;background:#fff;font-size:13px;}}
+  .plan th,.plan td{{border:1px solid #e5e5e5;padding:6px 8px;text-align:right;white-space:nowrap;}}
+  .plan th:first-child,.plan td:first-child{{text-align:left;}}
+</style>
+</head><body>
+{topbar('planner')}
+<div class="card">
+  <h2 style="margin:0 0 10px;">Produzione e fornitori</h2>
+  <form method="get" class="row">
+    <label>Dal <input type="date" name="from" value="{d_from.isoformat()}"></label>
+    <label>Al <input type="date" name="to" value="{d_to.isoformat()}"></label>
+    <select name="group">
+      <option value="week" {'selected' if group == 'week' else ''}>Per settimana</option>
+      <option value="day" {'selected' if group == 'day' else ''}>Per giorno</option>
+    </select>
+    <button class="btn primary" type="submit">Calcola</button>
+  </form>
+  <div class="muted" style="margin-top:8px;">Catering e dessert in porzioni (bimbi/adulti), extra in numero di eventi.</div>
+  {table}
+</div>
+</body></html>
+"""
+
+# -------------------------
+# Listini e ricalcolo prezzi in blocco (NumPy)
+# -------------------------
+# Stesse regole di compute_totals, ma su array: una passata per tutte le prenotazioni di un
+# listino. Gli importi sono interi in decimillesimi di euro (prezzo al centesimo per kg al
+# centesimo), così il risultato coincide al centesimo con i Decimal di compute_totals.
+REPRICE_COLUMNS = ("id, event_date, pacchetto, invitati_bambini, invitati_adulti, torta_choice, "
+                   "extra_keys_csv, totale_stimato_eur, price_list_id, row_version")
+# Salvataggio a blocchi: una SELECT e un executemany per blocco, un commit per blocco
+REPRICE_APPLY_ROWS = 500
+
+
+def _cents(value: Decimal) -> int:
+    q = value.quantize(Decimal("0.01"))
+    if q != value:
+        raise ValueError(f"Prezzo con più di due decimali: {value}")
+    return int(q * 100)
+
+
+def _round_half_up(np, values, factor: int):
+    """Divisione intera arrotondata come ROUND_HALF_UP (metà lontano da zero)."""
+    return np.sign(values) * ((np.abs(values) + factor // 2) // factor)
 
-        if not data_firma:
-            conn.close()
-            return render_form("Inserisci la data firma.", request.form)
 
-        if not firma_png_base64.startswith("data:image/png;base64,"):
-            conn.close()
-            return render_form("Firma mancante: firma nel riquadro prima di salvare.", request.form)
+def vectorized_totals(rows: list, prices: dict):
+    """Totali in centesimi (array int64) per le righe, identici a compute_totals(payload, prices)."""
+    try:
+        import numpy as np
+    except Exception as e:
+        raise RuntimeError("Per il ricalcolo in blocco serve la libreria 'numpy'. Installala con: pip install numpy") from e
+
+    n = len(rows)
+    bimbi = np.fromiter((int(r["invitati_bambini"] or 0) for r in rows), dtype=np.int64, count=n)
+    adulti = np.fromiter((int(r["invitati_adulti"] or 0) for r in rows), dtype=np.int64, count=n)
+    persone = bimbi + adulti
+
+    packages = list(prices["packages"])
+    package_pos = {name: i for i, name in enumerate(packages)}
+    package_cents = np.array([_cents(prices["packages"][p]) for p in packages] + [0], dtype=np.int64)
+    package_idx = np.fromiter((package_pos.get(r["pacchetto"] or "", len(packages)) for r in rows), dtype=np.int64, count=n)
+    pacchetto = np.fromiter((r["pacchetto"] or "" for r in rows), dtype=object, count=n)
+    experience = pacchetto == "Lullyland Experience"
+    all_inclusive = pacchetto == "Lullyland all-inclusive"
+    torta = np.fromiter((r["torta_choice"] or "" for r in rows), dtype=object, count=n)
+
+    total = package_cents[package_idx] * persone * 100
+
+    # Torta (solo Experience): esterna a persona, interna a kg = persone * KG_PER_PERSON al centesimo
+    total += np.where(experience & (torta == "esterna"), _cents(prices["torta_esterna_eur_per_person"]) * persone * 100, 0)
+    kg_exp = max(0, -KG_PER_PERSON.as_tuple().exponent)
+    kg_units = int(KG_PER_PERSON.scaleb(kg_exp))
+    kg_cent = persone * kg_units
+    kg_cent = _round_half_up(np, kg_cent, 10 ** (kg_exp - 2)) if kg_exp > 2 else kg_cent * 10 ** (2 - kg_exp)
+    total += np.where(experience & (torta == "interna"), _cents(prices["torta_eur_per_kg"]) * kg_cent, 0)
+
+    # Extra: matrice righe x servizi (quante volte compare la chiave) per i due cataloghi
+    keys = list({**prices["extras"], **prices["extras_all_inclusive"]})
+    key_pos = {k: i for i, k in enumerate(keys)}
+    counts = np.zeros((n, len(keys)), dtype=np.int64)
+    for i, r in enumerate(rows):
+        for k in (r["extra_keys_csv"] or "").split(","):
+            if k in key_pos:
+                counts[i, key_pos[k]] += 1
+    regular = np.array([_cents(prices["extras"][k][1]) if k in prices["extras"] else 0 for k in keys], dtype=np.int64)
+    inclusive = np.array([_cents(prices["extras_all_inclusive"][k][1]) if k in prices["extras_all_inclusive"] else 0
+                          for k in keys], dtype=np.int64)
+    total += np.where(all_inclusive, counts @ inclusive, counts @ regular) * 100
+
+    return _round_half_up(np, total, 100)
+
+
+def reprice_bookings(date_from: str, price_list_id: int = None, apply: bool = False, check: bool = False) -> dict:
+    """Ricalcola i totali delle prenotazioni con evento da date_from in poi.
+
+    Senza price_list_id ogni prenotazione usa il listino in vigore per la sua data; con un
+    id si simula quel listino su tutte (what-if, mai applicato). apply=True salva totale,
+    listino e testo del contratto delle sole prenotazioni cambiate; quelle modificate nel
+    frattempo (row_version diverso) si saltano e restano contate in "changes".
+    """
+    conn = get_db()
+    rows = conn.execute(
+        f"SELECT {REPRICE_COLUMNS} FROM bookings WHERE event_date >= ? ORDER BY event_date, id", (date_from,)
+    ).fetchall()
+    lists = {lid: prices for lid, _, prices in price_lists(conn)}
+    if price_list_id is not None and price_list_id not in lists:
+        conn.close()
+        raise ValueError(f"Listino #{price_list_id} inesistente")
+
+    groups = {}
+    for r in rows:
+        lid = price_list_id if price_list_id is not None else price_list_for(conn, r["event_date"])[0]
+        groups.setdefault(lid, []).append(r)
+
+    changes = []
+    old_sum = new_sum = 0
+    mismatches = 0
+    for lid, group in groups.items():
+        prices = lists.get(lid, DEFAULT_PRICE_LIST)
+        totals = vectorized_totals(group, prices)
+        for r, cents in zip(group, totals.tolist()):
+            old = _cents(Decimal(r["totale_stimato_eur"] or "0"))
+            old_sum += old
+            new_sum += cents
+            if check and Decimal(cents) / 100 != compute_totals(payload_from_row(r), prices)["totale"]:
+                mismatches += 1
+            if cents != old or r["price_list_id"] != lid:
+                changes.append((r["id"], r["event_date"], old, cents, lid, r["row_version"]))
+
+    if apply and price_list_id is None and changes:
+        for i in range(0, len(changes), REPRICE_APPLY_ROWS):
+            chunk = changes[i:i + REPRICE_APPLY_ROWS]
+            full = {
+                r["id"]: r
+                for r in conn.execute(f"SELECT * FROM bookings WHERE id IN ({','.join('?' * len(chunk))})", [c[0] for c in chunk])
+            }
+            # Testi dei contratti calcolati prima di prendere il lock di scrittura. La versione è
+            # quella letta col calcolo: una modifica arrivata dopo fa saltare la riga
+            updates = [
+                (str(Decimal(cents) / 100), lid, build_contract_text(payload_from_row(full[bid]), lists.get(lid, DEFAULT_PRICE_LIST)),
+                 actor_stamp(), bid, version)
+                for bid, _, _, cents, lid, version in chunk if bid in full
+            ]
+            with conn:
+                conn.executemany(
+                    "UPDATE bookings SET totale_stimato_eur = ?, price_list_id = ?, dettagli_contratto_text = ?, last_actor = ? "
+                    "WHERE id = ? AND row_version = ?",
+                    updates,
+                )
+    conn.close()
+    return {
+        "bookings": len(rows), "changes": changes, "old_cents": old_sum, "new_cents": new_sum,
+        "mismatches": mismatches if check else None,
+    }
 
-        pacchetto = (request.form.get("pacchetto") or "").strip()
 
-        confirm_area3 = (request.form.get("confirm_area3") == "on")
-        if slot_count(conn, event_date, slot_code) >= 2 and not confirm_area3:
-            conn.close()
-            return render_form("Area 1 e 2 sono già impegnate. Se vuoi inserire comunque, conferma Area 3.", request.form)
+@app.cli.command("reprice")
+@click.option("--from", "date_from", default=None, help="Eventi da questa data (default: oggi).")
+@click.option("--price-list", "price_list_id", default=None, type=int, help="Simula questo listino su tutte (what-if).")
+@click.option("--apply", is_flag=True, help="Salva i nuovi totali (solo coi listini in vigore).")
+@click.option("--check", is_flag=True, help="Confronta ogni totale con compute_totals.")
+def reprice_command(date_from, price_list_id, apply, check):
+    """Ricalcola in blocco i totali delle prenotazioni future coi listini datati."""
+    if apply and price_list_id is not None:
+        raise click.UsageError("--apply non si usa con --price-list: un what-if non si salva.")
+    t0 = time.monotonic()
+    res = reprice_bookings(date_from or date.today().isoformat(), price_list_id, apply=apply, check=check)
+    click.echo(
+        f"{res['bookings']} prenotazioni in {time.monotonic() - t0:.2f}s, {len(res['changes'])} con totale o listino diverso. "
+        f"Totale EUR {eur(Decimal(res['old_cents']) / 100)} -> {eur(Decimal(res['new_cents']) / 100)}"
+        + (" (salvati)" if apply else "")
+    )
+    if check:
+        click.echo(f"Differenze rispetto a compute_totals: {res['mismatches']}")
 
-        extra_keys = []
-        if pacchetto == "Lullyland all-inclusive":
-            for k in EXTRA_SERVIZI_ALL_INCLUSIVE.keys():
-                if request.form.get(f"extra_{k}"):
-                    extra_keys.append(k)
-        else:
-            for k in EXTRA_SERVIZI.keys():
-                if request.form.get(f"extra_{k}"):
-                    extra_keys.append(k)
 
-        # IMPORTANT: alcuni campi hanno lo stesso name in sezioni diverse (Experience vs All-inclusive).
-        # - lato client: disabilitiamo i campi delle sezioni nascoste (vedi JS)
-        # - lato server: per sicurezza prendiamo l'ULTIMO valore non-vuoto quando arrivano più valori
-        catering_baby_choice = last_nonempty(request.form.getlist("catering_baby_choice"))
+# -------------------------
+# Rigenerazione contratti in blocco (dopo modifiche al testo o alle regole)
+# -------------------------
+# Testo e totale si ricalcolano nei processi del pool (sola lettura), il processo principale
+# scrive a blocchi; poi i PDF dei blocchi scritti si generano nel pool e finiscono tra i
+# risultati dei lavori, dove /contratto.pdf li ritrova per impronta. Dopo ogni blocco si
+# salva l'ultimo id completato: un'interruzione riparte da lì con gli stessi filtri.
+REGEN_CHUNK_ROWS = 100
+REGEN_PDF_FILENAME = "contratto_prenotazione_{id}.pdf"
 
-        payload = {
-            "created_at": datetime.now().isoformat(timespec="seconds"),
-            "nome_festeggiato": (request.form.get("nome_festeggiato") or "").strip(),
-            "eta_festeggiato": to_int(request.form.get("eta_festeggiato")),
-            "data_compleanno": (request.form.get("data_compleanno") or "").strip(),
-            "data_evento": event_date,
-            "madre_nome_cognome": (request.form.get("madre_nome_cognome") or "").strip(),
-            "madre_telefono": (request.form.get("madre_telefono") or "").strip(),
-            "padre_nome_cognome": (request.form.get("padre_nome_cognome") or "").strip(),
-            "padre_telefono": (request.form.get("padre_telefono") or "").strip(),
-            "indirizzo_residenza": (request.form.get("indirizzo_residenza") or "").strip(),
-            "email": (request.form.get("email") or "").strip(),
-            "invitati_bambini": to_int(request.form.get("invitati_bambini")),
-            "invitati_adulti": to_int(request.form.get("invitati_adulti")),
-            "pacchetto": pacchetto,
-            "tema_evento": (request.form.get("tema_evento") or "").strip(),
-            "note": (request.form.get("note") or "").strip(),
-            "data_firma": data_firma,
-            "firma_png_base64": firma_png_base64,
-            "consenso_privacy": consenso_privacy,
-            "consenso_foto": consenso_foto,
-            "acconto_eur": (request.form.get("acconto_eur") or "").strip(),
-            "pacchetto_personalizzato_dettagli": (request.form.get("pacchetto_personalizzato_dettagli") or "").strip(),
-            "catering_baby_choice": (catering_baby_choice or "").strip(),
-            "dessert_bimbi_choice": (request.form.get("dessert_bimbi_choice") or "").strip(),
-            "dessert_adulti_choice": (request.form.get("dessert_adulti_choice") or "").strip(),
-            "torta_choice": (request.form.get("torta_choice") or "").strip(),
-            "torta_interna_choice": first_nonempty(request.form.getlist("torta_interna_choice")),
-            "torta_gusto_altro": first_nonempty(request.form.getlist("torta_gusto_altro")),
-            "extra_keys": extra_keys,
-        }
 
-        if not payload["nome_festeggiato"]:
-            conn.close()
-            return render_form("Inserisci il nome del festeggiato.", request.form)
+def regen_contract_chunk(booking_ids: list) -> list:
+    """Nel pool: (id, row_version, testo, totale) delle prenotazioni il cui contratto è cambiato."""
+    conn = get_db()
+    try:
+        out = []
+        placeholders = ",".join("?" * len(booking_ids))
+        for row in conn.execute(f"SELECT * FROM bookings WHERE id IN ({placeholders})", booking_ids):
+            payload = payload_from_row(row)
+            prices = booking_prices(conn, row)
+            text = build_contract_text(payload, prices)
+            total = str(compute_totals(payload, prices)["totale"])
+            if text != row["dettagli_contratto_text"] or total != row["totale_stimato_eur"]:
+                out.append((row["id"], row["row_version"], text, total))
+        return out
+    finally:
+        conn.close()
 
-        if payload["pacchetto"] not in PACKAGE_LABELS:
-            conn.close()
-            return render_form("Seleziona un pacchetto valido.", request.form)
 
-        if payload["pacchetto"] == "Personalizzato" and not payload["pacchetto_personalizzato_dettagli"]:
-            conn.close()
-            return render_form("Hai scelto Personalizzato: inserisci i dettagli.", request.form)
+def regen_pdf_chunk(booking_ids: list) -> list:
+    """Nel pool: genera i PDF che mancano nella cache dei lavori; ritorna (id, dedupe_key, path)."""
+    os.makedirs(jobs_dir(), exist_ok=True)
+    conn = get_db()
+    try:
+        out = []
+        placeholders = ",".join("?" * len(booking_ids))
+        for row in conn.execute(f"SELECT * FROM bookings WHERE id IN ({placeholders})", booking_ids):
+            dedupe_key = f"contract_pdf:{row['id']}:{contract_pdf_fingerprint(row)}"
+            cached = conn.execute(
+                "SELECT result_path FROM jobs WHERE dedupe_key = ? AND status = 'done' ORDER BY id DESC LIMIT 1",
+                (dedupe_key,),
+            ).fetchone()
+            if cached and cached["result_path"] and os.path.exists(cached["result_path"]):
+                continue
+            path = os.path.abspath(os.path.join(jobs_dir(), f"regen_{row['id']}_{dedupe_key.rsplit(':', 1)[1]}.pdf"))
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(build_contract_pdf_bytes(row).getvalue())
+            os.replace(f"{path}.tmp", path)
+            out.append((row["id"], dedupe_key, path))
+        return out
+    finally:
+        conn.close()
 
-        if payload["pacchetto"] == "Lullyland Experience":
-            cb = payload["catering_baby_choice"]
-            if cb not in CATERING_BABY_OPTIONS:
-                conn.close()
-                return render_form("Per Experience scegli Catering baby (Menu pizza o Box merenda).", request.form)
 
-            tc = payload["torta_choice"]
-            if tc not in ("esterna", "interna"):
-                conn.close()
-                return render_form("Per Experience scegli torta: Esterna (+EUR 1 a persona) oppure Interna (EUR 24/kg).", request.form)
-
-            if tc == "interna":
-                ti = payload["torta_interna_choice"]
-                if ti not in ("standard", "altro"):
-                    conn.close()
-                    return render_form("Se hai scelto torta interna, seleziona Classica o Altro.", request.form)
-                if ti == "altro" and not payload["torta_gusto_altro"]:
-                    conn.close()
-                    return render_form("Hai scelto Altro: scrivi il gusto della torta.", request.form)
-
-        if payload["pacchetto"] == "Lullyland all-inclusive":
-            if payload["dessert_bimbi_choice"] and payload["dessert_bimbi_choice"] not in ("muffin_nutella", "torta_compleanno"):
-                conn.close()
-                return render_form("All-inclusive: dessert bimbi non valido.", request.form)
-            if payload["dessert_adulti_choice"] and payload["dessert_adulti_choice"] not in ("muffin_nutella", "torta_compleanno"):
-                conn.close()
-                return render_form("All-inclusive: dessert adulti non valido.", request.form)
-
-            need_torta = (payload["dessert_bimbi_choice"] == "torta_compleanno") or (payload["dessert_adulti_choice"] == "torta_compleanno")
-            if need_torta:
-                payload["torta_choice"] = "interna"  # sempre interna e inclusa
-                if payload["torta_interna_choice"] and payload["torta_interna_choice"] not in ("standard", "altro"):
-                    conn.close()
-                    return render_form("All-inclusive: scelta torta non valida.", request.form)
-            else:
-                payload["torta_choice"] = ""
-                payload["torta_interna_choice"] = ""
-                payload["torta_gusto_altro"] = ""
+def regenerate_contracts(date_from: str, date_to: str = None, packages=(), with_pdf: bool = True,
+                         workers: int = JOBS_CONCURRENCY, chunk_rows: int = REGEN_CHUNK_ROWS,
+                         restart: bool = False, progress=None) -> dict:
+    """Rigenera testo contratto, totale ed eventualmente PDF delle prenotazioni selezionate.
 
-        totals = compute_totals(payload)
-        contract_text = build_contract_text(payload)
-        area = next_area(conn, event_date, slot_code)
+    Riprende dall'ultimo checkpoint della stessa selezione, salvo restart=True. Le
+    prenotazioni modificate nel frattempo (row_version cambiato) non si toccano: il
+    salvataggio della modifica ha già ricalcolato testo e totale.
+    """
+    params = {"from": date_from, "to": date_to or "", "packages": sorted(packages), "pdf": with_pdf}
+    run_key = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    now = datetime.now().isoformat(timespec="seconds")
 
+    conn = get_db()
+    cp = conn.execute("SELECT * FROM regen_checkpoints WHERE run_key = ?", (run_key,)).fetchone()
+    if restart or not cp or cp["finished_at"]:
         conn.execute(
+            "INSERT OR REPLACE INTO regen_checkpoints (run_key, params_json, started_at, updated_at) VALUES (?, ?, ?, ?)",
+            (run_key, json.dumps(params), now, now),
+        )
+        conn.commit()
+        cp = conn.execute("SELECT * FROM regen_checkpoints WHERE run_key = ?", (run_key,)).fetchone()
+    stats = {"resumed_from": cp["last_id"], "resumed_processed": cp["processed"], "processed": cp["processed"],
+             "updated": cp["updated"], "pdfs": cp["pdfs"], "conflicts": 0}
+
+    where, args = ["event_date >= ?", "id > ?"], [date_from, cp["last_id"]]
+    if date_to:
+        where.append("event_date <= ?")
+        args.append(date_to)
+    if packages:
+        where.append(f"pacchetto IN ({','.join('?' * len(packages))})")
+        args.extend(packages)
+    ids = [r["id"] for r in conn.execute(f"SELECT id FROM bookings WHERE {' AND '.join(where)} ORDER BY id", args)]
+    chunks = [ids[i:i + chunk_rows] for i in range(0, len(ids), chunk_rows)]
+    stats["selected"] = len(ids)
+
+    def checkpoint(chunk, pdf_rows):
+        finished = datetime.now().isoformat(timespec="seconds")
+        conn.executemany(
             """
-            INSERT INTO bookings (
-                created_at,
-                nome_festeggiato, eta_festeggiato, data_compleanno, data_evento,
-                madre_nome_cognome, madre_telefono,
-                padre_nome_cognome, padre_telefono,
-                indirizzo_residenza, email,
-                invitati_bambini, invitati_adulti,
-                pacchetto, tema_evento, note,
-                data_firma, firma_png_base64,
-                consenso_privacy, consenso_foto,
-                acconto_eur,
-                pacchetto_personalizzato_dettagli,
-                catering_baby_choice,
-                dessert_bimbi_choice,
-                dessert_adulti_choice,
-                torta_choice, torta_interna_choice, torta_gusto_altro,
-                extra_keys_csv,
-                totale_stimato_eur,
-                dettagli_contratto_text,
-                event_date, slot_code, start_time, end_time, area
-            ) VALUES (
-                :created_at,
-                :nome_festeggiato, :eta_festeggiato, :data_compleanno, :data_evento,
-                :madre_nome_cognome, :madre_telefono,
-                :padre_nome_cognome, :padre_telefono,
-                :indirizzo_residenza, :email,
-                :invitati_bambini, :invitati_adulti,
-                :pacchetto, :tema_evento, :note,
-                :data_firma, :firma_png_base64,
-                :consenso_privacy, :consenso_foto,
-                :acconto_eur,
-                :pacchetto_personalizzato_dettagli,
-                :catering_baby_choice,
-                :dessert_bimbi_choice,
-                :dessert_adulti_choice,
-                :torta_choice, :torta_interna_choice, :torta_gusto_altro,
-                :extra_keys_csv,
-                :totale_stimato_eur,
-                :dettagli_contratto_text,
-                :event_date, :slot_code, :start_time, :end_time, :area
-            )
+            INSERT INTO jobs (kind, params_json, dedupe_key, status, attempts, max_attempts, run_after, created_at,
+                              started_at, finished_at, worker, result_path, result_mimetype, result_filename)
+            VALUES ('contract_pdf', ?, ?, 'done', 1, 1, ?, ?, ?, ?, 'regenerate-contracts', ?, 'application/pdf', ?)
             """,
-            {
-                **payload,
-                "extra_keys_csv": ",".join(payload["extra_keys"]),
-                "totale_stimato_eur": str(totals["totale"]),
-                "dettagli_contratto_text": contract_text,
-                "event_date": event_date,
-                "slot_code": slot_code,
-                "start_time": slot["start"],
-                "end_time": slot["end"],
-                "area": area,
-            },
+            [(json.dumps({"booking_id": bid}), key, time.time(), finished, finished, finished, path,
+              REGEN_PDF_FILENAME.format(id=bid)) for bid, key, path in pdf_rows],
+        )
+        stats["processed"] += len(chunk)
+        stats["pdfs"] += len(pdf_rows)
+        conn.execute(
+            "UPDATE regen_checkpoints SET last_id = ?, processed = ?, updated = ?, pdfs = ?, updated_at = ? WHERE run_key = ?",
+            (chunk[-1], stats["processed"], stats["updated"], stats["pdfs"], finished, run_key),
         )
         conn.commit()
-        conn.close()
-        return redirect(url_for("day_view", date_iso=event_date))
+        if progress:
+            progress(stats)
 
-    conn.close()
-    return render_template_string(
-        BOOKING_HTML,
-        app_name=APP_NAME,
-        error=None,
-        today=datetime.now().strftime("%Y-%m-%d"),
-        form={},
-        package_labels=PACKAGE_LABELS,
-        dessert_options=DESSERT_OPTIONS,
-        torta_interna_flavors=TORTA_INTERNA_FLAVORS,
-        extra_servizi=EXTRA_SERVIZI,
-        extra_servizi_ai=EXTRA_SERVIZI_ALL_INCLUSIVE,
-        event_date=event_date,
-        slot=slot,
-        is_full=is_full,
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            pending_pdf = []  # (chunk, future) in ordine di id: il checkpoint avanza solo sul prefisso completato
+            for chunk, changes in zip(chunks, pool.map(regen_contract_chunk, chunks)):
+                for booking_id, version, text, total in changes:
+                    cur = conn.execute(
+                        "UPDATE bookings SET dettagli_contratto_text = ?, totale_stimato_eur = ?, last_actor = ? "
+                        "WHERE id = ? AND row_version = ?",
+                        (text, total, actor_stamp(), booking_id, version),
+                    )
+                    stats["updated" if cur.rowcount else "conflicts"] += 1
+                if not with_pdf:
+                    checkpoint(chunk, [])
+                    continue
+                conn.commit()
+                pending_pdf.append((chunk, pool.submit(regen_pdf_chunk, chunk)))
+                while pending_pdf and (pending_pdf[0][1].done() or len(pending_pdf) > 2 * workers):
+                    done_chunk, fut = pending_pdf.pop(0)
+                    checkpoint(done_chunk, fut.result())
+            for done_chunk, fut in pending_pdf:
+                checkpoint(done_chunk, fut.result())
+        conn.execute("UPDATE regen_checkpoints SET finished_at = ? WHERE run_key = ?",
+                     (datetime.now().isoformat(timespec="seconds"), run_key))
+        conn.commit()
+    finally:
+        conn.close()
+    return stats
+
+
+@app.cli.command("regenerate-contracts")
+@click.option("--from", "date_from", default=None, help="Eventi da questa data (default: oggi).")
+@click.option("--to", "date_to", default=None, help="Eventi fino a questa data.")
+@click.option("--package", "packages", multiple=True, type=click.Choice(list(PACKAGE_LABELS)), help="Solo questi pacchetti (ripetibile).")
+@click.option("--no-pdf", is_flag=True, help="Rigenera solo testo e totale, non i PDF.")
+@click.option("--workers", default=JOBS_CONCURRENCY, show_default=True, help="Processi in parallelo.")
+@click.option("--chunk", "chunk_rows", default=REGEN_CHUNK_ROWS, show_default=True, help="Prenotazioni per blocco (commit e checkpoint).")
+@click.option("--restart", is_flag=True, help="Ignora il checkpoint e ricomincia da capo.")
+def regenerate_contracts_command(date_from, date_to, packages, no_pdf, workers, chunk_rows, restart):
+    """Rigenera contratti (testo, totale, PDF) delle prenotazioni future dopo una modifica alle regole."""
+    t0 = time.monotonic()
+    last_echo = [0.0]
+
+    def progress(stats):
+        elapsed = time.monotonic() - t0
+        if elapsed - last_echo[0] >= 5:
+            last_echo[0] = elapsed
+            done = stats["processed"] - stats["resumed_processed"]
+            click.echo(f"  {done}/{stats['selected']} · {done / elapsed:.1f} prenotazioni/s · "
+                       f"{stats['updated']} aggiornate · {stats['pdfs']} PDF")
+
+    stats = regenerate_contracts(date_from or date.today().isoformat(), date_to, packages, with_pdf=not no_pdf,
+                                 workers=workers, chunk_rows=max(1, chunk_rows), restart=restart, progress=progress)
+    elapsed = time.monotonic() - t0
+    if stats["resumed_from"]:
+        click.echo(f"Ripreso dal checkpoint (dopo la prenotazione #{stats['resumed_from']}).")
+    click.echo(
+        f"{stats['selected']} prenotazioni in {elapsed:.1f}s ({stats['selected'] / elapsed if elapsed else 0:.1f}/s): "
+        f"{stats['updated']} aggiornate, {stats['pdfs']} PDF generati"
+        + (f", {stats['conflicts']} saltate perché modificate nel frattempo" if stats["conflicts"] else "")
     )
 
-@app.route("/prenotazioni")
-def prenotazioni():
+
+@app.route("/listini", methods=["GET", "POST"])
+def listini():
     if not is_logged_in():
         return redirect(url_for("login"))
+
     conn = get_db()
-    rows = conn.execute(
-        """
-        SELECT id, created_at, nome_festeggiato, data_evento, pacchetto,
-               invitati_bambini, invitati_adulti, totale_stimato_eur,
-               event_date, slot_code, area
-        FROM bookings
-        ORDER BY id DESC
-        """
-    ).fetchall()
+    lists = price_lists(conn)
+    latest = lists[-1][2] if lists else DEFAULT_PRICE_LIST
+
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "create":
+            try:
+                valid_from = datetime.strptime(request.form.get("valid_from") or "", "%Y-%m-%d").date().isoformat()
+
+                def price(field, current):
+                    raw = (request.form.get(field) or "").strip().replace(",", ".")
+                    value = Decimal(raw) if raw else current
+                    if value < 0:
+                        raise ValueError(field)
+                    return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+                prices = {
+                    "packages": {k: price(f"pkg_{i}", v) for i, (k, v) in enumerate(latest["packages"].items())},
+                    "torta_eur_per_kg": price("torta_eur_per_kg", latest["torta_eur_per_kg"]),
+                    "torta_esterna_eur_per_person": price("torta_esterna_eur_per_person", latest["torta_esterna_eur_per_person"]),
+                    "extras": {k: (name, price(f"extra_{k}", v)) for k, (name, v) in latest["extras"].items()},
+                    "extras_all_inclusive": {k: (name, price(f"extra_ai_{k}", v))
+                                             for k, (name, v) in latest["extras_all_inclusive"].items()},
+                }
+            except Exception:
+                conn.close()
+                abort(400, "Listino non valido: controlla data e prezzi.")
+            conn.execute(
+                "INSERT INTO price_lists (valid_from, created_at, note, data_json) VALUES (?,?,?,?)",
+                (valid_from, datetime.now().isoformat(timespec="seconds"), (request.form.get("note") or "").strip(),
+                 price_list_to_json(prices)),
+            )
+            conn.commit()
+            conn.close()
+            return redirect(url_for("listini"))
+        if action == "apply":
+            if jobs_worker_alive(conn):
+                job_id = enqueue_job(conn, "reprice_bookings", {"date_from": date.today().isoformat()})
+                conn.close()
+                return redirect(url_for("job_status", job_id=job_id))
+            conn.close()
+            res = reprice_bookings(date.today().isoformat(), apply=True)
+            return redirect(url_for("listini", applied=len(res["changes"])))
+        conn.close()
+        abort(400, "Azione non valida.")
     conn.close()
-    return render_template_string(LIST_HTML, app_name=APP_NAME, rows=rows)
 
-@app.route("/prenotazioni/<int:booking_id>")
-def prenotazione_dettaglio(booking_id: int):
-    if not is_logged_in():
-        return redirect(url_for("login"))
+    preview_html = ""
+    preview_id = to_int(request.args.get("preview"))
+    if preview_id:
+        try:
+            res = reprice_bookings(date.today().isoformat(), preview_id)
+        except ValueError as e:
+            abort(400, str(e))
+        diff_rows = "".join(
+            f"<tr><td><a href='{url_for('prenotazione_dettaglio', booking_id=bid)}'>#{bid}</a></td><td>{ev}</td>"
+            f"<td>{eur(Decimal(old) / 100)}</td><td>{eur(Decimal(new) / 100)}</td></tr>"
+            for bid, ev, old, new, _, _ in res["changes"][:50]
+        )
+        preview_html = f"""
+          <div class="eventline">
+            <b>Simulazione listino #{preview_id} sugli eventi da oggi</b>
+            <div class="muted">{res['bookings']} prenotazioni · {len(res['changes'])} cambierebbero ·
+              totale EUR {eur(Decimal(res['old_cents']) / 100)} → {eur(Decimal(res['new_cents']) / 100)}</div>
+            <table style="margin-top:8px;"><tr><th>#</th><th>Evento</th><th>Ora EUR</th><th>Con listino EUR</th></tr>{diff_rows}</table>
+          </div>
+        """
+
+    rows_html = "".join(
+        f"""<div class="eventline row">
+              <b>#{lid}</b> in vigore dal {valid_from}
+              <span class="muted">{', '.join(f'{k} {eur(v)}' for k, v in p['packages'].items() if v)}</span>
+              <a class="btn" href="{url_for('listini', preview=lid)}">Simula</a>
+            </div>"""
+        for lid, valid_from, p in reversed(lists)
+    )
+
+    def field(name, label, value):
+        return f"<label>{label} <input name='{name}' value='{eur(value)}' inputmode='decimal' style='width:80px'></label>"
+
+    form_fields = "".join(field(f"pkg_{i}", k, v) for i, (k, v) in enumerate(latest["packages"].items()))
+    form_fields += field("torta_eur_per_kg", "Torta EUR/kg", latest["torta_eur_per_kg"])
+    form_fields += field("torta_esterna_eur_per_person", "Servizio torta esterna", latest["torta_esterna_eur_per_person"])
+    form_fields += "".join(field(f"extra_{k}", name, v) for k, (name, v) in latest["extras"].items())
+    form_fields += "".join(field(f"extra_ai_{k}", f"{name} (all-inclusive)", v)
+                           for k, (name, v) in latest["extras_all_inclusive"].items())
+    applied = request.args.get("applied")
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Listini</title>
+{BASE_CSS}
+</head><body>
+{topbar('prices')}
+<div class="card">
+  <h2 style="margin:0 0 10px;">Listini prezzi</h2>
+  <div class="muted">Ogni prenotazione usa il listino in vigore alla data dell'evento. I listini non si modificano: se ne crea uno nuovo.</div>
+  {f"<p><b>Ricalcolo fatto: {applied} prenotazioni aggiornate.</b></p>" if applied else ""}
+  {preview_html}
+  {rows_html}
+  <form method="post" style="margin-top:10px;">
+    <input type="hidden" name="action" value="apply">
+    <button class="btn" type="submit">Ricalcola le prenotazioni future coi listini in vigore</button>
+  </form>
+</div>
+<div class="card" style="margin-top:12px;">
+  <h2 style="margin:0 0 10px;">Nuovo listino</h2>
+  <form method="post" class="row">
+    <input type="hidden" name="action" value="create">
+    <label>In vigore dal <input type="date" name="valid_from" required></label>
+    <input name="note" placeholder="Nota">
+    {form_fields}
+    <button class="btn primary" type="submit">Salva listino</button>
+  </form>
+</div>
+</body></html>
+"""
+
+
+# -------------------------
+# Statistiche: ricavi, gruppi, pacchetti e occupazione (dai rollup)
+# -------------------------
+# La dashboard legge solo stats_monthly e stats_daily, tenuti aggiornati dai trigger
+# (stats_trigger_sql). La capienza per l'utilizzo viene dalle regole slot attuali.
+def rebuild_stats(conn):
+    """Ricostruisce i rollup da zero (tabella calda + archivi): primo avvio o `flask rebuild-stats`."""
+    archived = [r["archive_year"] for r in conn.execute("SELECT DISTINCT archive_year FROM archived_bookings")]
+    schemas = [s for s in (attach_archive(conn, y) for y in sorted(archived)) if s]
+    cols = "event_date, pacchetto, slot_code, invitati_bambini, invitati_adulti, totale_stimato_eur"
+    source = " UNION ALL ".join(f"SELECT {cols} FROM {s}.bookings WHERE event_date IS NOT NULL" for s in ["main", *schemas])
+    try:
+        with conn:
+            conn.execute("DELETE FROM stats_monthly")
+            conn.execute("DELETE FROM stats_daily")
+            conn.execute(
+                f"""
+                INSERT INTO stats_monthly (month, pacchetto, slot_code, weekend, eventi, bimbi, adulti, ricavo_cent)
+                SELECT substr(event_date, 1, 7), COALESCE(pacchetto, ''), COALESCE(slot_code, ''),
+                       strftime('%w', event_date) IN ('0', '6'), COUNT(*),
+                       SUM(COALESCE(invitati_bambini, 0)), SUM(COALESCE(invitati_adulti, 0)),
+                       SUM(CAST(ROUND(COALESCE(CAST(totale_stimato_eur AS REAL), 0) * 100) AS INTEGER))
+                FROM ({source}) GROUP BY 1, 2, 3, 4
+                """
+            )
+            conn.execute(
+                f"INSERT INTO stats_daily (day, slot_code, eventi) "
+                f"SELECT event_date, COALESCE(slot_code, ''), COUNT(*) FROM ({source}) GROUP BY 1, 2"
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO stats_meta (id, built_at) VALUES (1, ?)",
+                (datetime.now().isoformat(timespec="seconds"),),
+            )
+    finally:
+        for s in schemas:
+            detach_archive(conn, s)
+
+
+def ensure_stats(conn):
+    if not conn.execute("SELECT 1 FROM stats_meta WHERE id = 1").fetchone():
+        rebuild_stats(conn)
+
 
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Ricalcola da zero i rollup delle statistiche."""
     conn = get_db()
-    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    rebuild_stats(conn)
+    n = conn.execute("SELECT COALESCE(SUM(eventi), 0) AS n FROM stats_monthly").fetchone()["n"]
     conn.close()
-    if not row:
-        abort(404)
+    click.echo(f"Rollup ricostruiti: {n} eventi.")
 
-    invitati_b = int(row["invitati_bambini"] or 0)
-    invitati_a = int(row["invitati_adulti"] or 0)
-    tot_persone = invitati_b + invitati_a
 
-    torta_info = "-"
-    if row["pacchetto"] == "Lullyland Experience":
-        tc = (row["torta_choice"] or "").strip()
-        if tc == "interna":
-            torta_kg = (Decimal(tot_persone) * KG_PER_PERSON).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            torta_info = f"{tot_persone} persone -> ~ {torta_kg} kg (100g a testa) a EUR {eur(TORTA_PRICE_EUR_PER_KG)}/kg"
-        elif tc == "esterna":
-            svc_tot = (TORTA_ESTERNASVC_EUR_PER_PERSON * Decimal(tot_persone)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            torta_info = f"{tot_persone} persone -> Servizio torta: EUR {eur(TORTA_ESTERNASVC_EUR_PER_PERSON)} x {tot_persone} = EUR {eur(svc_tot)}"
-    elif row["pacchetto"] == "Lullyland all-inclusive":
-        need_torta = (row["dessert_bimbi_choice"] == "torta_compleanno") or (row["dessert_adulti_choice"] == "torta_compleanno")
-        if need_torta:
-            ti = (row["torta_interna_choice"] or "").strip()
-            if ti == "standard":
-                torta_info = f"Torta interna (inclusa) - {TORTA_INTERNA_FLAVORS['standard']}"
-            elif ti == "altro":
-                gust = (row["torta_gusto_altro"] or "").strip() or "(da compilare)"
-                torta_info = f"Torta interna (inclusa) - Gusto: {gust}"
-            else:
-                torta_info = "Torta interna (inclusa) - (da definire)"
-        else:
-            torta_info = "-"
+def slot_capacity_by_month(year: int) -> dict:
+    """{mese: [capienza feriale, capienza weekend]} in eventi (slot x aree normali)."""
+    capacity = slot_capacity()
+    out = {mm: [0, 0] for mm in range(1, 13)}
+    d = date(year, 1, 1)
+    while d.year == year:
+        out[d.month][1 if d.weekday() >= 5 else 0] += len(slots_for_date(d)) * capacity
+        d += timedelta(days=1)
+    return out
 
-    return render_template_string(DETAIL_HTML, app_name=APP_NAME, b=row, torta_info=torta_info)
 
-@app.route("/prenotazioni/<int:booking_id>/contratto.pdf")
-def prenotazione_contratto_pdf(booking_id: int):
+def occupancy_heatmap(conn) -> tuple:
+    """(anni, matrice anni x 53 settimane di occupazione 0..1) da una matrice giorno x slot NumPy."""
+    try:
+        import numpy as np
+    except Exception as e:
+        raise RuntimeError("Per la mappa di occupazione serve la libreria 'numpy'. Installala con: pip install numpy") from e
+
+    r = conn.execute("SELECT MIN(day) AS lo, MAX(day) AS hi FROM stats_daily WHERE eventi > 0").fetchone()
+    if not r["lo"]:
+        return [], np.zeros((0, 53))
+    years = list(range(int(r["lo"][:4]), int(r["hi"][:4]) + 1))
+    codes = [code for code, _ in SLOT_CALENDAR.slot_choices(include_inactive=True)]
+    code_pos = {code: i for i, code in enumerate(codes)}
+    events = np.zeros((len(years), 371, len(codes)), dtype=np.int32)   # 371 = 53 settimane x 7 giorni
+    capacity = np.zeros_like(events)
+
+    for row in conn.execute("SELECT day, slot_code, eventi FROM stats_daily WHERE eventi > 0"):
+        d = date.fromisoformat(row["day"])
+        if row["slot_code"] in code_pos:
+            events[d.year - years[0], d.timetuple().tm_yday - 1, code_pos[row["slot_code"]]] += row["eventi"]
+
+    areas = slot_capacity()
+    for yi, year in enumerate(years):
+        d = date(year, 1, 1)
+        while d.year == year:
+            for s in slots_for_date(d):
+                if s["code"] in code_pos:
+                    capacity[yi, d.timetuple().tm_yday - 1, code_pos[s["code"]]] = areas
+            d += timedelta(days=1)
+
+    weekly_events = events.sum(axis=2).reshape(len(years), 53, 7).sum(axis=2)
+    weekly_capacity = capacity.sum(axis=2).reshape(len(years), 53, 7).sum(axis=2)
+    occupancy = np.divide(weekly_events, weekly_capacity, out=np.zeros(weekly_events.shape), where=weekly_capacity > 0)
+    return years, np.clip(occupancy, 0, 1)
+
+
+@app.route("/statistiche")
+def statistiche():
     if not is_logged_in():
         return redirect(url_for("login"))
 
+    today = date.today()
+    y = to_int(request.args.get("y")) or today.year
+
     conn = get_db()
-    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    ensure_stats(conn)
+    rows = conn.execute(
+        """
+        SELECT month, pacchetto, weekend, SUM(eventi) AS eventi, SUM(bimbi + adulti) AS ospiti, SUM(ricavo_cent) AS ricavo
+        FROM stats_monthly
+        WHERE month BETWEEN ? AND ? AND eventi <> 0
+        GROUP BY month, pacchetto, weekend
+        """,
+        (f"{y:04d}-01", f"{y:04d}-12"),
+    ).fetchall()
+    theme_rows = conn.execute(
+        "SELECT tema_evento, COUNT(*) AS n FROM bookings WHERE event_date BETWEEN ? AND ? AND tema_evento <> '' GROUP BY tema_evento",
+        (f"{y:04d}-01-01", f"{y:04d}-12-31"),
+    ).fetchall()
+    try:
+        years, heat = occupancy_heatmap(conn)
+        heat_error = None
+    except RuntimeError as e:
+        years, heat, heat_error = [], None, str(e)
     conn.close()
-    if not row:
-        abort(404)
 
-    try:
-        pdf_buf = build_contract_pdf_bytes(row)
-        filename = f"contratto_prenotazione_{booking_id}.pdf"
+    months = {mm: {"eventi": 0, "ospiti": 0, "ricavo": 0, "weekend": 0, "feriale": 0, "pacchetti": {}} for mm in range(1, 13)}
+    packages = set()
+    for r in rows:
+        m = months[int(r["month"][5:7])]
+        m["eventi"] += r["eventi"]
+        m["ospiti"] += r["ospiti"]
+        m["ricavo"] += r["ricavo"]
+        m["weekend" if r["weekend"] else "feriale"] += r["eventi"]
+        pkg = r["pacchetto"] or "-"
+        m["pacchetti"][pkg] = m["pacchetti"].get(pkg, 0) + r["eventi"]
+        packages.add(pkg)
+    packages = sorted(packages)
+    capacity = slot_capacity_by_month(y)
+
+    def pct(n, d):
+        return f"{100 * n / d:.0f}%" if d else "-"
+
+    body = ""
+    tot = {"eventi": 0, "ospiti": 0, "ricavo": 0}
+    for mm, m in months.items():
+        for k in tot:
+            tot[k] += m[k]
+        mix = "".join(f"<td>{pct(m['pacchetti'].get(p, 0), m['eventi'])}</td>" for p in packages)
+        avg = f"{m['ospiti'] / m['eventi']:.1f}" if m["eventi"] else "-"
+        body += (
+            f"<tr><td><b>{month_name[mm]}</b></td><td>{m['eventi']}</td><td>{eur(Decimal(m['ricavo']) / 100)}</td>"
+            f"<td>{avg}</td>{mix}<td>{pct(m['feriale'], capacity[mm][0])}</td><td>{pct(m['weekend'], capacity[mm][1])}</td></tr>"
+        )
+    avg = f"{tot['ospiti'] / tot['eventi']:.1f}" if tot["eventi"] else "-"
+    body += (
+        f"<tr><td><b>Totale</b></td><td><b>{tot['eventi']}</b></td><td><b>{eur(Decimal(tot['ricavo']) / 100)}</b></td>"
+        f"<td><b>{avg}</b></td>" + "<td></td>" * (len(packages) + 2) + "</tr>"
+    )
+    head = "".join(f"<th>{p}</th>" for p in packages)
+
+    themes = {}
+    for r in theme_rows:
+        key = theme_key(r["tema_evento"])
+        if key:
+            themes[key] = themes.get(key, 0) + r["n"]
+    top_themes = sorted(themes.items(), key=lambda kv: -kv[1])[:15]
+    if top_themes:
+        theme_html = "<table class='stats'><tr><th>Tema</th><th>Eventi</th></tr>" + "".join(
+            f"<tr><td>{xml_escape(THEME_INDEX.label(k) or k)}</td><td>{n}</td></tr>" for k, n in top_themes
+        ) + "</table>"
+    else:
+        theme_html = "<p class='muted'>Nessun tema registrato.</p>"
 
-        # Flask >= 2 usa "download_name", Flask < 2 usa "attachment_filename"
+    if heat_error:
+        heat_html = f"<p class='muted'>{heat_error}</p>"
+    elif not years:
+        heat_html = "<p class='muted'>Nessun evento registrato.</p>"
+    else:
+        week_head = "".join(f"<th>{w + 1 if w % 4 == 0 else ''}</th>" for w in range(53))
+        heat_rows = ""
+        for yi, year in enumerate(years):
+            cells = "".join(
+                f"<td title='Sett. {w + 1}: {100 * v:.0f}%' style='background:rgba(220,38,38,{v:.2f})'></td>"
+                for w, v in enumerate(heat[yi].tolist())
+            )
+            heat_rows += f"<tr><td><b>{year}</b></td>{cells}</tr>"
+        heat_html = f"<div style='overflow-x:auto;'><table class='heat'><tr><th></th>{week_head}</tr>{heat_rows}</table></div>"
+
+    return f"""<!doctype html><html><head>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{APP_NAME} – Statistiche</title>
+{BASE_CSS}
+<style>
+  .stats{{border-collapse:collapse;background:#fff;font-size:13px;}}
+  .stats th,.stats td{{border:1px solid #e5e5e5;padding:6px 8px;text-align:right;white-space:nowrap;}}
+  .stats th:first-child,.stats td:first-child{{text-align:left;}}
+  .heat{{border-collapse:collapse;font-size:11px;}}
+  .heat td{{width:12px;height:16px;border:1px solid #f0f0f0;}}
+  .heat th{{font-weight:600;padding:0 2px;}}
+</style>
+</head><body>
+{topbar('stats')}
+<div class="card">
+  <div class="head">
+    <h2 style="margin:0;">Statistiche {y}</h2>
+    <div class="row">
+      <a class="btn" href="{url_for('statistiche', y=y-1)}">← {y-1}</a>
+      <a class="btn" href="{url_for('statistiche', y=y+1)}">{y+1} →</a>
+    </div>
+  </div>
+  <div style="overflow-x:auto;margin-top:10px;">
+    <table class="stats">
+      <tr><th>Mese</th><th>Eventi</th><th>Ricavo EUR</th><th>Media ospiti</th>{head}<th>Utilizzo feriali</th><th>Utilizzo weekend</th></tr>
+      {body}
+    </table>
+  </div>
+  <div class="muted" style="margin-top:8px;">Ricavo = totale stimato delle prenotazioni. Utilizzo = eventi / (slot del periodo x aree normali).</div>
+</div>
+<div class="card" style="margin-top:12px;">
+  <h2 style="margin:0 0 10px;">Temi più richiesti {y}</h2>
+  {theme_html}
+  <div class="muted" style="margin-top:8px;">Grafie diverse dello stesso tema sono contate insieme.</div>
+</div>
+<div class="card" style="margin-top:12px;">
+  <h2 style="margin:0 0 10px;">Occupazione per settimana, anno su anno</h2>
+  {heat_html}
+</div>
+</body></html>
+"""
+
+
+# -------------------------
+# Aggiornamenti live del calendario (Server-Sent Events dal feed booking_changes)
+# -------------------------
+# Un solo thread per worker legge il feed e distribuisce gli eventi a tutti i client
+# collegati. Ogni client SSE occupa una connessione aperta, quindi lo stream resta aperto
+# solo con worker a thread (gunicorn.conf.py: gthread). Con worker sincroni (wsgi.multithread
+# falso) /events risponde subito con le novità e chiude: il browser si ricollega da solo dopo
+# "retry" col Last-Event-ID, cioè polling breve sul contatore di booking_changes.
+SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", "1.0"))
+SSE_PING_SECONDS = 15
+SSE_SHORT_POLL_MS = int(os.getenv("SSE_SHORT_POLL_MS", "10000"))
+
+
+def compact_change_events(conn, rows) -> list:
+    """Un evento per data toccata, con i conteggi aggiornati per slot (quelli che mostrano le pagine)."""
+    by_date = {}
+    for r in rows:
+        if r["event_date"]:
+            by_date[r["event_date"]] = max(by_date.get(r["event_date"], 0), r["seq"])
+
+    events = []
+    for ev_date, seq in sorted(by_date.items(), key=lambda kv: kv[1]):
+        slots = {
+            r["slot_code"]: r["c"]
+            for r in conn.execute(
+                "SELECT slot_code, COUNT(*) AS c FROM bookings WHERE event_date = ? GROUP BY slot_code", (ev_date,)
+            )
+        }
+        events.append({"seq": seq, "date": ev_date, "total": sum(slots.values()), "slots": slots})
+    return events
+
+
+class ChangeFeedBroadcaster:
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self.venue = current_venue()
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue(maxsize=256)
+        with self._lock:
+            self._subs.add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            self._subs.discard(q)
+
+    def _run(self):
+        _VENUE.set(self.venue)  # thread nuovo: contesto vuoto
+        conn = get_db()
+        seq = booking_change_counter(conn)
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                with self._lock:
+                    subs = list(self._subs)
+                if not subs:
+                    seq = booking_change_counter(conn)
+                    continue
+
+                rows = conn.execute(
+                    "SELECT seq, event_date FROM booking_changes WHERE seq > ? ORDER BY seq", (seq,)
+                ).fetchall()
+                if not rows:
+                    continue
+                seq = rows[-1]["seq"]
+                events = compact_change_events(conn, rows)
+
+                for q in subs:
+                    for ev in events:
+                        try:
+                            q.put_nowait(ev)
+                        except queue.Full:
+                            # Client troppo lento: lo chiudiamo, riconnettendosi riparte da Last-Event-ID
+                            self.unsubscribe(q)
+                            q.queue.clear()
+                            q.put_nowait(None)
+                            break
+            except Exception:
+                app.logger.exception("Errore nel poller del feed modifiche")
+
+
+CHANGE_FEED = PerVenue(lambda: ChangeFeedBroadcaster(SSE_POLL_SECONDS))
+
+
+def _sse(ev: dict) -> str:
+    return f"id: {ev['seq']}\nevent: booking\ndata: {json.dumps(ev, separators=(',', ':'))}\n\n"
+
+
+@app.route("/events")
+def booking_events():
+    if not is_logged_in():
+        abort(403)
+
+    last_id = to_int(request.headers.get("Last-Event-ID") or request.args.get("since"))
+
+    if not request.environ.get("wsgi.multithread"):
+        conn = get_db()
+        seq = booking_change_counter(conn)
+        events = []
+        if last_id is not None and last_id < seq:
+            rows = conn.execute(
+                "SELECT seq, event_date FROM booking_changes WHERE seq > ? ORDER BY seq", (last_id,)
+            ).fetchall()
+            events = compact_change_events(conn, rows)
+        conn.close()
+        # L'ultima riga porta solo l'id: il browser lo ricorda anche senza dati da mostrare
+        body = f"retry: {SSE_SHORT_POLL_MS}\n\n" + "".join(_sse(ev) for ev in events) + f"id: {seq}\n\n"
+        return Response(body, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    def stream():
+        q = CHANGE_FEED.subscribe()
         try:
-            return send_file(pdf_buf, mimetype="application/pdf", as_attachment=True, download_name=filename)
-        except TypeError:
-            return send_file(pdf_buf, mimetype="application/pdf", as_attachment=True, attachment_filename=filename)
-    except Exception as e:
-        return (
-            f"<h2>Errore generazione PDF</h2><pre>{str(e)}</pre>"
-            "<p>Controlla che siano installati i pacchetti: reportlab e Pillow (vedi requirements.txt).</p>",
-            500,
-        )
+            yield "retry: 5000\n\n"
+            if last_id is not None:
+                conn = get_db()
+                rows = conn.execute(
+                    "SELECT seq, event_date FROM booking_changes WHERE seq > ? ORDER BY seq", (last_id,)
+                ).fetchall()
+                events = compact_change_events(conn, rows)
+                conn.close()
+                for ev in events:
+                    yield _sse(ev)
+            while True:
+                try:
+                    ev = q.get(timeout=SSE_PING_SECONDS)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if ev is None:
+                    break
+                yield _sse(ev)
+        finally:
+            CHANGE_FEED.unsubscribe(q)
+
+    # Sotto gthread il generatore gira dopo la fine della richiesta: senza il contesto
+    # get_db() e CHANGE_FEED finirebbero sulla sede predefinita
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# -------------------------
+# Offline: service worker e coda invii (IndexedDB)
+# -------------------------
+@app.route("/sw.js")
+def service_worker():
+    # Servito dalla radice (della sede) perché il service worker possa controllare tutto il sito
+    return Response(SERVICE_WORKER_JS, mimetype="application/javascript", headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/offline.js")
+def offline_js():
+    return Response(OFFLINE_JS, mimetype="application/javascript", headers={"Cache-Control": "no-cache"})
 
 LOGIN_HTML = """<!doctype html>
 <html>
@@ -1198,29 +6281,56 @@ BOOKING_HTML = r"""<!doctype html>
     .section { margin-top: 14px; padding-top: 10px; border-top: 1px solid #eee; }
     .pill { display:inline-block; padding:6px 10px; border-radius:999px; background:#f0f2f7; font-weight:800; }
     .warn { margin-top:12px; padding:12px; border:1px solid #f2a0a0; border-radius:12px; background:#ffe1e1; }
+    .suggest-wrap { position:relative; }
+    .suggest { position:absolute; left:0; right:0; z-index:5; background:#fff; border-radius:10px; box-shadow:0 6px 18px rgba(0,0,0,.12); }
+    .suggest button.suggest-item { display:block; width:100%; text-align:left; background:#fff; color:#111; font-weight:600; border-bottom:1px solid #eee; border-radius:0; }
   </style>
 </head>
 <body>
   <div class="card">
+    {% if edit %}
+    <h2>Modifica prenotazione #{{booking_id}} - {{app_name}}</h2>
+    <p><a href="{{ url_for('prenotazione_dettaglio', booking_id=booking_id) }}"><- Torna alla prenotazione</a></p>
+    {% else %}
     <h2>Modulo prenotazione evento - {{app_name}}</h2>
-    <p><a href="/day/{{event_date}}"><- Torna al giorno</a></p>
+    <p><a class="js-day-link" href="{{ url_for('day_view', date_iso=event_date) }}"><- Torna al giorno</a></p>
+    {% endif %}
 
-    <div class="pill">Data evento: {{event_date}} · Slot: {{slot.start}}-{{slot.end}} ({{slot.label}})</div>
+    <div class="pill" id="eventPill">Data evento: {{event_date}} · Slot: {{slot.start}}-{{slot.end}} ({{slot.label}})</div>
 
     {% if is_full %}
       <div class="warn">
-        <b>Allert:</b> Area 1 e 2 sono già impegnate. Vuoi inserire comunque Area 3?
+        {% if overflow_label %}
+        <b>Allert:</b> {{areas_label}} già impegnate. Vuoi inserire comunque {{overflow_label}}?
         <div style="margin-top:10px;">
           <label style="font-weight:800;">
             <input type="checkbox" name="confirm_area3" form="bookingForm">
-            Confermo inserimento Area 3
+            Confermo inserimento {{overflow_label}}
           </label>
         </div>
+        {% else %}
+        <b>Allert:</b> {{areas_label}}: slot al completo.
+        {% endif %}
       </div>
     {% endif %}
 
     {% if error %}<p class="err">{{error}}</p>{% endif %}
 
+    {% if conflicts %}
+      <div class="warn">
+        <b>Prenotazioni simili già presenti:</b>
+        <ul style="margin:8px 0;">
+          {% for c in conflicts %}
+          <li><a href="{{ url_for('prenotazione_dettaglio', booking_id=c.id) }}" target="_blank">{{c.event_date}} {{c.start_time}} · {{c.nome_festeggiato}}</a>{% if c.genitori %} ({{c.genitori}}){% endif %} — {{c.reason}}</li>
+          {% endfor %}
+        </ul>
+        <label style="font-weight:800;">
+          <input type="checkbox" name="confirm_duplicate" form="bookingForm">
+          Non è un doppione: salva comunque
+        </label>
+      </div>
+    {% endif %}
+
     <form method="post" id="bookingForm">
       <div class="row">
         <div class="col">
@@ -1240,8 +6350,27 @@ BOOKING_HTML = r"""<!doctype html>
         </div>
         <div class="col">
           <label>Data dell'evento</label>
+          {% if edit %}
+          <input type="date" name="event_date" required value="{{form.get('event_date', event_date)}}" />
+          {% set sc = form.get('slot_code', slot.code) %}
+          <select name="slot_code" style="margin-top:6px;">
+            {% for code, label in slot_choices %}
+            <option value="{{code}}" {% if sc==code %}selected{% endif %}>{{label}}</option>
+            {% endfor %}
+          </select>
+          <div class="hint">Cambiando data o slot l'area viene riassegnata.</div>
+          {% else %}
           <input type="text" value="{{event_date}}" disabled />
           <div class="hint">La data viene dal calendario (non modificabile qui).</div>
+          {% endif %}
+        </div>
+      </div>
+
+      <div class="row">
+        <div class="col suggest-wrap">
+          <label>Famiglia già cliente? Cerca per cognome o telefono</label>
+          <input id="customerSearch" autocomplete="off" placeholder="es. Rossi oppure 333..." />
+          <div id="customerResults" class="suggest"></div>
         </div>
       </div>
 
@@ -1303,7 +6432,8 @@ BOOKING_HTML = r"""<!doctype html>
         </div>
         <div class="col">
           <label>Tema evento</label>
-          <input name="tema_evento" value="{{form.get('tema_evento','')}}" />
+          <input name="tema_evento" id="temaEvento" list="temiList" autocomplete="off" value="{{form.get('tema_evento','')}}" />
+          <datalist id="temiList"></datalist>
         </div>
       </div>
 
@@ -1336,8 +6466,8 @@ BOOKING_HTML = r"""<!doctype html>
             {% set tc = form.get('torta_choice','') %}
             <select name="torta_choice" id="torta_choice">
               <option value="">Seleziona...</option>
-              <option value="esterna" {% if tc=='esterna' %}selected{% endif %}>Torta esterna (+EUR 1,00 a persona)</option>
-              <option value="interna" {% if tc=='interna' %}selected{% endif %}>Torta interna (da noi) (EUR 24,00 al chilo)</option>
+              <option value="esterna" {% if tc=='esterna' %}selected{% endif %}>Torta esterna (+EUR {{"{:0.2f}".format(prices.torta_esterna_eur_per_person).replace(".", ",")}} a persona)</option>
+              <option value="interna" {% if tc=='interna' %}selected{% endif %}>Torta interna (da noi) (EUR {{"{:0.2f}".format(prices.torta_eur_per_kg).replace(".", ",")}} al chilo)</option>
             </select>
           </div>
         </div>
@@ -1443,6 +6573,7 @@ BOOKING_HTML = r"""<!doctype html>
         </div>
       </div>
 
+      {% if not edit %}
       <div style="margin-top:16px;">
         <label style="font-weight:700;">
           <input type="checkbox" name="consenso_privacy" required {% if form.get('consenso_privacy') %}checked{% endif %}>
@@ -1454,14 +6585,28 @@ BOOKING_HTML = r"""<!doctype html>
           Autorizzo {{app_name}} a scattare foto/video durante l'evento e a utilizzarli sui canali social
         </label>
       </div>
+      {% endif %}
 
       <div class="row" style="margin-top:14px;">
         <div class="col">
           <label>Acconto (EUR)</label>
+          {% if edit %}
+          <input type="text" value="{{acconto}}" readonly />
+          <div class="muted">Acconti, pagamenti e rimborsi si registrano dal <a href="{{ url_for('prenotazione_dettaglio', booking_id=booking_id) }}#pagamenti">registro pagamenti</a>.</div>
+          {% else %}
           <input type="text" name="acconto_eur" placeholder="Es: 50,00" value="{{form.get('acconto_eur','')}}" />
+          {% endif %}
         </div>
       </div>
 
+      {% if edit %}
+      <input type="hidden" name="row_version" value="{{form.get('row_version','')}}" />
+
+      <div class="actions">
+        <button type="submit">Salva modifiche</button>
+        <a class="link" href="{{ url_for('prenotazione_dettaglio', booking_id=booking_id) }}">Annulla</a>
+      </div>
+      {% else %}
       <div class="row" style="margin-top:14px;">
         <div class="col">
           <label>Data firma genitore *</label>
@@ -1479,16 +6624,19 @@ BOOKING_HTML = r"""<!doctype html>
       </div>
 
       <input type="hidden" name="firma_png_base64" id="firma_png_base64" />
+      <input type="hidden" name="idempotency_key" id="idempotency_key" value="{{form.get('idempotency_key','')}}" />
 
       <div class="actions">
         <button type="submit">Salva evento</button>
-        <a class="link" href="/day/{{event_date}}">Annulla</a>
+        <a class="link js-day-link" href="{{ url_for('day_view', date_iso=event_date) }}">Annulla</a>
       </div>
+      {% endif %}
     </form>
   </div>
 
 <script>
 (function() {
+  const ROOT = {{ request.script_root|tojson }};  // prefisso della sede (/mare), vuoto col sottodominio
   const pacchetto = document.getElementById('pacchetto');
   const experienceBox = document.getElementById('experienceBox');
   const allInclusiveBox = document.getElementById('allInclusiveBox');
@@ -1560,6 +6708,7 @@ BOOKING_HTML = r"""<!doctype html>
 
   refreshVisibility();
 
+  {% if not edit %}
   const canvas = document.getElementById('sigCanvas');
   const ctx = canvas.getContext('2d');
   let drawing = false;
@@ -1622,12 +6771,135 @@ BOOKING_HTML = r"""<!doctype html>
   canvas.addEventListener('touchmove', move, { passive:false });
   window.addEventListener('touchend', end, { passive:false });
 
-  document.getElementById('bookingForm').addEventListener('submit', function(e) {
+  // Pagina servita dalla cache offline per un altro giorno/slot: mostra quelli dell'URL
+  const qs = new URLSearchParams(location.search);
+  const realDate = qs.get('date') || '{{event_date}}';
+  const realSlot = (qs.get('slot') || '{{slot.code}}').toUpperCase();
+  if (realDate !== '{{event_date}}' || realSlot !== '{{slot.code}}') {
+    document.getElementById('eventPill').textContent = 'Data evento: ' + realDate + ' · Slot: ' + realSlot + ' (offline)';
+    document.querySelectorAll('.js-day-link').forEach(a => { a.href = ROOT + '/day/' + realDate; });
+    const warn = document.querySelector('.warn');
+    if (warn) warn.remove();
+  }
+  {% endif %}
+
+  // Famiglie ricorrenti: una richiesta quando si smette di digitare, un tocco compila i genitori
+  const custInput = document.getElementById('customerSearch');
+  const custBox = document.getElementById('customerResults');
+  const custFields = ['madre_nome_cognome', 'madre_telefono', 'padre_nome_cognome', 'padre_telefono', 'indirizzo_residenza', 'email'];
+  let custTimer = null, custSeq = 0;
+  custInput.addEventListener('keydown', e => { if (e.key === 'Enter') e.preventDefault(); });
+  custInput.addEventListener('input', function() {
+    clearTimeout(custTimer);
+    const q = custInput.value.trim();
+    if (q.length < 2) { custBox.innerHTML = ''; return; }
+    custTimer = setTimeout(function() {
+      const seq = ++custSeq;
+      fetch(ROOT + '/clienti/cerca?q=' + encodeURIComponent(q), {credentials: 'same-origin'})
+        .then(r => r.ok ? r.json() : {results: []})
+        .then(j => {
+          if (seq !== custSeq) return;  // arrivata dopo una ricerca più recente
+          custBox.innerHTML = '';
+          j.results.forEach(c => {
+            const b = document.createElement('button');
+            b.type = 'button';
+            b.className = 'suggest-item';
+            b.textContent = c.label;
+            b.addEventListener('click', () => {
+              const f = document.getElementById('bookingForm');
+              custFields.forEach(name => { if (c[name]) f.elements[name].value = c[name]; });
+              custBox.innerHTML = '';
+              custInput.value = '';
+            });
+            custBox.appendChild(b);
+          });
+        })
+        .catch(() => {});
+    }, 250);
+  });
+
+  // Temi: suggerimenti con la grafia più usata, così le feste si raggruppano nei report
+  const temaInput = document.getElementById('temaEvento');
+  const temiList = document.getElementById('temiList');
+  let temaTimer = null, temaSeq = 0;
+  temaInput.addEventListener('input', function() {
+    clearTimeout(temaTimer);
+    const q = temaInput.value.trim();
+    if (!q) { temiList.innerHTML = ''; return; }
+    temaTimer = setTimeout(function() {
+      const seq = ++temaSeq;
+      fetch(ROOT + '/temi/suggerisci?q=' + encodeURIComponent(q), {credentials: 'same-origin'})
+        .then(r => r.ok ? r.json() : {results: []})
+        .then(j => {
+          if (seq !== temaSeq) return;
+          temiList.innerHTML = '';
+          j.results.forEach(t => {
+            const o = document.createElement('option');
+            o.value = t.tema;
+            o.label = t.feste + ' feste';
+            temiList.appendChild(o);
+          });
+        })
+        .catch(() => {});
+    }, 200);
+  });
+
+  {% if not edit %}
+  const keyEl = document.getElementById('idempotency_key');
+  if (!keyEl.value) {
+    keyEl.value = (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+      : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+  }
+
+  const form = document.getElementById('bookingForm');
+  form.addEventListener('submit', function(e) {
     if (!hasInk) { e.preventDefault(); alert("Firma mancante: firma nel riquadro prima di salvare."); return; }
     document.getElementById('firma_png_base64').value = canvas.toDataURL('image/png');
+    const submitBtn = form.querySelector('button[type=submit]');
+    if (!window.fetch || !window.LullyQueue) {
+      // invio classico: blocca il doppio tap
+      setTimeout(() => { submitBtn.disabled = true; }, 0);
+      return;
+    }
+
+    e.preventDefault();
+    if (submitBtn.disabled) return;
+    submitBtn.disabled = true;
+    const fields = Array.from(new FormData(form).entries());
+    const item = {
+      key: keyEl.value, url: location.href, fields: fields, savedAt: new Date().toISOString(),
+      label: (form.elements['nome_festeggiato'].value || '?') + ' - ' + realDate + ' ' + realSlot,
+    };
+
+    fetch(location.href, {
+      method: 'POST', body: new URLSearchParams(fields), credentials: 'same-origin',
+      headers: {'Accept': 'application/json'},
+    }).then(
+      r => r.json().then(j => ({status: r.status, j: j}), () => ({status: r.status, j: null})),
+      () => null
+    ).then(res => {
+      if (res === null) {
+        // Rete assente: la firma e il form restano sul tablet e partono appena torna la connessione
+        LullyQueue.add(item).then(() => {
+          alert("Connessione assente: evento salvato sul tablet. Verra' inviato appena torna la rete.");
+          location.href = ROOT + '/';
+        });
+      } else if (res.j && res.j.ok) {
+        location.href = res.j.redirect;
+      } else if (res.status === 401) {
+        LullyQueue.add(item).then(() => {
+          alert("Sessione scaduta: evento salvato sul tablet, verra' inviato dopo l'accesso.");
+          location.href = ROOT + '/login';
+        });
+      } else {
+        form.submit();  // errore di validazione: invio classico per mostrare il messaggio col form compilato
+      }
+    });
   });
+  {% endif %}
 })();
 </script>
+<script src="{{ url_for('offline_js') }}"></script>
 </body>
 </html>
 """
@@ -1645,12 +6917,33 @@ LIST_HTML = """<!doctype html>
     th, td { padding: 10px; border-bottom:1px solid #eee; text-align:left; }
     a.link { color:#0a84ff; font-weight:700; text-decoration:none; }
     .pill { display:inline-block; padding:6px 10px; border-radius:999px; background:#f0f2f7; font-weight:800; }
+    .export { border:1px solid #eee; border-radius:12px; padding:12px; margin:10px 0 16px; }
+    .export input[type=date] { padding:8px; border-radius:8px; border:1px solid #dcdcdc; }
+    .export button { padding:8px 12px; border-radius:8px; border:none; background:#111; color:#fff; font-weight:800; cursor:pointer; }
+    .cols { display:flex; flex-wrap:wrap; gap:6px 14px; margin-top:8px; font-size:13px; }
   </style>
 </head>
 <body>
   <div class="card">
     <h2>Prenotazioni - {{app_name}}</h2>
-    <p><a class="link" href="/">📆 Calendario</a></p>
+    <p><a class="link" href="{{ url_for('calendar_month') }}">📆 Calendario</a> &nbsp; <a class="link" href="{{ url_for('archivio') }}">🗄️ Archivio stagioni passate</a> &nbsp; <a class="link" href="{{ url_for('import_prenotazioni') }}">📥 Importa CSV</a></p>
+
+    <form class="export" method="get" action="{{ url_for('export_bookings_csv') }}" id="exportForm">
+      <b>Esporta</b>
+      dal <input type="date" name="from"> al <input type="date" name="to">
+      <button type="submit">CSV</button>
+      <button type="submit" formaction="{{ url_for('export_bookings_xlsx') }}">Excel</button>
+      <button type="submit" formaction="{{ url_for('job_export') }}" formmethod="post" name="format" value="xlsx" title="Per export grandi: prepara il file in background">Excel in background</button>
+      <details>
+        <summary>Colonne (nessuna selezionata = tutte)</summary>
+        <div class="cols">
+          {% for c in export_columns %}
+            <label><input type="checkbox" name="col" value="{{c}}"> {{c}}</label>
+          {% endfor %}
+          <label><input type="checkbox" name="firma" value="1"> includi firma (PNG base64)</label>
+        </div>
+      </details>
+    </form>
 
     {% if rows|length == 0 %}
       <p style="color:#666;">Nessuna prenotazione salvata ancora.</p>
@@ -1684,7 +6977,7 @@ LIST_HTML = """<!doctype html>
                   <span class="pill">EUR {{"{:0.2f}".format(r['totale_stimato_eur']|float).replace(".", ",")}}</span>
                 {% else %}-{% endif %}
               </td>
-              <td><a class="link" href="/prenotazioni/{{r['id']}}">Apri</a> &nbsp; <a class="link" title="Scarica PDF" href="/prenotazioni/{{r['id']}}/contratto.pdf">📥 PDF</a></td>
+              <td><a class="link" href="{{ url_for('prenotazione_dettaglio', booking_id=r['id']) }}">Apri</a> &nbsp; <a class="link" title="Scarica PDF" href="{{ url_for('prenotazione_contratto_pdf', booking_id=r['id']) }}">📥 PDF</a></td>
             </tr>
           {% endfor %}
         </tbody>
@@ -1710,14 +7003,19 @@ DETAIL_HTML = """<!doctype html>
     img { max-width: 760px; width:100%; border:1px solid #ddd; border-radius:12px; background:#fff; }
     .contract { white-space: pre-wrap; background:#f6f7fb; padding: 14px; border-radius: 12px; border:1px solid #e8e8e8; }
     a.btnpdf { display:inline-block; margin-top:10px; padding:10px 12px; border-radius:12px; background:#111; color:#fff; text-decoration:none; font-weight:900; }
+    .muted { color:#666; }
+    .payform { display:flex; gap:8px; flex-wrap:wrap; margin-top:10px; }
+    .payform input, .payform select, .payform button { padding:8px 10px; border-radius:10px; border:1px solid #ccc; font-size:14px; }
+    .payform button { background:#111; color:#fff; font-weight:800; border:0; }
   </style>
 </head>
 <body>
   <div class="card">
-    <p><a href="/prenotazioni"><- Prenotazioni</a> | <a href="/">Calendario</a></p>
+    <p><a href="{{ url_for('prenotazioni') }}"><- Prenotazioni</a> | <a href="{{ url_for('calendar_month') }}">Calendario</a></p>
     <h2>Dettaglio prenotazione #{{b['id']}} - {{app_name}}</h2>
 
-    <a class="btnpdf" href="/prenotazioni/{{b['id']}}/contratto.pdf">⬇️ Scarica contratto PDF</a>
+    <a class="btnpdf" href="{{ url_for('prenotazione_contratto_pdf', booking_id=b['id']) }}">⬇️ Scarica contratto PDF</a>
+    {% if editable %}<a class="btnpdf" style="background:#0a84ff;" href="{{ url_for('prenotazione_modifica', booking_id=b['id']) }}">✏️ Modifica</a>{% endif %}
 
     <div class="box">
       <div class="k">Calendario</div>
@@ -1736,6 +7034,26 @@ DETAIL_HTML = """<!doctype html>
       <div class="v">{{torta_info}}</div>
     </div>
 
+    <div class="box" id="pagamenti">
+      <div class="k">Pagamenti</div>
+      {% for p in payments %}
+      <div>{{p['paid_at'][:10]}} · {{payment_methods.get(p['method'], p['method'] or '-')}} · <b>EUR {{cents_label(p['amount_cent'])}}</b>{% if p['note'] %} · {{p['note']}}{% endif %}</div>
+      {% else %}
+      <div class="muted">Nessun pagamento registrato.</div>
+      {% endfor %}
+      <div class="v" style="margin-top:8px;">Incassato EUR {{cents_label(b['paid_cent'])}} · Saldo EUR {{cents_label(b['balance_cent'])}}</div>
+      {% if editable %}
+      <form method="post" action="{{ url_for('prenotazione_pagamento', booking_id=b['id']) }}" class="payform">
+        <select name="tipo"><option value="pagamento">Pagamento</option><option value="rimborso">Rimborso</option></select>
+        <input name="importo" placeholder="Importo, es. 100,00" required>
+        <select name="metodo">{% for k, v in payment_methods.items() %}<option value="{{k}}">{{v}}</option>{% endfor %}</select>
+        <input type="date" name="data" value="{{today}}">
+        <input name="note" placeholder="Note">
+        <button type="submit">Registra</button>
+      </form>
+      {% endif %}
+    </div>
+
     <div class="box">
       <div class="k">Dettagli pacchetto (contratto)</div>
       <div class="contract">{{b['dettagli_contratto_text'] or ''}}</div>
@@ -1745,10 +7063,197 @@ DETAIL_HTML = """<!doctype html>
       <div class="k">Firma</div>
       <img src="{{b['firma_png_base64']}}" alt="Firma genitore" />
     </div>
+
+    {% if audit %}
+    <div class="box">
+      <div class="k">Storico modifiche</div>
+      {% for a in audit %}
+      <div style="margin-top:6px;">
+        <b>{{a.changed_at.replace('T', ' ')}}</b> · {{a.op}}{% if a.version %} (v{{a.version}}){% endif %} · <span class="muted">{{a.actor}}</span>
+        {% for field, pair in a.changes %}
+        <div class="muted" style="margin-left:14px;">{{field}}: {{pair[0] if pair[0] not in (none, '') else '-'}} → {{pair[1] if pair[1] not in (none, '') else '-'}}</div>
+        {% endfor %}
+      </div>
+      {% endfor %}
+    </div>
+    {% endif %}
   </div>
 </body>
 </html>
 """
 
+# Coda degli invii del form salvati offline. Gira sia nella pagina che nel service worker.
+OFFLINE_JS = r"""
+(function(global) {
+  const DB_NAME = 'lullyland-offline';
+  const STORE = 'submissions';
+
+  function openDb() {
+    return new Promise((resolve, reject) => {
+      const req = indexedDB.open(DB_NAME, 1);
+      req.onupgradeneeded = () => req.result.createObjectStore(STORE, {keyPath: 'key'});
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+
+  function withStore(mode, fn) {
+    return openDb().then(db => new Promise((resolve, reject) => {
+      const tx = db.transaction(STORE, mode);
+      const req = fn(tx.objectStore(STORE));
+      tx.oncomplete = () => resolve(req ? req.result : undefined);
+      tx.onerror = () => reject(tx.error);
+    }));
+  }
+
+  const LullyQueue = {
+    add(item) {
+      return withStore('readwrite', s => s.put(item)).then(() => {
+        if (global.navigator && navigator.serviceWorker && navigator.serviceWorker.ready) {
+          navigator.serviceWorker.ready.then(reg => reg.sync && reg.sync.register('lully-bookings')).catch(() => {});
+        }
+      });
+    },
+    all() { return withStore('readonly', s => s.getAll()); },
+    remove(key) { return withStore('readwrite', s => s.delete(key)); },
+
+    // Reinvia gli invii in coda; la chiave di idempotenza evita doppioni lato server.
+    flush() {
+      return LullyQueue.all().then(items => Promise.all(items.filter(i => !i.error).map(item =>
+        fetch(item.url, {
+          method: 'POST', body: new URLSearchParams(item.fields), credentials: 'same-origin',
+          headers: {'Accept': 'application/json'},
+        }).then(r => r.json().then(j => ({status: r.status, j: j}), () => ({status: r.status, j: null})))
+          .then(res => {
+            if (res.j && res.j.ok) return LullyQueue.remove(item.key);
+            if (res.status === 401 || !res.j) return;  // login scaduto o risposta inattesa: si riprova
+            item.error = res.j.error || ('Errore ' + res.status);
+            item.conflicts = res.j.conflicts || [];  // doppione possibile: si può confermare dal banner
+            return LullyQueue.add(item);
+          })
+          .catch(() => {})  // ancora offline
+      )));
+    },
+  };
+  global.LullyQueue = LullyQueue;
+
+  if (typeof document === 'undefined') return;  // service worker: solo la coda
+
+  // Sede con prefisso (/mare/...): il service worker e il suo scope stanno sotto il prefisso
+  const root = new URL('.', document.currentScript.src).pathname.replace(/\/$/, '');
+  if ('serviceWorker' in navigator) navigator.serviceWorker.register(root + '/sw.js').catch(() => {});
+
+  function renderBanner() {
+    LullyQueue.all().then(items => {
+      let box = document.getElementById('offlineQueue');
+      if (!items.length) { if (box) box.remove(); return; }
+      if (!box) {
+        box = document.createElement('div');
+        box.id = 'offlineQueue';
+        box.style.cssText = 'position:fixed;left:12px;right:12px;bottom:12px;padding:12px;border-radius:12px;' +
+          'background:#fff8d8;border:1px solid #f1df86;font:14px system-ui;z-index:99;';
+        document.body.appendChild(box);
+      }
+      box.innerHTML = '<b>' + items.length + ' evento/i salvati sul tablet in attesa di invio</b>';
+      items.forEach(item => {
+        const row = document.createElement('div');
+        row.style.marginTop = '6px';
+        row.textContent = item.label + (item.error ? ' - NON INVIATO: ' + item.error + ' ' : ' ');
+        if (item.error && item.conflicts && item.conflicts.length) {
+          const list = document.createElement('ul');
+          list.style.margin = '4px 0';
+          item.conflicts.forEach(c => {
+            const li = document.createElement('li');
+            li.textContent = c.event_date + ' ' + c.start_time + ' · ' + c.nome_festeggiato + (c.genitori ? ' (' + c.genitori + ')' : '') +
+              ' - ' + c.reason;
+            list.appendChild(li);
+          });
+          row.appendChild(list);
+          const ok = document.createElement('button');
+          ok.textContent = 'Non è un doppione: invia comunque';
+          ok.onclick = () => {
+            // Stessa conferma della casella nel form: rimandato con confirm_duplicate, stessa chiave di idempotenza
+            item.fields = item.fields.filter(f => f[0] !== 'confirm_duplicate').concat([['confirm_duplicate', 'on']]);
+            delete item.error;
+            delete item.conflicts;
+            LullyQueue.add(item).then(flushAndRender);
+          };
+          row.appendChild(ok);
+        }
+        if (item.error) {
+          const btn = document.createElement('button');
+          btn.textContent = 'Elimina';
+          btn.onclick = () => { if (confirm('Eliminare questo invio?')) LullyQueue.remove(item.key).then(renderBanner); };
+          row.appendChild(btn);
+        }
+        box.appendChild(row);
+      });
+    }).catch(() => {});
+  }
+
+  function flushAndRender() { LullyQueue.flush().then(renderBanner, renderBanner); }
+  window.addEventListener('online', flushAndRender);
+  if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', flushAndRender);
+  else flushAndRender();
+})(self);
+"""
+
+# Service worker: shell di calendario e form in cache (rete prima, cache se offline)
+SERVICE_WORKER_JS = r"""
+const ROOT = new URL('.', location).pathname.replace(/\/$/, '');  // prefisso della sede, se c'è
+importScripts(ROOT + '/offline.js');
+
+const CACHE = 'lullyland-shell-v2';
+
+self.addEventListener('install', e => {
+  e.waitUntil(caches.open(CACHE).then(c => c.add(ROOT + '/offline.js')).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', e => {
+  e.waitUntil(
+    caches.keys()
+      .then(keys => Promise.all(keys.filter(k => k !== CACHE).map(k => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
+});
+
+function isShell(url) {
+  const path = url.pathname.startsWith(ROOT + '/') ? url.pathname.slice(ROOT.length) : null;
+  return path === '/' || (path !== null && path.startsWith('/day/')) ||
+         path === '/booking/new' || path === '/offline.js';
+}
+
+self.addEventListener('fetch', e => {
+  const req = e.request;
+  const url = new URL(req.url);
+  if (req.method !== 'GET' || url.origin !== location.origin || !isShell(url)) return;
+
+  e.respondWith(
+    fetch(req).then(resp => {
+      // Non mettere in cache la pagina di login (redirect) o errori
+      if (resp.ok && !resp.redirected) {
+        const copy = resp.clone();
+        caches.open(CACHE).then(c => c.put(req, copy));
+      }
+      return resp;
+    }).catch(() => {
+      if (url.pathname !== ROOT + '/booking/new') return caches.match(req);
+      // Il form in cache contiene il token di idempotenza del GET originale: lo togliamo, così
+      // ogni form aperto offline ne genera uno suo e due eventi diversi non si "deduplicano".
+      return caches.match(req)
+        .then(hit => hit || caches.match(req, {ignoreSearch: true}))
+        .then(hit => hit && hit.text().then(html => new Response(
+          html.replace(/(name="idempotency_key"[^>]*value=")[^"]*"/, '$1"'),
+          {headers: {'Content-Type': 'text/html; charset=utf-8'}}
+        )));
+    })
+  );
+});
+
+self.addEventListener('sync', e => {
+  if (e.tag === 'lully-bookings') e.waitUntil(LullyQueue.flush());
+});
+"""
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
@@ -0,0 +1,11 @@
+# Letto da gunicorn all'avvio (gunicorn app:app) se lanciato da questa cartella.
+# Worker a thread: gli stream SSE di /events restano aperti senza bloccare le altre
+# richieste (con worker sincroni /events ripiega sul polling breve, vedi booking_events).
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+# Gli stream SSE mandano un ping ogni 15 s: il timeout del worker deve restare più lungo
+timeout = 60
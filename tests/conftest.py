@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+# app.py crea il DB all'import: il percorso va deciso prima
+_TMP = tempfile.mkdtemp(prefix="lullyland-test-")
+os.environ.setdefault("DB_PATH", os.path.join(_TMP, "test.db"))
+os.environ.setdefault("JOBS_DIR", os.path.join(_TMP, "jobs"))
+os.environ.setdefault("BACKUP_DIR", os.path.join(_TMP, "backups"))
+os.environ.setdefault("ARCHIVE_DIR", os.path.join(_TMP, "archive"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lullyland  # noqa: E402
+
+SIGNATURE = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+@pytest.fixture
+def app_module():
+    return lullyland
+
+
+@pytest.fixture
+def client():
+    c = lullyland.app.test_client()
+    with c.session_transaction() as s:
+        s["ok"] = True
+    return c
+
+
+def booking_form(**overrides) -> dict:
+    form = {
+        "nome_festeggiato": "Mario", "eta_festeggiato": "5", "pacchetto": "Lullyland Experience",
+        "consenso_privacy": "on", "data_firma": "2026-01-01", "firma_png_base64": SIGNATURE,
+        "invitati_bambini": "10", "invitati_adulti": "8", "catering_baby_choice": "menu_pizza",
+        "torta_choice": "interna", "torta_interna_choice": "standard", "madre_telefono": "333 1234567",
+        "tema_evento": "Frozen", "confirm_area3": "on", "confirm_duplicate": "on",
+    }
+    form.update(overrides)
+    return form
+
+
+@pytest.fixture
+def make_booking(client, app_module):
+    """Crea una prenotazione dal form e ne ritorna l'id."""
+
+    def make(event_date=None, slot="AFTERNOON", **overrides):
+        event_date = event_date or (date.today() + timedelta(days=30)).isoformat()
+        r = client.post(f"/booking/new?date={event_date}&slot={slot}", data=booking_form(**overrides),
+                        headers={"Accept": "application/json"})
+        assert r.status_code == 200, r.data[:500]
+        return r.get_json()["booking_id"]
+
+    return make
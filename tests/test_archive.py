@@ -0,0 +1,17 @@
+def test_archive_moves_rows_and_search_is_escaped(client, app_module, make_booking):
+    booking_id = make_booking(event_date="2031-07-01", nome_festeggiato="Pia", madre_telefono="3330000041")
+    conn = app_module.get_db()
+    conn.execute("UPDATE bookings SET event_date = '2019-07-01' WHERE id = ?", (booking_id,))
+    conn.commit()
+    conn.close()
+
+    assert app_module.archive_old_bookings(horizon_days=0)[2019] == 1
+
+    conn = app_module.get_db()
+    assert conn.execute("SELECT 1 FROM bookings WHERE id = ?", (booking_id,)).fetchone() is None
+    assert app_module.fetch_booking(conn, booking_id)["nome_festeggiato"] == "Pia"
+    conn.close()
+
+    r = client.get("/archivio", query_string={"anno": "2019", "q": '"><script>alert(1)</script>'})
+    assert b"<script>alert(1)" not in r.data
+    assert b"&lt;script&gt;" in r.data
@@ -0,0 +1,34 @@
+import sqlite3
+
+
+def audit_actors(app_module, booking_id: int) -> list:
+    conn = app_module.get_db()
+    rows = conn.execute("SELECT op, actor FROM audit_log WHERE booking_id = ? ORDER BY month, seq", (booking_id,)).fetchall()
+    conn.close()
+    return [(r["op"], r["actor"]) for r in rows]
+
+
+def test_triggers_work_from_plain_sqlite_without_inheriting_the_actor(app_module, make_booking):
+    booking_id = make_booking(event_date="2031-04-01", nome_festeggiato="Ivo", madre_telefono="3330000011")
+
+    outside = sqlite3.connect(app_module.venue_db_path())
+    outside.execute("UPDATE bookings SET note = 'da sqlite3' WHERE id = ?", (booking_id,))
+    outside.commit()
+    outside.close()
+
+    (op_i, actor_i), (op_u, actor_u) = audit_actors(app_module, booking_id)
+    assert (op_i, op_u) == ("I", "U")
+    assert actor_i.endswith("POST /booking/new")
+    assert actor_u is None
+
+
+def test_consecutive_app_edits_keep_their_actor(app_module, make_booking):
+    booking_id = make_booking(event_date="2031-04-02", nome_festeggiato="Lia", madre_telefono="3330000012")
+    conn = app_module.get_db()
+    for area in (2, 1):
+        conn.execute("UPDATE bookings SET area = ?, last_actor = ? WHERE id = ?", (area, app_module.actor_stamp(), booking_id))
+    conn.commit()
+    conn.close()
+
+    actors = [actor for op, actor in audit_actors(app_module, booking_id) if op == "U"]
+    assert len(actors) == 2 and all(a and "\t" not in a for a in actors)
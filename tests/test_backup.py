@@ -0,0 +1,32 @@
+import gzip
+import os
+import sqlite3
+import subprocess
+import sys
+
+
+def test_backup_is_a_complete_copy(tmp_path, app_module, make_booking):
+    booking_id = make_booking(event_date="2031-05-01", nome_festeggiato="Nora", madre_telefono="3330000021")
+
+    path = app_module.backup_database(dest_dir=str(tmp_path), compress=True, keep=2)
+    plain = tmp_path / "copia.db"
+    with gzip.open(path, "rb") as f_in:
+        plain.write_bytes(f_in.read())
+
+    conn = sqlite3.connect(plain)
+    assert conn.execute("SELECT nome_festeggiato FROM bookings WHERE id = ?", (booking_id,)).fetchone() == ("Nora",)
+    conn.close()
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_scheduler_starts_only_in_the_web_server(tmp_path):
+    script = (
+        "import app\n"
+        "print(app._backup_scheduler_tried)\n"
+        "app.app.test_client().get('/login')\n"
+        "print(app._backup_scheduler_tried)\n"
+    )
+    env = {**os.environ, "BACKUP_INTERVAL_HOURS": "24", "DB_PATH": str(tmp_path / "s.db"), "BACKUP_DIR": str(tmp_path)}
+    out = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         env=env, capture_output=True, text=True, check=True).stdout.split()
+    assert out == ["False", "True"]
@@ -0,0 +1,24 @@
+import sqlite3
+
+
+def test_feed_is_off_without_a_configured_token(client):
+    assert client.get("/calendario.ics").status_code == 503
+    assert "Feed calendario disattivato" in client.get("/calendario-telefono").get_data(as_text=True)
+
+
+def test_cancelled_events_keep_their_start(app_module, make_booking, monkeypatch):
+    monkeypatch.setattr(app_module, "ICS_TOKEN", "token-di-prova")
+    feed = app_module.app.test_client()
+    booking_id = make_booking(event_date="2031-10-01", nome_festeggiato="Vera", madre_telefono="3330000081")
+    since = feed.get("/calendario.ics?token=token-di-prova").headers["X-Sync-Token"]
+
+    outside = sqlite3.connect(app_module.venue_db_path())
+    outside.execute("DELETE FROM bookings WHERE id = ?", (booking_id,))
+    outside.commit()
+    outside.close()
+
+    body = feed.get(f"/calendario.ics?token=token-di-prova&since={since}").get_data(as_text=True)
+    event = body.split(f"UID:booking-{booking_id}@")[1].split("END:VEVENT")[0]
+    assert "STATUS:CANCELLED" in event
+    assert "DTSTART:20311001T" in event
+    assert feed.get("/calendario.ics?token=sbagliato").status_code == 403
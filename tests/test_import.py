@@ -0,0 +1,79 @@
+import io
+
+HEADER = "nome_festeggiato;event_date;slot_code;pacchetto;invitati_bambini;catering_baby_choice;torta_choice;torta_interna_choice;madre_telefono"
+
+
+def csv_rows(*rows) -> io.StringIO:
+    lines = [HEADER] + [
+        f"{name};{event_date};{slot};Lullyland Experience;10;menu_pizza;interna;standard;{phone}"
+        for name, event_date, slot, phone in rows
+    ]
+    return io.StringIO("\n".join(lines) + "\n")
+
+
+def count_bookings(app_module, event_date: str) -> int:
+    conn = app_module.get_db()
+    n = conn.execute("SELECT COUNT(*) FROM bookings WHERE event_date = ?", (event_date,)).fetchone()[0]
+    conn.close()
+    return n
+
+
+def test_rows_go_through_slot_capacity_and_duplicate_checks(app_module):
+    result = app_module.import_bookings_csv(csv_rows(
+        ("Anna", "2031-03-04", "MORNING", "3330000001"),      # martedì: slot chiuso
+        ("Bruno", "2031-03-04", "AFTERNOON", "3330000002"),
+        ("Carla", "2031-03-04", "AFTERNOON", "3330000003"),
+        ("Dario", "2031-03-04", "AFTERNOON", "3330000004"),   # area di sfogo senza conferma
+        ("Bruno", "2031-03-11", "AFTERNOON", "3330000002"),   # stesso festeggiato, stessa famiglia
+    ))
+    messages = dict(result["errors"])
+    assert result["imported"] == 2
+    assert "non disponibile" in messages[2]
+    assert "confirm_area3" in messages[5]
+    assert 6 in messages
+    assert count_bookings(app_module, "2031-03-04") == 2
+
+
+def test_reimporting_an_export_skips_existing_rows(client, app_module, make_booking):
+    make_booking(event_date="2031-03-05", nome_festeggiato="Elena", madre_telefono="3330000005")
+    data = client.get("/export/prenotazioni.csv?from=2031-03-05&to=2031-03-05").data.decode("utf-8-sig")
+
+    result = app_module.import_bookings_csv(io.StringIO(data))
+    assert (result["read"], result["imported"], result["skipped"]) == (1, 0, 1)
+    assert count_bookings(app_module, "2031-03-05") == 1
+
+
+def test_dry_run_on_scratch_copy_leaves_db_untouched(app_module):
+    with app_module.scratch_db_copy() as scratch:
+        result = app_module.import_bookings_csv(csv_rows(("Franco", "2031-03-06", "AFTERNOON", "3330000006")), conn=scratch)
+    assert result["imported"] == 1
+    assert count_bookings(app_module, "2031-03-06") == 0
+
+
+def test_upload_is_queued_and_the_job_writes_a_report(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "jobs_worker_alive", lambda conn: True)
+    body = csv_rows(("Gina", "2031-03-07", "AFTERNOON", "3330000007")).getvalue().encode()
+    r = client.post("/import", data={"file": (io.BytesIO(body), "foglio.csv")}, content_type="multipart/form-data")
+    assert r.status_code == 302
+    assert count_bookings(app_module, "2031-03-07") == 0
+
+    conn = app_module.get_db()
+    job = conn.execute("SELECT id, kind, params_json FROM jobs ORDER BY id DESC LIMIT 1").fetchone()
+    conn.close()
+    assert job["kind"] == "import_bookings"
+    meta = app_module.execute_job(job["id"], job["kind"], job["params_json"])
+    with open(meta["result_path"], encoding="utf-8") as f:
+        assert "importate 1" in f.read()
+    assert count_bookings(app_module, "2031-03-07") == 1
+
+
+def test_upload_runs_inline_without_a_worker(client, app_module):
+    body = csv_rows(
+        ("Ivo", "2031-03-08", "AFTERNOON", "3330000009"),
+        ("Lia", "2031-03-08", "NOTTE", "3330000010"),
+    ).getvalue().encode()
+    r = client.post("/import", data={"file": (io.BytesIO(body), "foglio.csv")}, content_type="multipart/form-data")
+    page = r.get_data(as_text=True)
+    assert r.status_code == 200
+    assert "Import completato" in page and "riga 3:" in page
+    assert count_bookings(app_module, "2031-03-08") == 1
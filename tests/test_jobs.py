@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import time
+
+
+def test_stale_job_out_of_attempts_fails_instead_of_requeueing(app_module):
+    conn = app_module.get_db()
+    last = app_module.enqueue_job(conn, "reprice_bookings", {"date_from": "2099-01-01"}, max_attempts=1)
+    spare = app_module.enqueue_job(conn, "reprice_bookings", {"date_from": "2099-01-02"}, max_attempts=2)
+    conn.execute("UPDATE jobs SET status = 'running', attempts = 1, worker = 'morto:1' WHERE id IN (?, ?)", (last, spare))
+    conn.execute("INSERT OR REPLACE INTO job_workers (name, heartbeat_at) VALUES ('morto:1', ?)", (time.time() - 3600,))
+    conn.commit()
+
+    app_module.requeue_stale_jobs(conn)
+
+    status = dict(conn.execute("SELECT id, status FROM jobs WHERE id IN (?, ?)", (last, spare)).fetchall())
+    conn.execute("DELETE FROM jobs WHERE id IN (?, ?)", (last, spare))
+    conn.commit()
+    conn.close()
+    assert status == {last: "failed", spare: "queued"}
+
+
+def test_worker_survives_a_crashed_pool_process(tmp_path):
+    # DB nuovo: il worker prende tutti i lavori in coda
+    script = (
+        "import os\n"
+        "import app\n"
+        "app.JOB_HANDLERS['crash'] = (lambda params, out_path: os._exit(1), None)\n"
+        "conn = app.get_db()\n"
+        "crash = app.enqueue_job(conn, 'crash', {}, max_attempts=1)\n"
+        "ok = app.enqueue_job(conn, 'reprice_bookings', {'date_from': '2099-01-01'})\n"
+        "real_finish = app.finish_job\n"
+        "def finish(conn, job_id, result=None, error=None):\n"
+        "    real_finish(conn, job_id, result=result, error=error)\n"
+        "    if job_id == ok:\n"
+        "        raise SystemExit\n"
+        "app.finish_job = finish\n"
+        "try:\n"
+        "    app.run_job_worker(1)\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "for r in conn.execute('SELECT status, error FROM jobs ORDER BY id'):\n"
+        "    print(r['status'], r['error'])\n"
+    )
+    env = {**os.environ, "DB_PATH": str(tmp_path / "w.db"), "JOBS_DIR": str(tmp_path / "jobs")}
+    out = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         env=env, capture_output=True, text=True, timeout=60, check=True).stdout.splitlines()
+    assert out[0].startswith("failed BrokenProcessPool")
+    assert out[1] == "done None"
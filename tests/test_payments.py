@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.mark.parametrize("text, cents", [
+    ("50", 5000), ("50,00", 5000), ("1.234,50", 123450), ("EUR 50.5", 5050), ("50 €", 5000),
+    ("200 (bonifico 12/03)", None), ("100 + 50", None), ("50 il 12/03/2024", None), ("", None),
+])
+def test_parse_eur_cents_accepts_only_a_single_amount(app_module, text, cents):
+    assert app_module.parse_eur_cents(text) == cents
+
+
+def test_deposit_becomes_first_ledger_row(app_module, make_booking):
+    booking_id = make_booking(acconto_eur="50,00")
+    conn = app_module.get_db()
+    row = conn.execute("SELECT paid_cent FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    conn.close()
+    assert row["paid_cent"] == 5000
+
+
+def test_free_text_deposit_is_rejected(client, app_module):
+    from conftest import booking_form
+    r = client.post("/booking/new?date=2030-01-01&slot=AFTERNOON", data=booking_form(acconto_eur="200 (bonifico 12/03)"))
+    assert "Acconto non leggibile".encode() in r.data
+
+
+def test_edit_does_not_change_the_deposit(client, app_module, make_booking):
+    from conftest import booking_form
+    booking_id = make_booking(acconto_eur="50")
+    page = client.get(f"/prenotazioni/{booking_id}/modifica")
+    assert b'name="acconto_eur"' not in page.data
+
+    conn = app_module.get_db()
+    row = conn.execute("SELECT event_date, slot_code FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    conn.close()
+    form = booking_form(acconto_eur="500", row_version="1", event_date=row["event_date"], slot_code=row["slot_code"],
+                        note="cambiata")
+    client.post(f"/prenotazioni/{booking_id}/modifica", data=form)
+
+    conn = app_module.get_db()
+    row = conn.execute("SELECT acconto_eur, paid_cent, note FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    conn.close()
+    assert (row["acconto_eur"], row["paid_cent"], row["note"]) == ("50", 5000, "cambiata")
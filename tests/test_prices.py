@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+
+def test_new_price_list_applies_and_shows_in_messages(client, app_module, make_booking):
+    booking_id = make_booking(event_date="2032-02-03", nome_festeggiato="Ugo", madre_telefono="3330000071")
+    r = client.post("/listini", data={
+        "action": "create", "valid_from": "2032-01-01", "torta_eur_per_kg": "30", "torta_esterna_eur_per_person": "2",
+    })
+    assert r.status_code == 302
+
+    r = client.post("/listini", data={"action": "apply"})
+    assert r.status_code == 302
+
+    conn = app_module.get_db()
+    row = conn.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+    list_id, prices = app_module.price_list_for(conn, "2032-02-03")
+    conn.close()
+    assert row["price_list_id"] == list_id
+    assert Decimal(row["totale_stimato_eur"]) == app_module.compute_totals(app_module.payload_from_row(row), prices)["totale"]
+
+    from conftest import booking_form
+    page = client.post("/booking/new?date=2032-02-10&slot=AFTERNOON", data=booking_form(torta_choice="")).get_data(as_text=True)
+    assert "+EUR 2,00 a persona" in page
+    assert "EUR 30,00/kg" in page
+
+
+def test_reprice_skips_a_booking_edited_after_the_totals_were_computed(app_module, make_booking, monkeypatch):
+    booking_id = make_booking(event_date="2032-03-04", nome_festeggiato="Gaia", madre_telefono="3330000072")
+    conn = app_module.get_db()
+    conn.execute("UPDATE bookings SET totale_stimato_eur = '1.00' WHERE id = ?", (booking_id,))
+    conn.commit()
+    conn.close()
+    real_totals = app_module.vectorized_totals
+
+    def totals_then_edit(rows, prices):
+        totals = real_totals(rows, prices)
+        other = app_module.get_db()
+        other.execute("UPDATE bookings SET totale_stimato_eur = '2.00', row_version = row_version + 1 WHERE id = ?",
+                      (booking_id,))
+        other.commit()
+        other.close()
+        return totals
+
+    monkeypatch.setattr(app_module, "vectorized_totals", totals_then_edit)
+    res = app_module.reprice_bookings("2032-03-04", apply=True)
+
+    conn = app_module.get_db()
+    total = conn.execute("SELECT totale_stimato_eur FROM bookings WHERE id = ?", (booking_id,)).fetchone()[0]
+    conn.close()
+    assert booking_id in [c[0] for c in res["changes"]]
+    assert total == "2.00"
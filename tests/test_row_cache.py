@@ -0,0 +1,22 @@
+def test_stale_row_is_not_cached_when_another_thread_synced_past_a_change(app_module, make_booking, monkeypatch):
+    booking_id = make_booking(event_date="2031-08-01", nome_festeggiato="Rita", madre_telefono="3330000051")
+    cache = app_module.BookingRowCache(1024 * 1024)
+    real_fetch = app_module.fetch_booking
+
+    def fetch_then_concurrent_edit(conn, bid):
+        row = real_fetch(conn, bid)  # riga vecchia
+        other = app_module.get_db()
+        other.execute("UPDATE bookings SET note = 'nuova' WHERE id = ?", (bid,))
+        other.commit()
+        with cache._lock:
+            cache._sync(other)  # un altro thread vede la modifica prima che la riga entri in cache
+        other.close()
+        return row
+
+    conn = app_module.get_db()
+    monkeypatch.setattr(app_module, "fetch_booking", fetch_then_concurrent_edit)
+    cache.get(conn, booking_id)
+    monkeypatch.setattr(app_module, "fetch_booking", real_fetch)
+
+    assert cache.get(conn, booking_id)["note"] == "nuova"
+    conn.close()
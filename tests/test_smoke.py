@@ -0,0 +1,65 @@
+def test_month_page(client):
+    assert client.get("/").status_code == 200
+
+
+def test_booking_detail_page(client, make_booking):
+    booking_id = make_booking(nome_festeggiato="Dettaglio")
+    r = client.get(f"/prenotazioni/{booking_id}")
+    assert r.status_code == 200
+    assert b"Dettaglio" in r.data
+
+
+def test_contract_pdf(client, make_booking):
+    booking_id = make_booking()
+    r = client.get(f"/prenotazioni/{booking_id}/contratto.pdf")
+    assert r.status_code == 200
+    assert r.data.startswith(b"%PDF")
+
+
+def test_events_short_poll_on_sync_workers(client, make_booking):
+    first = client.get("/events").get_data(as_text=True)
+    last_id = first.strip().splitlines()[-1].split(": ")[1]
+
+    make_booking(event_date="2031-06-01", nome_festeggiato="Olga", madre_telefono="3330000031")
+    r = client.get("/events", headers={"Last-Event-ID": last_id})
+    assert r.status_code == 200
+    assert '"date":"2031-06-01"' in r.get_data(as_text=True)
+
+
+def test_day_view_shows_bookings_outside_todays_rules(client, app_module, make_booking):
+    booking_id = make_booking(event_date="2031-09-02", nome_festeggiato="Sara", madre_telefono="3330000061")
+    conn = app_module.get_db()
+    conn.execute("UPDATE bookings SET slot_code = 'MORNING', start_time = '10:00', end_time = '12:00' WHERE id = ?", (booking_id,))
+    conn.commit()
+    conn.close()
+
+    page = client.get("/day/2031-09-02").get_data(as_text=True)
+    assert "Sara" in page
+    assert "Slot non previsto dalle regole attuali" in page
+
+
+def test_replan_reports_each_move_in_cli_and_day_view(client, app_module, make_booking):
+    booking_id = make_booking(event_date="2031-11-04", nome_festeggiato="Zeno", madre_telefono="3330000091")
+    conn = app_module.get_db()
+    conn.execute("UPDATE bookings SET area = 3 WHERE id = ?", (booking_id,))
+    conn.commit()
+    conn.close()
+
+    out = app_module.app.test_cli_runner().invoke(args=["replan-areas", "--season", "2031"]).output
+    assert f"#{booking_id} 2031-11-04 AFTERNOON Zeno: Area 3 -> Area 1" in out
+    assert "Spostata da Area 3 ad Area 1" in client.get("/day/2031-11-04").get_data(as_text=True)
+
+
+def test_occupancy_index_keeps_every_slot_code(app_module):
+    from datetime import date
+    index = app_module.OccupancyIndex()
+    conn = app_module.get_db()
+    index.refresh(conn)
+    conn.close()
+    codes = [f"S{i}" for i in range(12)]
+    for code in codes:
+        index.mark("2031-12-01", code, 3)
+    assert [index.areas_mask(date(2031, 12, 1), code) for code in codes] == [1 << 2] * 12
+    index.mark("1990-01-01", "S11", 1)  # giorno prima della base: tutti gli slot si spostano insieme
+    assert index.areas_mask(date(2031, 12, 1), "S0") == 1 << 2
+    assert index.areas_mask(date(1990, 1, 1), "S11") == 1
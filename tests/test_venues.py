@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_with_two_venues(tmp_path, script: str) -> str:
+    """Esegue lo script con due sedi configurate (la modalità si decide all'import di app)."""
+    env = {**os.environ, "VENUES": f"mare={tmp_path / 'mare.db'},citta={tmp_path / 'citta.db'}",
+           "JOBS_DIR": str(tmp_path / "jobs"), "ICS_TOKEN": "token-di-prova"}
+    env.pop("VENUE", None)
+    return subprocess.run([sys.executable, "-c", script], cwd=os.path.join(ROOT, "tests"), env=env,
+                          capture_output=True, text=True, check=True).stdout
+
+
+SETUP = (
+    "import sys\n"
+    f"sys.path.insert(0, {ROOT!r})\n"
+    "from conftest import booking_form\n"
+    "import app\n"
+    "c = app.app.test_client()\n"
+    "with c.session_transaction() as s:\n"
+    "    s['ok'] = True\n"
+    "r = c.post('/citta/booking/new?date=2031-11-05&slot=AFTERNOON', data=booking_form(),\n"
+    "           headers={'Accept': 'application/json'})\n"
+    "booking_id = r.get_json()['booking_id']\n"
+)
+
+
+def test_live_updates_stream_reads_the_request_venue(tmp_path):
+    script = SETUP + (
+        "r = c.get('/citta/events?since=0', environ_overrides={'wsgi.multithread': True})\n"
+        "chunks = iter(r.response)\n"
+        "print(next(chunks).strip())\n"
+        "print(next(chunks).strip())\n"
+        "r.close()\n"
+    )
+    out = run_with_two_venues(tmp_path, script)
+    assert '"date":"2031-11-05"' in out
+
+
+
+def test_calendar_uids_carry_the_venue(tmp_path):
+    script = SETUP + "print(c.get('/citta/calendario.ics?token=token-di-prova').get_data(as_text=True))\n"
+    out = run_with_two_venues(tmp_path, script)
+    assert "UID:booking-1@citta.lullyland" in out